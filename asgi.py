@@ -0,0 +1,85 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+# Entry point for running the app under an ASGI server, e.g. "uvicorn --workers=2 asgi:application"
+# The queries run as coroutines on each worker's event loop (ASYNC_PIPELINE), so waiting on OpenAI, xAI and Google holds no thread
+
+os.environ.setdefault('FLASK_ASYNC_PIPELINE', 'true')
+
+from project import create_app
+
+# Number of threads each worker runs Flask's (synchronous) views in, e.g. a query waiting on its coroutine or an open event stream
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+
+_view_pool = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='envisonet-view')
+
+
+# Class for one request to the Flask app
+# asgiref runs every request on one shared thread by default, so requests would be handled one at a time; here each gets a thread of the pool
+class PooledWsgiInstance(WsgiToAsgiInstance):
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False, executor=_view_pool)
+
+
+# Exception raised while a request body is received, once it is larger than MAX_CONTENT_LENGTH
+class BodyTooLarge(Exception):
+    pass
+
+
+# Class that serves a WSGI app over ASGI with the pool above, and answers the server's startup and shutdown messages
+# asgiref receives the whole request body before Flask runs, so the body limit is enforced here, while the body arrives:
+# from its Content-Length, or as soon as it goes past the limit. Admission control (see "main/admission.py") only runs once
+# the body has been received, which is why it is limited here first
+class PooledWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        limit = self.wsgi_application.config['MAX_CONTENT_LENGTH']
+        if limit is not None and scope["type"] == "http":
+            content_length = dict(scope["headers"]).get(b"content-length")
+            if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+                return await self.too_large(send)
+            receive = self.limited(receive, limit)
+
+        try:
+            await PooledWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+        except BodyTooLarge:
+            await self.too_large(send)
+
+    # Function that, given the server's receive function and a number of bytes, will return a receive function that raises
+    # BodyTooLarge once the body has gone past that many bytes
+    @staticmethod
+    def limited(receive, limit):
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise BodyTooLarge()
+            return message
+        return limited_receive
+
+    # Function that, given the server's send function, will answer 413 the same way as the app's handler (see "main/main.py")
+    @staticmethod
+    async def too_large(send):
+        body = json.dumps({'error': 'Upload too large'}).encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
+
+
+app = create_app()
+application = PooledWsgiToAsgi(app)
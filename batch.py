@@ -0,0 +1,327 @@
+import os
+import csv
+import sys
+import glob
+import time
+import hashlib
+import argparse
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from werkzeug.utils import secure_filename
+
+from project.main.audio import decode_webm, TTS_FORMATS
+from project.main.process import (speech_interpreter, image_interpreter, xaiprocess_semantic, route_query, tts_audio, synthesize,
+                                  SEMANTIC_KEYWORDS, TTS_FORMAT)
+from project.main.pipeline import start_stage
+from project.main.imaging import prepare_image
+from project.main.intent import local_intent
+from project.main.timing import StageTimer
+from project.main.clients import set_concurrency, CONCURRENCY
+from project.main import providers, vision_cache
+
+# Batch command: runs a folder (or manifest) of recorded queries through the same stages as the app, without Flask or a browser,
+# and writes the transcripts, intents, descriptions, answers, response audio and stage timings of every query to one results file
+#
+#   python batch.py queries/ --output results/ --workers 8
+#   python batch.py manifest.csv --output results/ --providers vision=xai --tts-policy quality --no-cache
+#
+# Results are written in parts while the batch runs, so a batch that was interrupted carries on where it stopped when run again
+
+# Image queries are "<name>.webm" with "<name>.jpg" (or ".jpeg", ".png") next to it, a WebM on its own is an audio query
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Results are written as Parquet when pyarrow (or fastparquet) is installed, otherwise as gzipped CSV
+PARQUET = any(importlib.util.find_spec(module) for module in ("pyarrow", "fastparquet"))
+RESULTS_EXTENSION = ".parquet" if PARQUET else ".csv.gz"
+
+# Stages timed for every query, in the order they run (stages a query did not have are left empty)
+STAGES = ("webm_decode", "image_prep", "stt", "intent", "semantic", "routing", "vision", "tts")
+
+PERCENTILES = (50, 95)
+
+
+# Function that, given a folder, will return its queries as dicts with an id, the WebM audio and the image (or None)
+def load_folder(folder):
+    items = []
+    for audio_path in sorted(glob.glob(os.path.join(folder, "*.webm"))):
+        base = os.path.splitext(audio_path)[0]
+        image_path = next((base + extension for extension in IMAGE_EXTENSIONS if os.path.exists(base + extension)), None)
+        items.append({'id': os.path.basename(base), 'audio': audio_path, 'image': image_path})
+    return items
+
+
+# Function that, given a CSV manifest with "audio" and optionally "id" and "image" columns (paths relative to the manifest),
+# will return its queries the same way as "load_folder"
+def load_manifest(path):
+    folder = os.path.dirname(os.path.abspath(path))
+    items = []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            audio_path = os.path.join(folder, row['audio'])
+            image_path = os.path.join(folder, row['image']) if row.get('image') else None
+            items.append({'id': row.get('id') or os.path.splitext(os.path.basename(audio_path))[0], 'audio': audio_path, 'image': image_path})
+
+    ids = [item['id'] for item in items]
+    if len(set(ids)) != len(ids):
+        raise SystemExit(f"{path} has queries with the same id, give them an \"id\" column")
+    return items
+
+
+# Function that, given a "name=value,name=value" string, will return the values by name
+def parse_settings(text):
+    return dict(pair.split("=") for pair in filter(None, (text or "").split(",")))
+
+
+# Function that, given the output folder, will return the paths of the results written so far (parts and merged results)
+def result_files(output):
+    return sorted(glob.glob(os.path.join(output, "parts", "*" + RESULTS_EXTENSION))
+                  + glob.glob(os.path.join(output, "results" + RESULTS_EXTENSION)))
+
+
+def read_results(path):
+    return pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path, keep_default_na=False, na_values=[""])
+
+
+# Function that, given a table of results and a path, will write it atomically (a part is either whole or missing)
+def write_results(frame, path):
+    tmp_path = path + f".{os.getpid()}.tmp"
+    if PARQUET:
+        frame.to_parquet(tmp_path, index=False)
+    else:
+        frame.to_csv(tmp_path, index=False, compression="gzip")
+    os.replace(tmp_path, path)
+
+
+# Function that, given the output folder, will return the results written so far, the last one for each query (None when there are none)
+def load_results(output):
+    frames = [read_results(path) for path in result_files(output)]
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True).drop_duplicates('id', keep='last')
+
+
+# Class that keeps the results of finished queries and writes them as a new part every "flush_every" queries
+class ResultWriter:
+    def __init__(self, output, flush_every):
+        self.folder = os.path.join(output, "parts")
+        self.flush_every = flush_every
+        self.rows = []
+        self.lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def add(self, row):
+        with self.lock:
+            self.rows.append(row)
+            if len(self.rows) >= self.flush_every:
+                self.flush()
+
+    # Function that writes the results that are not on disk yet (called with the lock held, or once the pool has stopped)
+    def flush(self):
+        if not self.rows:
+            return
+        path = os.path.join(self.folder, f"part-{time.time_ns()}{RESULTS_EXTENSION}")
+        write_results(pd.DataFrame(self.rows), path)
+        self.rows = []
+
+
+# Function that, given the output folder, will merge every part into one results file (the last result for each query) and remove the parts
+def merge_results(output):
+    parts = glob.glob(os.path.join(output, "parts", "*" + RESULTS_EXTENSION))
+    results = load_results(output)
+    if results is None:
+        return None
+    write_results(results.sort_values('id').reset_index(drop=True), os.path.join(output, "results" + RESULTS_EXTENSION))
+    for path in parts:
+        os.remove(path)
+    return results
+
+
+# Function that, given the transcript of an audio query, will return its intent (a keyword, or the answer) and the stage that decided it
+def interpret(timer, transcript, one_call):
+    semantic = timer.run("intent", ("stt",), local_intent, transcript)
+    if semantic:
+        return semantic, "intent"
+    # There is no conversation in a batch, so one-call routing has no last image to look at
+    if one_call:
+        return timer.run("routing", ("intent",), route_query, transcript, None), "routing"
+    return timer.run("semantic", ("intent",), xaiprocess_semantic, transcript), "semantic"
+
+
+# Function that, given text and whether the TTS cache may be used, will return its response audio (None if the TTS failed)
+def speak_text(text, use_cache):
+    if use_cache:
+        return tts_audio(text)
+    return synthesize(text)[0]
+
+
+# Function that, given a query id, will return the name of its response audio file
+# Ids that only differ in characters secure_filename drops (e.g. "a b" and "a_b", or "../x" and "x") would share a file, so a
+# short hash of the id itself is added
+def audio_name(item_id):
+    return f"{secure_filename(item_id)}-{hashlib.sha256(item_id.encode()).hexdigest()[:8]}"
+
+
+# Function that, given a query, the output folder and the options, will run the query through the pipeline and return its result row
+# Each query stands on its own: there is no user, so control keywords (logout, repeat, ...) are recorded but not acted on
+def run_item(item, output, one_call, use_cache):
+    timer = StageTimer("batch")
+    row = {'id': item['id'], 'audio': item['audio'], 'image': item['image'], 'kind': "image" if item['image'] else "audio",
+           'transcript': None, 'intent': None, 'decided_by': None, 'description': None, 'answer': None,
+           'audio_path': None, 'audio_bytes': None, 'status': "ok", 'error': None}
+    try:
+        # Loads, downscales and encodes the image while the audio is decoded and transcribed, the same as the app
+        image_future = start_stage(timer, "image_prep", (), prepare_image, item['image']) if item['image'] else None
+
+        with open(item['audio'], "rb") as f:
+            audio = timer.run("webm_decode", (), decode_webm, f)
+        transcript = row['transcript'] = timer.run("stt", ("webm_decode",), speech_interpreter, audio)
+
+        if not transcript:
+            timer.intent = "no_transcript"
+            text, after = None, None
+        elif image_future is not None:
+            timer.intent = "describe"
+            row['description'] = timer.run("vision", ("stt", "image_prep"), image_interpreter,
+                                           item['image'], transcript, image_future.result())
+            text, after = row['description'], "vision"
+        else:
+            semantic, row['decided_by'] = interpret(timer, transcript, one_call)
+            timer.intent = semantic if semantic in SEMANTIC_KEYWORDS else "answer"
+            row['answer'] = semantic if timer.intent == "answer" else None
+            text, after = row['answer'], row['decided_by']
+
+        if text:
+            audio_content = timer.run("tts", (after,), speak_text, text, use_cache)
+            if audio_content is None:
+                raise RuntimeError("Could not generate the response audio")
+            path = os.path.join(output, "audio", f"{audio_name(item['id'])}.{TTS_FORMATS[TTS_FORMAT]['extension']}")
+            with open(path, "wb") as f:
+                f.write(audio_content)
+            row['audio_path'] = os.path.relpath(path, output)
+            row['audio_bytes'] = len(audio_content)
+        elif transcript and timer.intent in ("describe", "answer"):
+            raise RuntimeError(f"No {timer.intent} was returned")
+
+    except Exception as e:
+        row['status'] = "error"
+        row['error'] = str(e)
+    finally:
+        # The next query on this thread starts its own timer, nothing after this may be recorded with this one
+        timer.close()
+
+    summary = timer.summary()
+    row['intent'] = timer.intent
+    for stage in STAGES:
+        row[f"{stage}_s"] = summary['stages'].get(stage)
+    row['total_s'] = summary['total']
+    row['serial_total_s'] = summary['serial_total']
+    row['critical_path'] = " -> ".join(summary['critical_path'])
+    return row
+
+
+# Function that, given the results of a batch and how long it took, will print its throughput, errors and stage timings
+def print_summary(results, ran, elapsed):
+    print(f"\n{ran} queries in {elapsed:.1f}s ({ran / elapsed if elapsed else 0:.2f} queries/s), "
+          f"{int((results['status'] == 'error').sum())} of {len(results)} failed (see the \"error\" column)")
+    print(f"\n{'stage':<16}" + "".join(f"{f'p{p} s':>10}" for p in PERCENTILES) + f"{'queries':>10}")
+    for column in [f"{stage}_s" for stage in STAGES] + ["total_s"]:
+        seconds = results[column].dropna().to_numpy(dtype=float) if column in results else np.array([])
+        if len(seconds):
+            print(f"{column[:-2]:<16}" + "".join(f"{np.percentile(seconds, p):>10.2f}" for p in PERCENTILES) + f"{len(seconds):>10}")
+    print("\nintents: " + ", ".join(f"{intent} {count}" for intent, count in results['intent'].value_counts().items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a folder or manifest of recorded queries through the pipeline.")
+    parser.add_argument("queries", help="folder of <name>.webm queries (with <name>.jpg for image queries), or a CSV manifest")
+    parser.add_argument("--output", required=True, help="folder for the results file and the response audio")
+    parser.add_argument("--workers", type=int, default=4, help="number of queries run at the same time")
+    parser.add_argument("--concurrency", help="requests in flight to each upstream, e.g. openai=4,google=8 (defaults: "
+                                              + ",".join(f"{name}={limit}" for name, limit in CONCURRENCY.items()) + ")")
+    parser.add_argument("--providers", help="provider to ask first for a stage, e.g. vision=xai,semantic=openai")
+    parser.add_argument("--tts-policy", choices=tuple(providers.TTS_POLICIES), help="TTS_POLICY to use")
+    parser.add_argument("--routing", choices=("two-stage", "one-call"), default="two-stage",
+                        help="xAI semantic engine, or one model call with tool calling, for audio queries")
+    parser.add_argument("--vision-cache", action="store_true",
+                        help="answer image questions asked before from the vision cache (its descriptions may come from another provider or prompt)")
+    parser.add_argument("--no-cache", action="store_true", help="send every query to the vision and TTS providers instead of the caches")
+    parser.add_argument("--flush-every", type=int, default=20, help="number of finished queries written at a time")
+    parser.add_argument("--restart", action="store_true", help="run every query again instead of carrying on from the last results")
+    args = parser.parse_args()
+
+    items = load_manifest(args.queries) if os.path.isfile(args.queries) else load_folder(args.queries)
+    if not items:
+        raise SystemExit(f"No queries found in {args.queries}")
+
+    # The limits and provider order have to be set before the first request
+    concurrency = parse_settings(args.concurrency)
+    for name in concurrency:
+        if name not in CONCURRENCY:
+            raise SystemExit(f"Unknown upstream '{name}', expected one of: {', '.join(CONCURRENCY)}")
+    set_concurrency({name: int(limit) for name, limit in concurrency.items()})
+    for stage, provider in parse_settings(args.providers).items():
+        if provider not in providers.STAGE_PROVIDERS.get(stage, ()):
+            raise SystemExit(f"Unknown provider '{provider}' for '{stage}', expected one of: "
+                             + ", ".join(f"{s}={p}" for s, ps in providers.STAGE_PROVIDERS.items() for p in ps))
+        providers.STAGE_PROVIDERS[stage] = (provider,) + tuple(p for p in providers.STAGE_PROVIDERS[stage] if p != provider)
+    if args.tts_policy:
+        providers.TTS_POLICY = args.tts_policy
+    # The vision cache is keyed on the image and question only, so descriptions from an earlier run with another provider or prompt
+    # would be given back as this run's
+    vision_cache.cache_enabled = args.vision_cache and not args.no_cache
+
+    os.makedirs(os.path.join(args.output, "audio"), exist_ok=True)
+    if args.restart:
+        for path in result_files(args.output):
+            os.remove(path)
+
+    # Queries that already have a result are skipped, the ones that failed are run again
+    previous = load_results(args.output)
+    done = set(previous.loc[previous['status'] == "ok", 'id']) if previous is not None else set()
+    pending = [item for item in items if item['id'] not in done]
+    print(f"{len(items)} queries, {len(items) - len(pending)} already done, {len(pending)} to run with {args.workers} workers")
+
+    writer = ResultWriter(args.output, args.flush_every)
+    start = time.perf_counter()
+    recorded = set()
+    pool = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='envisonet-batch')
+
+    # Function that, given a finished query, will keep its result and print it
+    def record(future):
+        row = future.result()
+        writer.add(row)
+        recorded.add(future)
+        print(f"[{len(recorded)}/{len(pending)}] {row['id']}: {row['status']} {row['intent']} in {row['total_s']:.2f}s"
+              + (f" ({row['error']})" if row['error'] else ""))
+
+    futures = [pool.submit(run_item, item, args.output, args.routing == "one-call", not args.no_cache) for item in pending]
+    try:
+        for future in as_completed(futures):
+            record(future)
+    except KeyboardInterrupt:
+        # Queries that had not started are dropped, the ones running are finished and kept with the others,
+        # so the next run carries on from there
+        print("\nInterrupted, finishing the queries that are running (Ctrl-C again to stop now)")
+        pool.shutdown(cancel_futures=True)
+        for future in futures:
+            if future.done() and not future.cancelled() and future not in recorded:
+                record(future)
+        with writer.lock:
+            writer.flush()
+        print(f"Stopped after {len(recorded)} queries, run the same command again to carry on")
+        sys.exit(130)
+    pool.shutdown()
+    with writer.lock:
+        writer.flush()
+
+    results = merge_results(args.output)
+    print_summary(results, len(recorded), time.perf_counter() - start)
+    print(f"\nResults: {os.path.join(args.output, 'results' + RESULTS_EXTENSION)}")
+
+
+if __name__ == "__main__":
+    main()
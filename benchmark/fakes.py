@@ -0,0 +1,238 @@
+import json
+import time
+import random
+import base64
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from project.main.audio import FFMPEG
+
+# Local stand-ins for OpenAI, xAI, Google speech recognition and Google TTS, so the app can be load tested for free
+# Each one answers like the real service after a configurable delay, and fails a configurable share of its requests
+
+# What the fake speech recognition hears, picked at random for every request
+TRANSCRIPTS = [
+    "what is in front of me",
+    "what colour is the car",
+    "is the door open",
+    "how many people are there",
+    "what colour was the sign in that picture",
+    "repeat that",
+]
+
+# What the fake vision model answers
+VISION_ANSWER = "A wooden table with a cup of coffee and a laptop on it. The cup is on the left, close to the edge."
+
+# What the fake semantic engine answers when the question does not fit a keyword
+SEMANTIC_ANSWER = "It is about twenty degrees outside. You might want a light jacket."
+
+# Number of chunks a streamed completion is split into
+STREAM_CHUNKS = 8
+
+# How many times longer than usual a slow request takes (see "slow_rate")
+SLOW_FACTOR = 8
+
+
+# Function that will return one second of MP3 audio, which the fake TTS services send back
+def sample_mp3():
+    result = subprocess.run([FFMPEG, "-loglevel", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=1",
+                             "-ac", "1", "-ar", "24000", "-b:a", "48k", "-f", "mp3", "pipe:1"],
+                            stdout=subprocess.PIPE, check=True)
+    return result.stdout
+
+
+# Class that handles the requests sent to one fake upstream
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # The benchmark report is the output, not one line per request
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        # Waits like the real service would (some requests take far longer), then fails some of the requests
+        delay = fake.latency * random.uniform(0.75, 1.25) * (SLOW_FACTOR if fake.slow() else 1)
+        if fake.failed():
+            time.sleep(delay)
+            return self.send_body(503, "application/json", json.dumps({"error": {"message": "Fake upstream error"}}).encode())
+
+        route = getattr(self, f"handle_{fake.kind}")
+        route(body, delay)
+
+    # Function that, given a status, a content type and a body, will send the response
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # OpenAI: chat completions (vision, the semantic engine when xAI fails, and one-call routing with tools), speech and transcriptions
+    def handle_openai(self, body, delay):
+        if self.path.endswith("/audio/speech"):
+            time.sleep(delay)
+            return self.send_body(200, "audio/mpeg", self.server.fake.mp3)
+        if self.path.endswith("/audio/transcriptions"):
+            time.sleep(delay)
+            return self.send_body(200, "application/json", json.dumps({"text": random.choice(TRANSCRIPTS)}).encode())
+        if json.loads(body).get("tools"):
+            return self.route(body, delay)
+        self.chat(body, delay, self.answer(body))
+
+    # Function that, given a chat request, will return the answer: a description when an image is attached, otherwise a keyword or an answer
+    def answer(self, body):
+        content = json.loads(body)["messages"][-1]["content"]
+        if isinstance(content, list):
+            return VISION_ANSWER
+        transcript = content.lower()
+        if "repeat" in transcript:
+            return "repeat"
+        if "picture" in transcript:
+            return "lastImage"
+        return SEMANTIC_ANSWER
+
+    # One-call routing: calls the "control" tool for control requests, otherwise answers (about the image when one is attached)
+    def route(self, body, delay):
+        content = json.loads(body)["messages"][-1]["content"]
+        if isinstance(content, list):
+            transcript = " ".join(part.get("text", "") for part in content).lower()
+            answer = VISION_ANSWER
+        else:
+            transcript = content.lower()
+            answer = "lastImage" if "picture" in transcript else SEMANTIC_ANSWER
+        if "repeat" in transcript:
+            answer = "repeat"
+
+        if answer not in ("repeat", "lastImage"):
+            return self.chat(body, delay, answer)
+        time.sleep(delay)
+        request = json.loads(body)
+        completion = {"id": "chatcmpl-bench", "created": int(time.time()), "model": request.get("model", "fake"),
+                      "object": "chat.completion", "choices": [{
+                          "index": 0, "finish_reason": "tool_calls",
+                          "message": {"role": "assistant", "content": None, "tool_calls": [{
+                              "id": "call_bench", "type": "function",
+                              "function": {"name": "control", "arguments": json.dumps({"action": answer})},
+                          }]},
+                      }], "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}}
+        self.send_body(200, "application/json", json.dumps(completion).encode())
+
+    # xAI: chat completions (semantic engine, and vision when OpenAI fails)
+    def handle_xai(self, body, delay):
+        self.chat(body, delay, self.answer(body))
+
+    # Google speech recognition: one JSON result per line, the first one empty like the real service
+    def handle_google(self, body, delay):
+        time.sleep(delay)
+        result = {"result": [{"alternative": [{"transcript": random.choice(TRANSCRIPTS), "confidence": 0.92}], "final": True}],
+                  "result_index": 0}
+        self.send_body(200, "application/json", ('{"result":[]}\n' + json.dumps(result) + "\n").encode())
+
+    # Google TTS: the "batchexecute" answer with the base64 MP3 inside
+    def handle_gtts(self, body, delay):
+        time.sleep(delay)
+        audio = base64.b64encode(self.server.fake.mp3).decode("ascii")
+        line = ')]}\'\n\n[["wrb.fr","jQ1olc","[\\"' + audio + '\\"]",null,null,null,"generic"]]\n'
+        self.send_body(200, "application/json", line.encode())
+
+    # Function that, given the request, the delay and an answer, will send a chat completion, streamed if it was asked for
+    def chat(self, body, delay, answer):
+        request = json.loads(body)
+        completion = {"id": "chatcmpl-bench", "created": int(time.time()), "model": request.get("model", "fake")}
+
+        if not request.get("stream"):
+            time.sleep(delay)
+            completion.update(object="chat.completion", choices=[{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": answer},
+            }], usage={"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0})
+            return self.send_body(200, "application/json", json.dumps(completion).encode())
+
+        # The first chunk arrives after half of the delay, the rest are spread over the other half
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = answer.split(" ")
+        size = max(1, len(words) // STREAM_CHUNKS)
+        pieces = [" ".join(words[i:i + size]) + " " for i in range(0, len(words), size)]
+        pieces[-1] = pieces[-1].rstrip()
+        time.sleep(delay / 2)
+        for piece in pieces:
+            chunk = dict(completion, object="chat.completion.chunk",
+                         choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            time.sleep(delay / 2 / len(pieces))
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    # Function that, given some bytes, will send them as one HTTP chunk
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+# Class for one fake upstream server running in a background thread
+class FakeUpstream:
+    def __init__(self, kind, latency, error_rate, mp3, slow_rate=0.0):
+        self.kind = kind
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.mp3 = mp3
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    # Function that counts a request and decides whether it fails
+    def failed(self):
+        failed = random.random() < self.error_rate
+        with self.lock:
+            self.requests += 1
+            self.errors += failed
+        return failed
+
+    # Function that decides whether a request is one of the slow ones
+    def slow(self):
+        return random.random() < self.slow_rate
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Function that, given the latency, error rate and share of slow requests of each upstream, will start the fakes and return them by name
+def start_fakes(latency, error_rate, slow_rate=None):
+    mp3 = sample_mp3()
+    return {kind: FakeUpstream(kind, latency[kind], error_rate[kind], mp3, (slow_rate or {}).get(kind, 0.0)).start()
+            for kind in ("openai", "xai", "google", "gtts")}
+
+
+# Function that, given the fakes, will return the environment variables that point the app at them
+def fake_environment(fakes):
+    return {
+        "OPENAI_BASE_URL": fakes["openai"].url + "/v1",
+        "OPENAI_API_KEY": "benchmark",
+        "xAI_BASE_URL": fakes["xai"].url + "/v1",
+        "xAI_API_KEY": "benchmark",
+        "GOOGLE_STT_URL": fakes["google"].url + "/speech-api/v2/recognize",
+        "GTTS_URL": fakes["gtts"].url + "/_/TranslateWebserverUi/data/batchexecute",
+        "NO_PROXY": "127.0.0.1,localhost",
+    }
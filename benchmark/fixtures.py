@@ -0,0 +1,56 @@
+import os
+import glob
+import random
+import subprocess
+from PIL import Image, ImageDraw
+
+from project.main.audio import FFMPEG
+
+# Recorded queries are replayed from a folder: every "<name>.webm" is a query, and an image with the same name ("<name>.jpg" or
+# "<name>.png") makes it an image query
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+# Function that, given a folder, will return its queries as dicts with the name, the WebM audio and the image (or None)
+def load_fixtures(folder):
+    fixtures = []
+    for audio_path in sorted(glob.glob(os.path.join(folder, "*.webm"))):
+        base = os.path.splitext(audio_path)[0]
+        fixture = {'name': os.path.basename(base), 'audio': open(audio_path, "rb").read(), 'image': None, 'image_name': None}
+        for extension in IMAGE_EXTENSIONS:
+            if os.path.exists(base + extension):
+                fixture['image'] = open(base + extension, "rb").read()
+                fixture['image_name'] = os.path.basename(base + extension)
+                break
+        fixtures.append(fixture)
+    return fixtures
+
+
+# Function that, given a path and a duration, will record a tone in WebM/Opus like the browser's MediaRecorder
+def make_webm(path, seconds):
+    subprocess.run([FFMPEG, "-loglevel", "error", "-y", "-f", "lavfi", "-i", f"sine=frequency=300:duration={seconds}",
+                    "-ac", "1", "-ar", "48000", "-c:a", "libopus", "-b:a", "32k", path], check=True)
+
+
+# Function that, given a path and a seed, will draw a photo-sized image with a few shapes on it
+def make_image(path, seed):
+    rng = random.Random(seed)
+    image = Image.new("RGB", (3024, 4032), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(3024), rng.randrange(4032)
+        draw.rectangle((x, y, x + rng.randrange(200, 1200), y + rng.randrange(200, 1200)),
+                       fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    image.save(path, quality=90)
+
+
+# Function that, given a folder, will fill it with synthetic queries (used when there are no recorded ones)
+def generate_fixtures(folder):
+    os.makedirs(folder, exist_ok=True)
+    for i, seconds in enumerate((2, 4)):
+        make_webm(os.path.join(folder, f"image_{i}.webm"), seconds)
+        make_image(os.path.join(folder, f"image_{i}.jpg"), i)
+    for i, seconds in enumerate((2, 3)):
+        make_webm(os.path.join(folder, f"audio_{i}.webm"), seconds)
+    return load_fixtures(folder)
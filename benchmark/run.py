@@ -0,0 +1,448 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from .fakes import start_fakes, fake_environment
+from .fixtures import load_fixtures, generate_fixtures
+
+# Load test for the whole app: starts gunicorn against local fake upstreams, replays recorded queries from many logged-in
+# sessions at once, and reports latency per route, throughput and peak memory per worker
+#
+#   python -m benchmark.run --users 8 --queries 10 --save-baseline benchmark/baseline.json
+#   python -m benchmark.run --users 8 --queries 10 --baseline benchmark/baseline.json
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Default delay (in seconds) and share of failed requests of every fake upstream
+DEFAULT_LATENCY = {'openai': 1.0, 'xai': 0.4, 'google': 0.5, 'gtts': 0.3}
+DEFAULT_ERROR_RATE = {'openai': 0.0, 'xai': 0.0, 'google': 0.0, 'gtts': 0.0}
+DEFAULT_SLOW_RATE = {'openai': 0.0, 'xai': 0.0, 'google': 0.0, 'gtts': 0.0}
+
+# Seconds between two job status requests (the same as the frontend)
+POLL_INTERVAL = 0.5
+
+# Seconds a query may take before it counts as failed
+QUERY_TIMEOUT = 120
+
+# Number of times a query turned away by admission control (429 or 503) is sent again, after the Retry-After it was given
+BUSY_RETRIES = 5
+
+# Percentiles in the report
+PERCENTILES = (50, 95, 99)
+
+# Parts of a path that change between requests, replaced so requests to the same route are counted together
+ROUTE_PATTERNS = [
+    (re.compile(r"^/job_status/\w+"), "/job_status/<job_id>"),
+    (re.compile(r"^/response_audio/\w+"), "/response_audio/<response_id>"),
+    (re.compile(r"^/stream_response_audio/\w+"), "/stream_response_audio/<stream_id>"),
+    (re.compile(r"^/static/.*"), "/static/<path>"),
+]
+
+
+# Function that, given a "name=value,name=value" string and the defaults, will return the values by name
+def parse_settings(text, defaults):
+    settings = dict(defaults)
+    for pair in filter(None, (text or "").split(",")):
+        name, value = pair.split("=")
+        if name not in settings:
+            raise SystemExit(f"Unknown upstream '{name}', expected one of: {', '.join(settings)}")
+        settings[name] = float(value)
+    return settings
+
+
+# Function that, given a URL path, will return the route it belongs to
+def route_of(path):
+    path = path.split("?")[0]
+    for pattern, route in ROUTE_PATTERNS:
+        if pattern.match(path):
+            return route
+    return path
+
+
+# Class that collects the duration and result of every request and query, from every session
+class Recorder:
+    def __init__(self):
+        self.requests = {}
+        self.queries = []
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def request(self, route, seconds, ok):
+        with self.lock:
+            self.requests.setdefault(route, []).append((seconds, ok))
+
+    def query(self, seconds, ok):
+        with self.lock:
+            self.queries.append((seconds, ok))
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+
+
+# Class for one logged-in user sending queries the same way the frontend does
+class Session:
+    def __init__(self, base_url, username, recorder):
+        self.base_url = base_url
+        self.username = username
+        self.recorder = recorder
+        self.http = requests.Session()
+        self.http.trust_env = False
+
+    # Function that, given a method, a path and the request options, will send a request without following redirects and record it
+    def send(self, method, path, **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = self.http.request(method, self.base_url + path, allow_redirects=False, timeout=QUERY_TIMEOUT, **kwargs)
+            ok = response.status_code < 400
+            return response
+        finally:
+            self.recorder.request(route_of(path), time.perf_counter() - start, ok)
+
+    # Function that, given a method, a path and the request options, will send the request and follow every redirect
+    def follow(self, method, path, **kwargs):
+        response = self.send(method, path, **kwargs)
+        while response.is_redirect:
+            response = self.send("GET", response.headers["Location"].replace(self.base_url, ""))
+        return response
+
+    # Function that registers the user and logs in (which also creates the user's upload folder)
+    def login(self):
+        form = {'username': self.username, 'password': 'benchmark'}
+        self.http.post(self.base_url + "/register", data=form, timeout=QUERY_TIMEOUT)
+        response = self.http.post(self.base_url + "/login", data=form, timeout=QUERY_TIMEOUT)
+        if not response.url.endswith("/service"):
+            raise RuntimeError(f"Could not log in as {self.username}")
+
+    # Function that, given a fixture, will send it as a query and wait for the response audio, returning whether it worked
+    def query(self, fixture):
+        files = {'audio': (f"{fixture['name']}.webm", fixture['audio'], "audio/webm")}
+        if fixture['image'] is not None:
+            files['image'] = (fixture['image_name'], fixture['image'], "image/jpeg")
+
+        # Queries turned away because the server is busy are sent again, the same way the frontend does
+        response = self.follow("POST", "/upload_files", files=files)
+        for _ in range(BUSY_RETRIES):
+            if response.status_code not in (429, 503):
+                break
+            self.recorder.reject()
+            time.sleep(float(response.headers.get("Retry-After", 5)))
+            response = self.follow("POST", "/upload_files", files=files)
+        if not response.ok:
+            return False
+        result = response.json()
+
+        # Background jobs are polled until they finish
+        if 'job_id' in result:
+            deadline = time.time() + QUERY_TIMEOUT
+            while True:
+                time.sleep(POLL_INTERVAL)
+                status = self.send("GET", result['status_url']).json()
+                if status['status'] in ('done', 'error'):
+                    break
+                if time.time() > deadline:
+                    return False
+            if status['status'] == 'error':
+                return False
+            result = status['result']
+
+        # The query is finished when the response audio has been downloaded
+        if result.get('audio_url'):
+            response = self.follow("GET", result['audio_url'])
+            return response.ok and response.headers.get("Content-Type", "").startswith("audio/")
+        return 'error' not in result
+
+    # Function that, given the fixtures and the number of queries, will send them one after the other
+    def run(self, fixtures, queries):
+        for _ in range(queries):
+            start = time.perf_counter()
+            try:
+                ok = self.query(random.choice(fixtures))
+            except (requests.RequestException, ValueError, KeyError) as e:
+                print(f"Query from {self.username} failed: {e}")
+                ok = False
+            self.recorder.query(time.perf_counter() - start, ok)
+
+
+# Function that, given a process id, will return the ids of its child processes
+def child_pids(pid):
+    children = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # The parent id is the second field after the process name (which is in brackets and may contain spaces)
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (FileNotFoundError, ProcessLookupError, IndexError):
+            continue
+        if parent == pid:
+            children.append(int(name))
+    return children
+
+
+# Function that, given a process id, will return its peak resident memory in bytes (or None once it has exited)
+def peak_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        return None
+    return None
+
+
+# Class that keeps track of the peak memory of every gunicorn worker while the benchmark runs
+class MemorySampler:
+    def __init__(self, master_pid, interval=0.5):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peaks = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample_forever, daemon=True)
+
+    def sample(self):
+        for pid in child_pids(self.master_pid):
+            rss = peak_rss(pid)
+            if rss is not None:
+                self.peaks[pid] = max(rss, self.peaks.get(pid, 0))
+
+    def sample_forever(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.sample()
+        self.stopped.set()
+        self.thread.join()
+
+
+# Commands that start the app with each server (uvicorn serves "asgi.py", see "Async Mode" in the readme)
+SERVERS = {
+    'gunicorn': lambda workers, port: ["gunicorn", f"--workers={workers}", f"--bind=127.0.0.1:{port}", "--timeout=120", "app:app"],
+    'uvicorn': lambda workers, port: ["uvicorn", f"--workers={workers}", "--host=127.0.0.1", f"--port={port}", "asgi:application"],
+}
+
+
+# Function that, given the working folder, the environment, the port, the number of workers and the server, will start the app
+def start_app(workdir, env, port, workers, server_name="gunicorn"):
+    # Another server on the port would answer instead of the one being tested
+    try:
+        requests.get(f"http://127.0.0.1:{port}/login", timeout=1)
+        raise RuntimeError(f"Port {port} is already in use, pick another one with --port")
+    except (requests.ConnectionError, requests.Timeout):
+        pass
+
+    # Creates the database of the benchmark users
+    subprocess.run([sys.executable, os.path.join(REPO, "config.py")], cwd=workdir, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+    log = open(os.path.join(workdir, f"{server_name}.log"), "w")
+    server = subprocess.Popen([sys.executable, "-m"] + SERVERS[server_name](workers, port),
+                              cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    # Waits until the app answers
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"{server_name} exited, see {log.name}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/login", timeout=5)
+            return server
+        except (requests.ConnectionError, requests.Timeout):
+            time.sleep(0.2)
+    server.terminate()
+    server.wait()
+    raise RuntimeError(f"{server_name} did not start, see {log.name}")
+
+
+# Function that, given a list of durations, will return the percentiles in milliseconds
+def percentiles(durations):
+    if not durations:
+        return {f"p{p}": None for p in PERCENTILES}
+    values = np.percentile(np.array(durations) * 1000, PERCENTILES)
+    return {f"p{p}": round(float(value), 1) for p, value in zip(PERCENTILES, values)}
+
+
+# Function that, given the recorded requests and queries, the run time, the fakes and the memory peaks, will build the report
+def build_report(recorder, elapsed, fakes, peaks, settings):
+    routes = {}
+    for route, samples in sorted(recorder.requests.items()):
+        routes[route] = dict(percentiles([seconds for seconds, _ in samples]),
+                             requests=len(samples), errors=sum(not ok for _, ok in samples))
+
+    queries = [seconds for seconds, _ in recorder.queries]
+    return {
+        'settings': settings,
+        'elapsed': round(elapsed, 2),
+        'queries': dict(percentiles(queries), count=len(queries), errors=sum(not ok for _, ok in recorder.queries)),
+        'rejected': recorder.rejected,
+        'throughput': {
+            'queries_per_second': round(len(queries) / elapsed, 3),
+            'requests_per_second': round(sum(len(samples) for samples in recorder.requests.values()) / elapsed, 3),
+        },
+        'routes': routes,
+        'upstreams': {name: {'requests': fake.requests, 'errors': fake.errors} for name, fake in fakes.items()},
+        'peak_rss_mb': {str(pid): round(rss / 2 ** 20, 1) for pid, rss in sorted(peaks.items())},
+    }
+
+
+# Function that, given a report, will print it as tables
+def print_report(report):
+    def row(name, stats):
+        cells = "".join(f"{stats[f'p{p}'] if stats[f'p{p}'] is not None else '-':>10}" for p in PERCENTILES)
+        return f"{name:<38}{cells}"
+
+    header = "".join(f"{f'p{p} ms':>10}" for p in PERCENTILES)
+    print(f"\n{'route':<38}{header}{'requests':>10}{'errors':>8}")
+    for route, stats in report['routes'].items():
+        print(f"{row(route, stats)}{stats['requests']:>10}{stats['errors']:>8}")
+    queries = report['queries']
+    print(f"{row('whole query', queries)}{queries['count']:>10}{queries['errors']:>8}")
+
+    throughput = report['throughput']
+    print(f"\nthroughput: {throughput['queries_per_second']} queries/s, {throughput['requests_per_second']} requests/s "
+          f"over {report['elapsed']}s")
+    print(f"turned away by admission control (and sent again): {report['rejected']}")
+    print("upstream calls: " + ", ".join(f"{name} {stats['requests']} ({stats['errors']} failed)"
+                                         for name, stats in report['upstreams'].items()))
+    print("peak RSS per worker: " + ", ".join(f"pid {pid} {mb} MB" for pid, mb in report['peak_rss_mb'].items()))
+
+
+# Function that, given a report, a baseline and the allowed slowdown, will print the differences and return the regressions
+def compare(report, baseline, tolerance):
+    regressions = []
+
+    def check(name, current, previous, higher_is_worse=True):
+        if current is None or not previous:
+            return
+        change = (current - previous) / previous
+        worse = change > tolerance if higher_is_worse else -change > tolerance
+        print(f"{name:<48}{previous:>10}{current:>10}{change:>+9.1%}{'  REGRESSION' if worse else ''}")
+        if worse:
+            regressions.append(name)
+
+    print(f"\n{'compared with baseline':<48}{'before':>10}{'now':>10}{'change':>9}")
+    for p in PERCENTILES:
+        check(f"whole query p{p} ms", report['queries'][f'p{p}'], baseline['queries'].get(f'p{p}'))
+    for route, stats in report['routes'].items():
+        if route in baseline['routes']:
+            check(f"{route} p95 ms", stats['p95'], baseline['routes'][route]['p95'])
+    check("queries/s", report['throughput']['queries_per_second'], baseline['throughput']['queries_per_second'],
+          higher_is_worse=False)
+    check("max peak RSS MB", max(report['peak_rss_mb'].values(), default=None),
+          max(baseline['peak_rss_mb'].values(), default=None))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app against local fake upstreams.")
+    parser.add_argument("--users", type=int, default=8, help="number of logged-in sessions sending queries at once")
+    parser.add_argument("--queries", type=int, default=10, help="number of queries each session sends")
+    parser.add_argument("--workers", type=int, default=2, help="number of server workers")
+    parser.add_argument("--server", choices=tuple(SERVERS), default="gunicorn", help="serve the app with gunicorn (WSGI) or uvicorn (ASGI)")
+    parser.add_argument("--pipeline", choices=("threads", "async"),
+                        help="run queries on a thread each or as coroutines (ASYNC_PIPELINE), async by default with uvicorn")
+    parser.add_argument("--port", type=int, default=8400, help="port the app listens on")
+    parser.add_argument("--mode", choices=("jobs", "inline"), default="jobs",
+                        help="background jobs (ASYNC_JOBS) or within the upload request")
+    parser.add_argument("--routing", choices=("two-stage", "one-call"), default="two-stage",
+                        help="semantic engine then vision model, or one model call with tool calling (ONE_CALL_ROUTING)")
+    parser.add_argument("--responses", choices=("whole", "streamed"), default="whole",
+                        help="generate the whole response first, or stream it sentence by sentence (STREAM_RESPONSES)")
+    parser.add_argument("--latency", help="seconds of delay per upstream, e.g. openai=1.5,google=0.3")
+    parser.add_argument("--error-rate", help="share of failed requests per upstream, e.g. openai=0.05")
+    parser.add_argument("--slow-rate", help="share of requests per upstream that take 8 times longer, e.g. google=0.1")
+    parser.add_argument("--tts-policy", choices=("free", "quality", "free_only"), default="free", help="TTS_POLICY of the app")
+    parser.add_argument("--fixtures", default=os.path.join(REPO, "benchmark", "fixtures"),
+                        help="folder of recorded queries (synthetic ones are used when it has none)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the choice of fixtures and upstream errors")
+    parser.add_argument("--output", help="where to write the report as JSON")
+    parser.add_argument("--baseline", help="report to compare with")
+    parser.add_argument("--save-baseline", help="where to save this report as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="slowdown allowed before it counts as a regression")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    latency = parse_settings(args.latency, DEFAULT_LATENCY)
+    error_rate = parse_settings(args.error_rate, DEFAULT_ERROR_RATE)
+    slow_rate = parse_settings(args.slow_rate, DEFAULT_SLOW_RATE)
+
+    # Every run starts from an empty working folder, so caches and uploads from earlier runs do not count
+    workdir = tempfile.mkdtemp(prefix="envisonet-benchmark-")
+    os.makedirs(os.path.join(workdir, "FILES"))
+    fixtures = load_fixtures(args.fixtures) or generate_fixtures(os.path.join(workdir, "fixtures"))
+    print(f"Working folder: {workdir} ({len(fixtures)} fixtures)")
+
+    fakes = start_fakes(latency, error_rate, slow_rate)
+    env = dict(os.environ, **fake_environment(fakes))
+    env.update({
+        'PYTHONPATH': REPO,
+        'FLASK_SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'db.sqlite')}",
+        'FLASK_ASYNC_JOBS': "true" if args.mode == "jobs" else "false",
+        'FLASK_ONE_CALL_ROUTING': "true" if args.routing == "one-call" else "false",
+        'FLASK_STREAM_RESPONSES': "true" if args.responses == "streamed" else "false",
+        'TTS_POLICY': args.tts_policy,
+    })
+    if args.pipeline:
+        env['FLASK_ASYNC_PIPELINE'] = "true" if args.pipeline == "async" else "false"
+
+    server = start_app(workdir, env, args.port, args.workers, args.server)
+    sampler = MemorySampler(server.pid).start()
+    try:
+        base_url = f"http://127.0.0.1:{args.port}"
+        recorder = Recorder()
+        sessions = [Session(base_url, f"benchmark{i}", recorder) for i in range(args.users)]
+        for session in sessions:
+            session.login()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            for future in [pool.submit(session.run, fixtures, args.queries) for session in sessions]:
+                future.result()
+        elapsed = time.perf_counter() - start
+    finally:
+        sampler.stop()
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        for fake in fakes.values():
+            fake.stop()
+
+    settings = {'users': args.users, 'queries': args.queries, 'workers': args.workers, 'mode': args.mode, 'routing': args.routing,
+                'responses': args.responses, 'latency': latency, 'error_rate': error_rate, 'fixtures': len(fixtures)}
+    report = build_report(recorder, elapsed, fakes, sampler.peaks, settings)
+    print_report(report)
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != settings:
+            print("\nWARNING: the baseline was recorded with different settings")
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
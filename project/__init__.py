@@ -1,29 +1,95 @@
+import os
+import logging
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from sqlalchemy import event
 
 # Initializes SQLAlchemy
 db = SQLAlchemy()
 
+# Settings for every SQLite connection: WAL lets readers carry on while a worker writes, NORMAL sync is safe with WAL and skips most fsyncs,
+# and a connection waits up to busy_timeout ms for another worker's write instead of failing with "database is locked"
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
+
+
+# Function that, given a new SQLite connection, will apply SQLITE_PRAGMAS to it
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
 def create_app():
     app = Flask(__name__)
 
     app.config['SECRET_KEY'] = 'supermagicultrasecretkey'
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///db.sqlite'
+    # Connections kept open in each worker (request and job threads each hold one while they use the database), and seconds a thread
+    # waits for a free one
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 10, 'pool_recycle': 3600}
     app.config['FLASK_ENV'] = 'development'
     app.config['DEBUG'] = True
 
+    # Queries are queued in a background worker pool and the frontend polls for the result (False processes it within the upload request)
+    app.config['ASYNC_JOBS'] = True
+    # Number of queries each gunicorn worker processes at the same time
+    app.config['JOB_WORKERS'] = 4
+    # Queries each user may have in flight (running or queued), and all users together across the workers, see "main/admission.py"
+    # Past these a query is turned away with 429 (the user's limit) or 503 (the server's), with a Retry-After hint
+    app.config['MAX_USER_QUERIES'] = 2
+    app.config['MAX_QUERIES_IN_FLIGHT'] = 16
+    # Bytes a request body may have, larger uploads are turned away with 413 while they are read (or from their Content-Length)
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 2 ** 20
+    # One model call with tool calling picks the control action or answers (with the last image attached), instead of the
+    # xAI semantic engine followed by the vision model (False)
+    app.config['ONE_CALL_ROUTING'] = False
+    # Stream answers sentence by sentence while they are generated (True) or generate the whole response first (False)
+    app.config['STREAM_RESPONSES'] = False
+    # Run the queries as coroutines on one event loop per worker (True) or on a thread each (False), see "main/aio.py"
+    app.config['ASYNC_PIPELINE'] = False
+    # nginx internal location that serves the scratch folder (e.g. "/_responses"), response audio is then sent with X-Accel-Redirect
+    app.config['X_ACCEL_RESPONSES'] = os.environ.get('X_ACCEL_RESPONSES')
+    # Removes expired files and enforces the storage quotas in a background thread of each worker (see "project/main/storage.py")
+    app.config['STORAGE_SWEEPER'] = True
+    # When set, "/metrics" can only be read with this bearer token, otherwise only by requests from this machine that did not come through a proxy
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    # PBKDF2-SHA256 iterations for new password hashes, each login takes about this much CPU (0.3s for 600000 on a t2.micro)
+    # Passwords hashed with another count still work and are hashed again with this one at the next login
+    app.config['PASSWORD_HASH_ITERATIONS'] = 600000
+
+    # Structured (JSON) log lines for every query, with its request id and stage timings
+    log = logging.getLogger('envisonet')
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+
+    # Any setting can be overridden with a "FLASK_" environment variable (e.g. FLASK_ASYNC_JOBS=false)
+    app.config.from_prefixed_env()
+
     db.init_app(app)
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', set_sqlite_pragmas)
 
     login_manager = LoginManager()
     login_manager.login_view = 'auth.login'
     login_manager.init_app(app)
 
-    from .auth.models import User
+    from .auth.user_cache import user_cache
 
+    # Logged-in requests get their user from this worker's user cache, see "auth/user_cache.py"
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return user_cache.get(int(user_id))
 
     # Blueprint for auth routes
     from .auth.auth import auth as auth_blueprint
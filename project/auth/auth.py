@@ -1,11 +1,30 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, session, app
+from flask import Blueprint, render_template, redirect, url_for, request, flash, session, app, current_app
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_login import login_user, login_required, logout_user
+from flask_login import login_user, login_required, logout_user, current_user
 from .models import User
+from .user_cache import user_cache
+from ..main.metrics import stage
 from .. import db
 
 auth = Blueprint('auth', __name__)
 
+
+# Function that will return the method new passwords are hashed with (the number of iterations is PASSWORD_HASH_ITERATIONS)
+def password_method():
+    return f"pbkdf2:sha256:{current_app.config['PASSWORD_HASH_ITERATIONS']}"
+
+
+# Function that, given a password, will hash it (timed as the "password_hash" stage on "/metrics")
+def hash_password(password):
+    with stage("password_hash", route=request.path):
+        return generate_password_hash(password, method=password_method())
+
+
+# Function that, given a password hash and a password, will check the password (timed as the "password_check" stage on "/metrics")
+def check_password(password_hash, password):
+    with stage("password_check", route=request.path):
+        return check_password_hash(password_hash, password)
+
 # Route that serves the login page
 @auth.route('/login')
 def login():
@@ -21,11 +40,16 @@ def login_post():
     user = User.query.filter_by(username=username).first()
 
     # Checks if the user actually exists and takes the password, hashes it, and compares it to the hashed password in the database
-    if not user or not check_password_hash(user.password, password):
+    if not user or not check_password(user.password, password):
         flash('Please check your login credentials and try again.')
         # Reloads the page if the user doesn't exist or password is wrong
         return redirect(url_for('auth.login'))
 
+    # Passwords hashed with another number of iterations are hashed again with the current one, now that the password is known
+    if not user.password.startswith(password_method() + "$"):
+        user.password = hash_password(password)
+        db.session.commit()
+
     # If the above check passes, the user has the right credentials, so log them in
     login_user(user, remember=remember)
 
@@ -50,7 +74,7 @@ def register_post():
     # If a username that is not already used and a password are submitted, add the user to the database
     if username != '' and password != '' and not user: 
         # Creates a new user with the form data and hashes the password so the plaintext version isn't saved.
-        new_user = User(username=username, password=generate_password_hash(password, method='pbkdf2:sha256'))
+        new_user = User(username=username, password=hash_password(password))
 
         # Add the new user to the database
         db.session.add(new_user)
@@ -80,5 +104,7 @@ def register_post():
 @auth.route('/logout')
 @login_required
 def logout():
+    # The next login loads the user from the database again
+    user_cache.invalidate(current_user.id)
     logout_user()
     return redirect(url_for('auth.login'))
\ No newline at end of file
@@ -5,4 +5,12 @@ from project import db
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(250), unique=True, nullable=False)
-    password = db.Column(db.String(250), nullable=False)
\ No newline at end of file
+    password = db.Column(db.String(250), nullable=False)
+
+# Conversation state of each user (looked up by the user's id), used by follow-up queries such as "repeat" and "in the last image"
+class Conversation(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    last_image = db.Column(db.String(250))
+    last_transcript = db.Column(db.Text)
+    last_response_id = db.Column(db.String(32))
+    updated = db.Column(db.Float, nullable=False)
@@ -0,0 +1,84 @@
+import time
+import threading
+from sqlalchemy import event
+
+from project import db
+from .models import User
+
+# Users loaded by "load_user" are kept for a short while in each gunicorn worker, so logged-in requests do not read the database
+# every time. Changes to a user made through this worker drop it straight away, other workers see them within USER_CACHE_TTL seconds
+
+# Seconds a loaded user is kept
+USER_CACHE_TTL = 60
+
+# Number of users kept in each worker
+USER_CACHE_MAX_ENTRIES = 1000
+
+
+# Class for the per-worker cache of users, by id
+class UserCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.users = {}
+        self.lock = threading.Lock()
+        # Counters for this worker
+        self.hits = 0
+        self.misses = 0
+
+    # Function that, given a user id, will return the user (from the cache, or from the database) or None if there is no such user
+    def get(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+
+        # The user is taken out of the request's session, so commits made later in the request (or in other requests) do not expire it
+        db.session.expunge(user)
+        with self.lock:
+            if len(self.users) >= self.max_entries:
+                self.evict(now)
+            self.users[user_id] = (user, now + self.ttl)
+        return user
+
+    # Function that, given the current time, will remove expired users, or the oldest half when none have expired
+    def evict(self, now):
+        expired = [user_id for user_id, (_, expires) in self.users.items() if expires <= now]
+        if not expired:
+            expired = sorted(self.users, key=lambda user_id: self.users[user_id][1])[:len(self.users) // 2]
+        for user_id in expired:
+            del self.users[user_id]
+
+    # Function that, given a user id, will drop the user from the cache
+    def invalidate(self, user_id):
+        with self.lock:
+            self.users.pop(user_id, None)
+
+    # Function that will return the cache's statistics
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.users),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+# The cache shared by the whole worker
+user_cache = UserCache(USER_CACHE_TTL, USER_CACHE_MAX_ENTRIES)
+
+
+# Users that are changed or removed through the model are dropped from the cache
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user(mapper, connection, user):
+    user_cache.invalidate(user.id)
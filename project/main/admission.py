@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import fcntl
+import threading
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from .storage import SCRATCH_FOLDER
+from .metrics import Counter
+
+# Admission control: a query is only accepted when its user has fewer than MAX_USER_QUERIES queries in flight, all gunicorn workers
+# together have fewer than MAX_QUERIES_IN_FLIGHT, and the instance still has memory to spare. Anything else is turned away straight
+# away (before its upload is read) with a Retry-After hint, instead of waiting in a queue the user would give up on
+# Queries are counted in a small JSON file in the scratch folder, so the limits hold across workers. A streamed recording takes its
+# slot when it starts (its segments are recognized while the user speaks), and the query about it takes the slot over
+
+# Queries in flight (running or queued) and the lock every worker takes to change them
+ADMISSION_PATH = os.path.join(SCRATCH_FOLDER, 'admission.json')
+ADMISSION_LOCK_PATH = os.path.join(SCRATCH_FOLDER, '.admission.lock')
+
+# Seconds after which a query that was never released stops counting (its worker was killed, or it hung)
+SLOT_TTL = 10 * 60
+
+# Seconds a streamed recording keeps its slot without a new chunk, so a recording that was abandoned soon stops counting
+RECORDING_SLOT_TTL = 30
+
+# Bytes of memory (MemAvailable) the instance has to keep free for a new query to be accepted
+MIN_FREE_MEMORY = 100 * 2 ** 20
+
+# Seconds clients are told to wait before trying again, for each reason a query is turned away
+RETRY_AFTER = {
+    'user_limit': 3,
+    'queue_full': 5,
+    'low_memory': 10,
+}
+
+# Bytes read from an upload at a time while checking its size
+READ_SIZE = 64 * 1024
+
+REJECTIONS = Counter('envisonet_admission_rejections_total', "Requests turned away by admission control, by reason.", ('reason',))
+
+_lock = threading.Lock()
+
+
+# Class for a query that was turned away, with the status to answer with and the seconds the client should wait
+class Rejected(Exception):
+    def __init__(self, reason, status):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = RETRY_AFTER[reason]
+
+
+# Function that will return the bytes of memory the instance can still give to new work (None where /proc/meminfo does not exist)
+def memory_available():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# Function that, given a process id, will return whether the process is still running
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Function that will return the queries in flight by slot id, without the ones that expired or whose worker is gone
+def load_slots():
+    try:
+        with open(ADMISSION_PATH) as f:
+            slots = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    now = time.time()
+    return {slot_id: slot for slot_id, slot in slots.items()
+            if slot.get('expires', slot['started'] + SLOT_TTL) > now and process_alive(slot['pid'])}
+
+
+def save_slots(slots):
+    tmp_path = ADMISSION_PATH + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(slots, f)
+    os.replace(tmp_path, ADMISSION_PATH)
+
+
+# Function that, given a function of the queries in flight, will call it with every worker locked out and save what it changed
+def update_slots(change):
+    os.makedirs(SCRATCH_FOLDER, exist_ok=True)
+    with _lock, open(ADMISSION_LOCK_PATH, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            slots = load_slots()
+            result = change(slots)
+            save_slots(slots)
+            return result
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# Function that, given the app, a user id and the seconds the slot lasts unless it is renewed, will take a slot for one query
+# of the user and return its id. Raises Rejected when the user, the workers or the instance cannot take another query
+def admit(app, user_id, ttl=SLOT_TTL):
+    free_memory = memory_available()
+    if free_memory is not None and free_memory < MIN_FREE_MEMORY:
+        REJECTIONS.inc(reason='low_memory')
+        raise Rejected('low_memory', 503)
+
+    def take(slots):
+        if sum(slot['user_id'] == user_id for slot in slots.values()) >= app.config['MAX_USER_QUERIES']:
+            raise Rejected('user_limit', 429)
+        if len(slots) >= app.config['MAX_QUERIES_IN_FLIGHT']:
+            raise Rejected('queue_full', 503)
+        slot_id = f"{os.getpid()}.{threading.get_ident()}.{time.monotonic_ns()}"
+        now = time.time()
+        slots[slot_id] = {'user_id': user_id, 'pid': os.getpid(), 'started': now, 'expires': now + ttl}
+        return slot_id
+
+    try:
+        return update_slots(take)
+    except Rejected as e:
+        REJECTIONS.inc(reason=e.reason)
+        raise
+
+
+# Function that, given a slot id, will give the slot back
+def release(slot_id):
+    update_slots(lambda slots: slots.pop(slot_id, None))
+
+
+# Function that, given a slot id and a number of seconds, will keep the slot for that much longer and return whether it is still held
+# (e.g. with every chunk of a streamed recording, and when the query about the recording takes it over)
+def renew(slot_id, ttl=SLOT_TTL):
+    def extend(slots):
+        if slot_id not in slots:
+            return False
+        slots[slot_id].update(pid=os.getpid(), expires=time.time() + ttl)
+        return True
+    return update_slots(extend)
+
+
+# Function that will return the number of queries in flight in all workers, and how many users they belong to
+def admission_stats():
+    slots = load_slots()
+    return {
+        'in_flight': len(slots),
+        'users': len({slot['user_id'] for slot in slots.values()}),
+        'memory_available': memory_available(),
+    }
+
+
+# Function that, given a request stream and a number of bytes, will read the stream and raise RequestEntityTooLarge (413)
+# as soon as it goes past that many bytes, so an oversized body is never held in memory whole
+def read_limited(stream, limit):
+    data = bytearray()
+    for chunk in iter(lambda: stream.read(READ_SIZE), b''):
+        data += chunk
+        if len(data) > limit:
+            raise RequestEntityTooLarge()
+    return bytes(data)
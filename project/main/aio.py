@@ -0,0 +1,69 @@
+import asyncio
+import functools
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Async mode: the queries of a worker run as coroutines on one event loop thread, so waiting on upstream services ties up no thread
+# and one process can have dozens of queries in flight. CPU-bound work (decoding, image preparation, encoding) is offloaded to a
+# small bounded pool, so it cannot take more of the CPU than the instance has
+
+# Number of threads for CPU-bound work in each worker (a t2.micro has one vCPU)
+CPU_WORKERS = 2
+
+# The event loop and the pool are created the first time they are needed (after gunicorn has forked)
+_loop = None
+_cpu_pool = None
+_lock = threading.Lock()
+
+
+# Function that will return this worker's event loop, running in its own thread
+def get_loop():
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='envisonet-aio', daemon=True).start()
+        return _loop
+
+
+# Function that will return this worker's pool for CPU-bound work
+def get_cpu_pool():
+    global _cpu_pool
+    with _lock:
+        if _cpu_pool is None:
+            _cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix='envisonet-cpu')
+        return _cpu_pool
+
+
+# Function that, given a coroutine, will start it on the event loop and return a future for its result
+# The coroutine runs in a copy of the caller's context, so it keeps the request id and the app context
+def submit(coro):
+    loop = get_loop()
+    context = contextvars.copy_context()
+    future = Future()
+
+    def done(task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start():
+        loop.create_task(coro, context=context).add_done_callback(done)
+
+    loop.call_soon_threadsafe(start)
+    return future
+
+
+# Function that, given a coroutine, will run it on the event loop and wait for its result (for callers that are not async)
+def run(coro):
+    return submit(coro).result()
+
+
+# Function that, given a function and its arguments, will run it in the pool for CPU-bound work and return its result
+async def offload(func, *args, **kwargs):
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(get_cpu_pool(), functools.partial(context.run, func, *args, **kwargs))
@@ -0,0 +1,79 @@
+import shutil
+import subprocess
+import threading
+from speech_recognition import AudioData
+
+# ffmpeg is required for decoding (see the readme), pydub finds it the same way
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+
+# Audio format handed to speech recognition: 16 kHz, mono, 16-bit PCM
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+# Number of bytes fed to ffmpeg at a time
+CHUNK_SIZE = 64 * 1024
+
+# Seconds of an upload that are decoded, so a long (or crafted) recording cannot grow into hundreds of megabytes of PCM (4 MB at most)
+MAX_AUDIO_SECONDS = 120
+
+# Formats TTS responses can be encoded in: the ffmpeg encoder and container, the file extension and the MIME type
+TTS_FORMATS = {
+    'mp3': {'codec': ['-c:a', 'libmp3lame'], 'container': 'mp3', 'extension': 'mp3', 'mimetype': 'audio/mpeg'},
+    'opus': {'codec': ['-c:a', 'libopus', '-application', 'voip'], 'container': 'ogg', 'extension': 'ogg', 'mimetype': 'audio/ogg'},
+}
+
+
+# Function that, given a readable stream of WebM audio, will decode it in memory with a single ffmpeg process and return it as AudioData
+# With "partial", a recording that is still being uploaded (cut off anywhere) is decoded as far as it goes instead of failing
+# With "start", decoding starts that many seconds in (the packets before it are only read), the first second or so of what is
+# returned does not match a decode from the beginning exactly, and where it starts is only accurate to a few milliseconds
+def decode_webm(stream, partial=False, start=0):
+    # ffmpeg reads the WebM from stdin and writes raw PCM to stdout, so nothing touches the disk
+    process = subprocess.Popen(
+        [FFMPEG, '-hide_banner', '-loglevel', 'error']
+        + (['-ss', str(start)] if start else [])
+        + ['-f', 'webm', '-i', 'pipe:0',
+           '-t', str(MAX_AUDIO_SECONDS - start),
+           '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(SAMPLE_RATE),
+           'pipe:1'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+    # Feeds the upload to ffmpeg from another thread while the PCM is read back, so neither pipe can fill up and block
+    def feed():
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    pcm = process.stdout.read()
+    errors = process.stderr.read()
+    writer.join()
+
+    if (process.wait() != 0 or not pcm) and not partial:
+        raise RuntimeError(f"ffmpeg could not decode the audio: {errors.decode(errors='replace').strip()}")
+
+    return AudioData(pcm, SAMPLE_RATE, SAMPLE_WIDTH)
+
+
+# Function that, given audio (compressed, or raw 16-bit mono PCM with its sample rate), a gain in dB, a format and a bitrate,
+# will apply the gain and encode the audio in that format with a single ffmpeg process, in memory
+def encode_audio(audio_content, gain, audio_format, bitrate, pcm_rate=None):
+    audio_format = TTS_FORMATS[audio_format]
+    input_format = ['-f', 's16le', '-ar', str(pcm_rate), '-ac', '1'] if pcm_rate else []
+    result = subprocess.run(
+        [FFMPEG, '-hide_banner', '-loglevel', 'error',
+         *input_format, '-i', 'pipe:0',
+         '-af', f'volume={gain}dB', '-ac', '1', *audio_format['codec'], '-b:a', bitrate,
+         '-f', audio_format['container'], 'pipe:1'],
+        input=audio_content, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+    if result.returncode != 0 or not result.stdout:
+        raise RuntimeError(f"ffmpeg could not encode the audio: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
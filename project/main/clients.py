@@ -0,0 +1,286 @@
+import os
+import re
+import time
+import base64
+import random
+import asyncio
+import threading
+import urllib.request
+from contextlib import contextmanager, asynccontextmanager
+
+import httpx
+import requests
+from openai import OpenAI, AsyncOpenAI
+from gtts import gTTS, gTTSError
+from speech_recognition import Recognizer, RequestError, UnknownValueError
+from speech_recognition.recognizers.google import create_request_builder, OutputParser
+
+from .metrics import upstream_error
+
+# Shared clients for every upstream service, created once per worker process so connections are kept alive between queries
+
+# Where the xAI API is (can be pointed somewhere else, e.g. for load testing)
+xAI_BASE_URL = os.environ.get("xAI_BASE_URL", "https://api.x.ai/v1")
+
+# Where Google speech recognition and Google TTS are (OpenAI uses the SDK's own "OPENAI_BASE_URL" variable)
+GOOGLE_STT_URL = os.environ.get("GOOGLE_STT_URL", "http://www.google.com/speech-api/v2/recognize")
+GTTS_URL = os.environ.get("GTTS_URL")
+
+# Seconds allowed to open a connection to any upstream
+CONNECT_TIMEOUT = 5
+
+# Seconds allowed for the response of each stage
+TIMEOUTS = {
+    'stt': 15,
+    'vision': 30,
+    'semantic': 15,
+    'routing': 30,
+    'tts': 20,
+}
+
+# Number of times a request that failed for a transient reason is tried again
+MAX_RETRIES = 2
+
+# Base delay (in seconds) before a retry, doubled each time and jittered
+RETRY_DELAY = 0.5
+
+# Maximum number of requests each worker has in flight to each upstream
+CONCURRENCY = {
+    'openai': 8,
+    'xai': 8,
+    'google': 8,
+}
+
+_lock = threading.Lock()
+_clients = {}
+_semaphores = {provider: threading.BoundedSemaphore(limit) for provider, limit in CONCURRENCY.items()}
+_async_semaphores = {provider: asyncio.BoundedSemaphore(limit) for provider, limit in CONCURRENCY.items()}
+
+
+# Function that, given limits by provider, will change how many requests this process may have in flight to each upstream
+# Clients built before keep their connection pools, so it is called before the first request (e.g. by "batch.py")
+def set_concurrency(limits):
+    with _lock:
+        CONCURRENCY.update(limits)
+        for provider, limit in limits.items():
+            _semaphores[provider] = threading.BoundedSemaphore(limit)
+            _async_semaphores[provider] = asyncio.BoundedSemaphore(limit)
+
+
+# Function that, given a provider, will hold one of its request slots while the "with" block runs and count any error it raises
+@contextmanager
+def upstream(provider):
+    with _semaphores[provider]:
+        try:
+            yield
+        # Google answering that there was no speech in the audio is not an upstream error
+        except UnknownValueError:
+            raise
+        except Exception:
+            upstream_error(provider)
+            raise
+
+
+# Function that, given a provider name and a function that builds its client, will return the shared client, building it the first time
+def _shared(name, build):
+    with _lock:
+        if name not in _clients:
+            _clients[name] = build()
+        return _clients[name]
+
+
+# Function that, given a stage, will return its httpx timeout
+def stage_timeout(stage):
+    return httpx.Timeout(TIMEOUTS[stage], connect=CONNECT_TIMEOUT)
+
+
+# Function that, given a provider, will return an httpx client with a connection pool sized for it
+def _http_client(provider):
+    limits = httpx.Limits(max_connections=CONCURRENCY[provider], max_keepalive_connections=CONCURRENCY[provider])
+    return httpx.Client(limits=limits, timeout=httpx.Timeout(max(TIMEOUTS.values()), connect=CONNECT_TIMEOUT))
+
+
+# Function that, given a stage, will return the shared OpenAI client with the timeout of that stage
+# The OpenAI SDK retries connection errors, timeouts, 429s and 5xx responses with jittered exponential backoff
+def openai_client(stage):
+    client = _shared('openai', lambda: OpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        http_client=_http_client('openai'),
+        max_retries=MAX_RETRIES,
+    ))
+    return client.with_options(timeout=stage_timeout(stage))
+
+
+# Function that, given a stage, will return the shared xAI client (xAI uses the OpenAI API) with the timeout of that stage
+def xai_client(stage):
+    client = _shared('xai', lambda: OpenAI(
+        api_key=os.environ.get("xAI_API_KEY"),
+        base_url=xAI_BASE_URL,
+        http_client=_http_client('xai'),
+        max_retries=MAX_RETRIES,
+    ))
+    return client.with_options(timeout=stage_timeout(stage))
+
+
+# Function that will return the shared speech recognizer
+def recognizer():
+    def build():
+        r = Recognizer()
+        r.operation_timeout = TIMEOUTS['stt']
+        return r
+    return _shared('recognizer', build)
+
+
+# Function that will return the shared requests session used for Google TTS
+def gtts_session():
+    def build():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=CONCURRENCY['google'])
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    return _shared('gtts', build)
+
+
+# Function that, given a provider, the errors worth retrying and a function with its arguments, will call it, retrying transient errors with jittered backoff
+def call_with_retries(provider, transient_errors, func, *args, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with upstream(provider):
+                return func(*args, **kwargs)
+        except transient_errors as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = RETRY_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+            print(f"Retrying {provider} in {delay:.2f}s after: {e}\n")
+            time.sleep(delay)
+
+
+# Google TTS that sends its requests through the shared session instead of opening a new connection for every part
+class PooledgTTS(gTTS):
+    def stream(self):
+        # Same as gTTS.stream, but with the shared session (gTTS only builds the requests, it has no option for a session)
+        for pr in self._prepare_requests():
+            if GTTS_URL:
+                pr.prepare_url(GTTS_URL, None)
+            try:
+                r = gtts_session().send(request=pr, proxies=urllib.request.getproxies(),
+                                        timeout=(CONNECT_TIMEOUT, TIMEOUTS['tts']))
+                r.raise_for_status()
+            except requests.exceptions.HTTPError:
+                raise gTTSError(tts=self, response=r)
+            except requests.exceptions.RequestException:
+                raise gTTSError(tts=self)
+
+            for line in r.iter_lines(chunk_size=1024):
+                decoded_line = line.decode("utf-8")
+                if "jQ1olc" in decoded_line:
+                    audio_search = re.search(r'jQ1olc","\[\\"(.*)\\"]', decoded_line)
+                    if audio_search:
+                        yield base64.b64decode(audio_search.group(1).encode("ascii"))
+                    else:
+                        raise gTTSError(tts=self, response=r)
+
+
+# Errors from Google speech recognition and Google TTS that are worth retrying
+STT_TRANSIENT_ERRORS = (RequestError,)
+TTS_TRANSIENT_ERRORS = (gTTSError,)
+
+
+# Clients for async mode (see "aio.py"), used from the worker's event loop only
+
+# Builds the FLAC request for Google speech recognition and reads its answer, the same way "recognize_google" does
+STT_REQUESTS = create_request_builder(endpoint=GOOGLE_STT_URL)
+STT_ANSWERS = OutputParser(show_all=False, with_confidence=False)
+
+
+# Function that, given a provider, will hold one of its request slots while the "async with" block runs and count any error it raises
+@asynccontextmanager
+async def async_upstream(provider):
+    async with _async_semaphores[provider]:
+        try:
+            yield
+        # Google answering that there was no speech in the audio is not an upstream error
+        except UnknownValueError:
+            raise
+        except Exception:
+            upstream_error(provider)
+            raise
+
+
+# Function that, given a provider, will return an async httpx client with a connection pool sized for it
+def _async_http_client(provider):
+    limits = httpx.Limits(max_connections=CONCURRENCY[provider], max_keepalive_connections=CONCURRENCY[provider])
+    return httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(max(TIMEOUTS.values()), connect=CONNECT_TIMEOUT))
+
+
+# Functions that, given a stage, will return the shared async OpenAI and xAI clients with the timeout of that stage
+def async_openai_client(stage):
+    client = _shared('async_openai', lambda: AsyncOpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        http_client=_async_http_client('openai'),
+        max_retries=MAX_RETRIES,
+    ))
+    return client.with_options(timeout=stage_timeout(stage))
+
+
+def async_xai_client(stage):
+    client = _shared('async_xai', lambda: AsyncOpenAI(
+        api_key=os.environ.get("xAI_API_KEY"),
+        base_url=xAI_BASE_URL,
+        http_client=_async_http_client('xai'),
+        max_retries=MAX_RETRIES,
+    ))
+    return client.with_options(timeout=stage_timeout(stage))
+
+
+# Function that will return the shared async httpx client for Google speech recognition and Google TTS
+def async_google_client():
+    return _shared('async_google', lambda: _async_http_client('google'))
+
+
+# Function that, given a provider, the errors worth retrying and an async function with its arguments, will await it, retrying transient errors
+async def call_with_retries_async(provider, transient_errors, func, *args, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with async_upstream(provider):
+                return await func(*args, **kwargs)
+        except transient_errors as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = RETRY_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+            print(f"Retrying {provider} in {delay:.2f}s after: {e}\n")
+            await asyncio.sleep(delay)
+
+
+# Function that, given a request built with STT_REQUESTS, will send it to Google speech recognition and return the transcript
+async def recognize_google_async(request):
+    try:
+        response = await async_google_client().post(request.full_url, content=request.data, headers=dict(request.header_items()),
+                                                    timeout=stage_timeout('stt'))
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        raise RequestError(f"recognition request failed: {e.response.reason_phrase}")
+    except httpx.TransportError as e:
+        raise RequestError(f"recognition connection failed: {e}")
+    return STT_ANSWERS.parse(response.text)
+
+
+# Function that, given a gTTS object, will fetch its audio with the shared async client and return the MP3 bytes
+async def gtts_async(tts):
+    audio = b""
+    for pr in tts._prepare_requests():
+        try:
+            response = await async_google_client().request(pr.method, GTTS_URL or pr.url, content=pr.body, headers=dict(pr.headers),
+                                                           timeout=stage_timeout('tts'))
+            response.raise_for_status()
+        except (httpx.HTTPStatusError, httpx.TransportError):
+            raise gTTSError(tts=tts)
+
+        for line in response.text.splitlines():
+            if "jQ1olc" in line:
+                audio_search = re.search(r'jQ1olc","\[\\"(.*)\\"]', line)
+                if not audio_search:
+                    raise gTTSError(tts=tts)
+                audio += base64.b64decode(audio_search.group(1).encode("ascii"))
+    return audio
@@ -0,0 +1,85 @@
+import os
+import time
+import uuid
+import hashlib
+from sqlalchemy.exc import IntegrityError
+
+from .. import db
+from ..auth.models import Conversation
+from .imaging import prepared_path
+from .audio import TTS_FORMATS
+from .storage import scratch_folder, RESPONSES_FOLDER
+
+
+# Function that will return a new id for a response or an uploaded image
+def new_id():
+    return uuid.uuid4().hex
+
+
+# Function that, given audio, will return an id made from its content, so the same response always has the same (cacheable) URL
+def content_id(audio_content):
+    return hashlib.sha256(audio_content).hexdigest()[:32]
+
+
+# Function that, given the user's folder, a response id and the file extension of its format, will return the path of the response audio
+# Every response is saved under its own id (in the scratch folder), so queries from several tabs or devices of the same user do not overwrite each other
+def response_path(UPLOAD_FOLDER, response_id, extension="mp3"):
+    return os.path.join(scratch_folder(UPLOAD_FOLDER), RESPONSES_FOLDER, f"{response_id}.{extension}")
+
+
+# Function that, given the user's folder and a response id, will return the path of the saved response audio in whichever format it has, or None
+def find_response(UPLOAD_FOLDER, response_id):
+    for audio_format in TTS_FORMATS.values():
+        path = response_path(UPLOAD_FOLDER, response_id, audio_format['extension'])
+        if os.path.exists(path):
+            return path
+    return None
+
+
+# Function that, given a user id, will return the user's conversation state or None if there is none yet
+def load_state(user_id):
+    return db.session.get(Conversation, user_id)
+
+
+# Function that, given a user id and the fields to change, will update the user's conversation state
+def remember(user_id, **fields):
+    # Two workers may create the state of the same user at the same time, the second one then updates it instead
+    for attempt in range(2):
+        state = load_state(user_id) or Conversation(user_id=user_id)
+        for name, value in fields.items():
+            setattr(state, name, value)
+        state.updated = time.time()
+        db.session.add(state)
+        try:
+            db.session.commit()
+            return state
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == 1:
+                raise
+
+
+# Function that, given an image path, will remove the image and its prepared version
+def remove_image(image_path):
+    for path in (image_path, prepared_path(image_path)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Function that, given a user id, a new last image and other fields, will update the state and remove the previous last image
+def remember_image(user_id, image_path, **fields):
+    state = load_state(user_id)
+    previous_image = state.last_image if state else None
+    remember(user_id, last_image=image_path, **fields)
+    if previous_image and previous_image != image_path:
+        remove_image(previous_image)
+
+
+# Function that, given a user id, will return the path of the user's last image, or None if there is none
+def last_image(user_id):
+    state = load_state(user_id)
+    if state and state.last_image and os.path.exists(state.last_image):
+        return state.last_image
+    return None
@@ -0,0 +1,102 @@
+import io
+import os
+import json
+import base64
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+
+# Longest side (in pixels) of the image sent to the vision model, larger photos are downscaled
+MAX_IMAGE_SIDE = 1024
+
+# JPEG quality used when re-encoding the image
+JPEG_QUALITY = 85
+
+# Transparent parts of an image (PNGs) are filled with this colour, since JPEG has no transparency
+BACKGROUND_COLOUR = (255, 255, 255)
+
+# Number of prepared images each worker keeps in memory
+PREPARED_CACHE_SIZE = 32
+
+_prepared_cache = OrderedDict()
+_prepared_cache_lock = threading.Lock()
+
+
+# Function that, given an image path, will load, downscale and encode the image and return it ready for a vision request
+def prepare_image(image_path):
+    with Image.open(image_path) as image:
+        # Phone cameras store the rotation in the EXIF data, so the pixels are turned the right way up first
+        image = ImageOps.exif_transpose(image)
+
+        # Shrinks the image so that its longest side is at most MAX_IMAGE_SIDE, keeping the aspect ratio
+        image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+
+        # JPEG has no alpha channel or palette, so everything is converted to RGB
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, BACKGROUND_COLOUR)
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        else:
+            image = image.convert("RGB")
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+
+    return {
+        'mime': 'image/jpeg',
+        'data': base64.b64encode(buffer.getvalue()).decode('utf-8'),
+    }
+
+
+# Function that, given an image path, will return the path where its prepared version is kept
+# (e.g. "<image_id>.png" -> "<image_id>_prepared.json")
+def prepared_path(image_path):
+    return image_path.rsplit('.', 1)[0] + "_prepared.json"
+
+
+# Function that, given an image path, will return what identifies this version of the image and the settings it was prepared with
+def image_stamp(image_path):
+    stat = os.stat(image_path)
+    return [stat.st_mtime_ns, stat.st_size, MAX_IMAGE_SIDE, JPEG_QUALITY]
+
+
+# Function that, given an image path and its prepared version, will keep the prepared version for later queries about the same image
+def save_prepared_image(image_path, prepared_image):
+    stamp = image_stamp(image_path)
+    with _prepared_cache_lock:
+        _prepared_cache[image_path] = (stamp, prepared_image)
+        _prepared_cache.move_to_end(image_path)
+        while len(_prepared_cache) > PREPARED_CACHE_SIZE:
+            _prepared_cache.popitem(last=False)
+
+    # Also saved next to the image so the other gunicorn workers can use it
+    path = prepared_path(image_path)
+    tmp_path = path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({'stamp': stamp, 'prepared_image': prepared_image}, f)
+    os.replace(tmp_path, path)
+
+
+# Function that, given an image path, will return the prepared image, only preparing it if it has not been prepared already
+def load_prepared_image(image_path):
+    stamp = image_stamp(image_path)
+
+    with _prepared_cache_lock:
+        cached = _prepared_cache.get(image_path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    try:
+        with open(prepared_path(image_path)) as f:
+            saved = json.load(f)
+        if saved['stamp'] == stamp:
+            with _prepared_cache_lock:
+                _prepared_cache[image_path] = (stamp, saved['prepared_image'])
+            return saved['prepared_image']
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    prepared_image = prepare_image(image_path)
+    save_prepared_image(image_path, prepared_image)
+    return prepared_image
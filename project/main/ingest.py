@@ -0,0 +1,339 @@
+import os
+import json
+import time
+import zlib
+import fcntl
+import shutil
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+from speech_recognition import AudioData
+
+from .audio import decode_webm, SAMPLE_RATE, SAMPLE_WIDTH, MAX_AUDIO_SECONDS
+from .process import speech_interpreter
+from .conversation import new_id
+from .storage import RECORDINGS_FOLDER
+from . import metrics
+
+# Audio streamed while the user is still speaking: the browser sends a chunk of the recording every second, and speech
+# recognition runs on overlapping segments as soon as they are complete, so only the last few seconds are left when the user stops
+# Chunks of one recording may reach different gunicorn workers, so the recording and its segments are kept in the scratch folder
+
+# Seconds of audio in each segment, and seconds each segment shares with the next one (so a word cut at the edge is heard whole once)
+SEGMENT_SECONDS = 5
+OVERLAP_SECONDS = 1
+
+# Number of words at the start of a segment compared with the end of the previous one when the transcripts are joined
+MAX_OVERLAP_WORDS = 6
+
+# Seconds of audio past the end of a segment that have to be decoded before it is recognized (ffmpeg's last samples can still change)
+DECODER_MARGIN = 0.25
+
+# Every chunk only decodes the audio after what was decoded before (kept as PCM next to the recording), starting this many seconds
+# earlier so the decoder has settled by the time it gets there. The new audio is lined up with the old where they overlap, by looking
+# up to ALIGN_SEARCH samples around where it should be for ALIGN_SAMPLES that match exactly; when they do not, the whole recording is
+# decoded again. This keeps a recording at about one decode of its length instead of one decode of everything so far per chunk
+DECODE_PREROLL = 2
+ALIGN_SAMPLES = SAMPLE_RATE // 2
+ALIGN_SEARCH = SAMPLE_RATE // 10
+
+# Threads that decode recordings and recognize segments in each gunicorn worker
+SEGMENT_WORKERS = 2
+
+# Seconds a finished recording waits for a segment that another request is still recognizing before recognizing it itself
+SEGMENT_WAIT = 10
+
+# Recognizer for the segments: "google" (the same as for uploaded audio) or "local", a stand-in that needs no network, for tests
+STREAMING_RECOGNIZER = os.environ.get("STREAMING_RECOGNIZER", "google")
+
+# The local stand-in "hears" a word in every half second of sound, picked from the audio itself, so the same audio always gives the same words
+LOCAL_WORDS = ["apple", "river", "stone", "cloud", "green", "table", "light", "north",
+               "paper", "glass", "train", "music", "chair", "water", "field", "house"]
+LOCAL_FRAME_SECONDS = 0.5
+LOCAL_SILENCE_RMS = 200
+
+_segment_pool = None
+_segment_pool_lock = threading.Lock()
+
+
+# Function that will return this worker's pool for decoding and recognizing segments, created on first use (after gunicorn has forked)
+def get_segment_pool():
+    global _segment_pool
+    with _segment_pool_lock:
+        if _segment_pool is None:
+            _segment_pool = ThreadPoolExecutor(max_workers=SEGMENT_WORKERS, thread_name_prefix='envisonet-segment')
+        return _segment_pool
+
+
+# Functions that, given a recording id, will return the folder of the recording, its WebM audio and its record
+def recording_folder(recording_id):
+    return os.path.join(RECORDINGS_FOLDER, recording_id)
+
+
+def audio_path(recording_id):
+    return os.path.join(recording_folder(recording_id), "audio.webm")
+
+
+def pcm_path(recording_id):
+    return os.path.join(recording_folder(recording_id), "audio.pcm")
+
+
+def record_path(recording_id):
+    return os.path.join(recording_folder(recording_id), "record.json")
+
+
+def save_record(record):
+    record['updated'] = time.time()
+    tmp_path = record_path(record['id']) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(record, f)
+    os.replace(tmp_path, record_path(record['id']))
+
+
+def load_record(recording_id):
+    # Recording ids are generated with uuid4().hex, anything else cannot be a recording
+    if not recording_id.isalnum():
+        return None
+    try:
+        with open(record_path(recording_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# Context manager that, given a recording id, will lock the recording in every worker and yield its record, saved again afterwards
+@contextmanager
+def locked_record(recording_id):
+    with open(os.path.join(recording_folder(recording_id), ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            record = load_record(recording_id)
+            if record is None:
+                raise FileNotFoundError(f"Recording {recording_id} is gone")
+            yield record
+            save_record(record)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# Function that, given a user id and the recording's admission slot (see "admission.py"), will start a new recording and return its id
+def create_recording(user_id, slot=None):
+    recording_id = new_id()
+    os.makedirs(recording_folder(recording_id))
+    save_record({'id': recording_id, 'user_id': user_id, 'slot': slot, 'created': time.time(), 'next_seq': 0, 'bytes': 0, 'segments': {}})
+    return recording_id
+
+
+# Function that, given a recording id and a user id, will return the record if the recording belongs to the user, otherwise None
+def load_recording(recording_id, user_id):
+    record = load_record(recording_id)
+    if record is None or record['user_id'] != user_id:
+        return None
+    return record
+
+
+# Function that, given a recording id, the number of the chunk and its bytes, will add the chunk to the recording and start recognizing
+# Returns False when the chunk is out of order (a chunk that was already added is ignored)
+def add_chunk(recording_id, seq, data):
+    with locked_record(recording_id) as record:
+        if seq < record['next_seq']:
+            return True
+        if seq > record['next_seq']:
+            return False
+        with open(audio_path(recording_id), "ab") as f:
+            f.write(data)
+        record['next_seq'] += 1
+        record['bytes'] += len(data)
+
+    metrics.count_bytes("webm_chunk", "in", len(data))
+    get_segment_pool().submit(contextvars.copy_context().run, advance, recording_id)
+    return True
+
+
+# Function that, given a number of samples, will return how many whole segments fit in them
+def complete_segments(samples):
+    length, step = SEGMENT_SECONDS * SAMPLE_RATE, (SEGMENT_SECONDS - OVERLAP_SECONDS) * SAMPLE_RATE
+    if samples < length:
+        return 0
+    return (samples - length) // step + 1
+
+
+# Function that, given decoded audio and the first and last sample, will return that part of the audio
+def cut(audio, start, end):
+    return AudioData(audio.frame_data[start * SAMPLE_WIDTH:end * SAMPLE_WIDTH], SAMPLE_RATE, SAMPLE_WIDTH)
+
+
+# Function that, given decoded audio and the number of a segment, will return the audio of the segment
+def segment_audio(audio, index):
+    start = index * (SEGMENT_SECONDS - OVERLAP_SECONDS) * SAMPLE_RATE
+    return cut(audio, start, start + SEGMENT_SECONDS * SAMPLE_RATE)
+
+
+# Function that, given a record and a number of segments, will mark the ones nobody is recognizing yet as started and return them
+def claim_segments(record, count):
+    claimed = [index for index in range(count) if str(index) not in record['segments']]
+    for index in claimed:
+        record['segments'][str(index)] = {'status': 'running', 'started': time.time(), 'transcript': None}
+    return claimed
+
+
+# Function that, given audio, will return its transcript from the streaming recognizer (or None)
+def recognize(audio):
+    with metrics.stage("stt_segment"):
+        if STREAMING_RECOGNIZER == "local":
+            return local_recognize(audio)
+        return speech_interpreter(audio)
+
+
+# Function that, given audio, will return a made-up transcript of it: one word for every half second of sound (None for silence)
+def local_recognize(audio):
+    samples = np.frombuffer(audio.frame_data, dtype=np.int16)
+    frame = int(LOCAL_FRAME_SECONDS * SAMPLE_RATE)
+    words = []
+    for start in range(0, len(samples), frame):
+        piece = samples[start:start + frame]
+        if np.sqrt(np.mean(piece.astype(np.float64) ** 2)) >= LOCAL_SILENCE_RMS:
+            words.append(LOCAL_WORDS[zlib.crc32(piece.tobytes()) % len(LOCAL_WORDS)])
+    return " ".join(words) or None
+
+
+# Function that, given a recording id, a segment number and its audio, will recognize the segment and save the transcript
+def recognize_segment(recording_id, index, audio):
+    transcript = recognize(audio)
+    with locked_record(recording_id) as record:
+        record['segments'][str(index)].update(status='done', transcript=transcript)
+    return transcript
+
+
+# Function that, given the samples decoded before, the samples of a decode that started DECODE_PREROLL seconds before their end
+# and the sample it should start at, will return the old samples followed by the new ones, or None when they cannot be lined up
+def join_decoded(known, new, start):
+    # A window the decoder has settled by, which ends before the old samples do wherever the new decode really started
+    window = DECODE_PREROLL * SAMPLE_RATE - ALIGN_SAMPLES - ALIGN_SEARCH
+    if len(new) < window + ALIGN_SAMPLES:
+        return None
+    for offset in range(-ALIGN_SEARCH, ALIGN_SEARCH + 1):
+        at = start + offset + window
+        if np.array_equal(known[at:at + ALIGN_SAMPLES], new[window:window + ALIGN_SAMPLES]):
+            # Everything after the window has to match as well, up to the end of the old samples
+            overlap = len(known) - (start + offset)
+            if np.array_equal(known[at:], new[window:overlap]):
+                return np.concatenate([known, new[overlap:]])
+    return None
+
+
+# Function that, given a recording id, will decode what has arrived since the last chunk and return the decoded recording so far
+# The last DECODER_MARGIN seconds are left out, so what is kept as PCM does not change any more
+def decode_recording(recording_id):
+    try:
+        known = np.fromfile(pcm_path(recording_id), dtype=np.int16)
+    except FileNotFoundError:
+        known = np.zeros(0, dtype=np.int16)
+
+    start = len(known) - DECODE_PREROLL * SAMPLE_RATE
+    if len(known) >= MAX_AUDIO_SECONDS * SAMPLE_RATE:
+        samples = known
+    else:
+        samples = None
+        if start >= DECODE_PREROLL * SAMPLE_RATE:
+            with open(audio_path(recording_id), "rb") as f:
+                new = decode_webm(f, partial=True, start=start / SAMPLE_RATE)
+            samples = join_decoded(known, np.frombuffer(new.frame_data, dtype=np.int16), start)
+        if samples is None:
+            with open(audio_path(recording_id), "rb") as f:
+                samples = np.frombuffer(decode_webm(f, partial=True).frame_data, dtype=np.int16)
+        samples = samples[:min(len(samples) - int(DECODER_MARGIN * SAMPLE_RATE), MAX_AUDIO_SECONDS * SAMPLE_RATE)]
+
+        # Chunks handled at the same time decode the same audio, the longest result is kept
+        with locked_record(recording_id):
+            saved = os.path.getsize(pcm_path(recording_id)) // SAMPLE_WIDTH if os.path.exists(pcm_path(recording_id)) else 0
+            if len(samples) > saved:
+                tmp_path = pcm_path(recording_id) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+                samples.tofile(tmp_path)
+                os.replace(tmp_path, pcm_path(recording_id))
+
+    return AudioData(samples.tobytes(), SAMPLE_RATE, SAMPLE_WIDTH)
+
+
+# Function that, given a recording id, will decode what has arrived so far and recognize the segments that are now complete
+def advance(recording_id):
+    try:
+        audio = decode_recording(recording_id)
+        samples = len(audio.frame_data) // SAMPLE_WIDTH
+
+        with locked_record(recording_id) as record:
+            claimed = claim_segments(record, complete_segments(samples))
+        for index in claimed:
+            recognize_segment(recording_id, index, segment_audio(audio, index))
+
+    # The recording was sent (and removed) while this chunk was being handled
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error recognizing streamed audio: {e}\n")
+
+
+# Function that, given the transcripts of overlapping segments in order, will join them without repeating the words they share
+def merge_transcripts(transcripts):
+    words = []
+    for transcript in transcripts:
+        new_words = (transcript or "").split()
+        lowered = [word.lower() for word in new_words]
+
+        # The longest run of words that ends the transcript so far and starts the next one is only kept once
+        overlap = 0
+        for size in range(min(len(words), len(new_words), MAX_OVERLAP_WORDS), 0, -1):
+            if [word.lower() for word in words[-size:]] == lowered[:size]:
+                overlap = size
+                break
+        words += new_words[overlap:]
+    return " ".join(words) or None
+
+
+# Class for a recording that was streamed while the user spoke, handed to the pipeline instead of the decoded audio
+class StreamedAudio:
+    def __init__(self, recording_id):
+        self.recording_id = recording_id
+
+    # Function that will decode the whole recording, recognize what is left of it and return the transcript of the recording
+    def transcribe(self):
+        with open(audio_path(self.recording_id), "rb") as f:
+            audio = decode_webm(f)
+        samples = len(audio.frame_data) // SAMPLE_WIDTH
+        count = complete_segments(samples)
+
+        # Segments the chunks did not start (e.g. the last whole one) are recognized now, next to the rest of the audio
+        with locked_record(self.recording_id) as record:
+            claimed = claim_segments(record, count)
+        futures = [get_segment_pool().submit(contextvars.copy_context().run, recognize_segment,
+                                             self.recording_id, index, segment_audio(audio, index))
+                   for index in claimed]
+
+        # The rest of the audio starts where the next segment would, so it overlaps the last segment like the segments do
+        tail_start = count * (SEGMENT_SECONDS - OVERLAP_SECONDS) * SAMPLE_RATE
+        tail = None
+        if samples - tail_start > (OVERLAP_SECONDS * SAMPLE_RATE if count else 0):
+            tail = recognize(cut(audio, tail_start, samples))
+        wait(futures)
+
+        transcripts = self.wait_for_segments(audio, count)
+        shutil.rmtree(recording_folder(self.recording_id), ignore_errors=True)
+        return merge_transcripts(transcripts + [tail])
+
+    # Function that, given the decoded recording and the number of segments, will return their transcripts once every segment is done
+    # A segment that another request is still recognizing after SEGMENT_WAIT seconds is recognized again here
+    def wait_for_segments(self, audio, count):
+        deadline = time.time() + SEGMENT_WAIT
+        while True:
+            segments = load_record(self.recording_id)['segments']
+            pending = [index for index in range(count) if segments[str(index)]['status'] != 'done']
+            if not pending or time.time() > deadline:
+                break
+            time.sleep(0.05)
+
+        transcripts = [segments[str(index)]['transcript'] for index in range(count)]
+        for index in pending:
+            transcripts[index] = recognize(segment_audio(audio, index))
+        return transcripts
@@ -0,0 +1,128 @@
+import re
+import zlib
+import threading
+import numpy as np
+
+# Local intent engine that recognizes the control requests ("logout", "lastImage", "askAbout", "repeat") without calling xAI
+# Anything it is not confident about (open questions) still goes to "xaiprocess_semantic"
+
+# Intents with a similarity below this are left to xAI
+INTENT_CONFIDENCE_THRESHOLD = 0.8
+
+# The best intent has to beat the second best by at least this much
+INTENT_MARGIN = 0.1
+
+# Size of the hashed character n-gram vectors
+FEATURES = 2048
+
+# Commands, only when they are the whole utterance ("read the sign out loud" is a question, not a logout)
+# An intent is only settled locally when its rule matches: the classifier alone also scores open questions that sound like a command
+# ("say that again slower", "tell me what you can see") above the threshold
+RULES = {
+    "logout": re.compile(r"^(i'm done )?(please )?((i want to )?((log|sign) (me )?(out|off)|logout)( of my account)?)( please| now)?$"),
+    "repeat": re.compile(r"^(please )?((can|could) you )?(repeat( that| yourself| it| the last answer)?|say (that|it) again|come again|pardon"
+                         r"|what did you (just )?say|one more time|i didn't (hear|catch) (you|that))( please)?$"),
+    "askAbout": re.compile(r"^(what (can|do) you do|what can i ask you|what are you (able|capable) (to do|of)|how does this (website|app|site) work"
+                           r"|what is this (website|app|site) for)$"),
+    # Questions about the last image are answered by the vision model with the whole transcript, so this one may match within a question
+    "lastImage": re.compile(r"\b(in|from|about|on|at) (the|that|my) (last|previous|same) (image|photo|picture|pic)\b"),
+}
+
+# Example phrases for each intent, "question" holds open questions that should go to xAI
+EXAMPLES = {
+    "logout": [
+        "log out", "log me out", "sign me out", "i want to log out", "sign out of my account",
+        "log off", "i'm done log me out", "please log out",
+    ],
+    "repeat": [
+        "repeat that", "say that again", "can you repeat", "what did you say", "repeat yourself",
+        "one more time", "i didn't hear you", "please repeat the last answer",
+    ],
+    "askAbout": [
+        "what can you do", "what are you capable of", "how does this website work",
+        "what is this app for", "what can i ask you",
+    ],
+    "lastImage": [
+        "in the last image", "in the last picture what color is it", "what else is in the last photo",
+        "tell me more about the previous image", "in that picture is there a person",
+        "looking at the same photo", "about the last image", "what was in the previous picture",
+    ],
+    "question": [
+        "what is the weather like today", "what is the capital of france", "how far away is the moon",
+        "tell me a joke", "what time is it", "who wrote hamlet", "how do i cook rice",
+        "what is two plus two", "how tall is the eiffel tower", "what should i have for dinner",
+    ],
+}
+
+# Counters for this worker
+stats = {'local': 0, 'remote': 0}
+_stats_lock = threading.Lock()
+
+
+# Function that, given a transcript, will return it in lower case without punctuation or extra spaces
+def normalize(transcript):
+    return " ".join(re.sub(r"[^a-z0-9' ]", " ", transcript.lower()).split())
+
+
+# Function that, given normalized text, will return its hashed character trigram and word vector, scaled to unit length
+def vectorize(text):
+    padded = f" {text} "
+    grams = [padded[i:i + 3] for i in range(len(padded) - 2)] + text.split()
+    indices = np.fromiter((zlib.crc32(gram.encode()) % FEATURES for gram in grams), dtype=np.int64, count=len(grams))
+    vector = np.bincount(indices, minlength=FEATURES).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+# Every example is vectorized once, when the module is imported
+_labels = [intent for intent, phrases in EXAMPLES.items() for phrase in phrases]
+_intents = list(EXAMPLES)
+_label_index = np.array([_intents.index(label) for label in _labels])
+_matrix = np.stack([vectorize(normalize(phrase)) for phrases in EXAMPLES.values() for phrase in phrases])
+
+
+# Function that, given a transcript, will return the most likely intent and how confident the match is
+def classify_intent(transcript):
+    text = normalize(transcript)
+    if not text:
+        return None, 0.0
+
+    for intent, rule in RULES.items():
+        if rule.search(text):
+            return intent, 1.0
+
+    # Cosine similarity against every example, then the best example for each intent
+    similarities = _matrix @ vectorize(text)
+    best = np.full(len(_intents), -1.0, dtype=np.float32)
+    np.maximum.at(best, _label_index, similarities)
+
+    order = np.argsort(best)[::-1]
+    intent, confidence = _intents[order[0]], float(best[order[0]])
+    if confidence - float(best[order[1]]) < INTENT_MARGIN:
+        return None, confidence
+    return intent, confidence
+
+
+# Function that, given a transcript, will return the control keyword when it is confidently recognized, or None so xAI is asked
+def local_intent(transcript):
+    intent, confidence = classify_intent(transcript)
+    local = (intent is not None and intent != "question" and confidence >= INTENT_CONFIDENCE_THRESHOLD
+             and RULES[intent].search(normalize(transcript)) is not None)
+
+    with _stats_lock:
+        stats['local' if local else 'remote'] += 1
+
+    if local:
+        print(f"LOCAL INTENT {intent} ({confidence:.2f})\n")
+        return intent
+    return None
+
+
+# Function that will return how many semantic requests were settled locally and how many went to xAI
+def intent_stats():
+    with _stats_lock:
+        return {
+            'remote_calls_avoided': stats['local'],
+            'remote_calls': stats['remote'],
+            'threshold': INTENT_CONFIDENCE_THRESHOLD,
+        }
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import uuid
+import inspect
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from .storage import JOBS_FOLDER
+from .admission import release
+from . import aio
+
+# Job records are kept as small JSON files in JOBS_FOLDER so that every gunicorn worker can answer status requests for any job (the storage sweeper removes old ones)
+
+# The background worker pool is created the first time a job is submitted (after gunicorn has forked)
+_executor = None
+_executor_lock = threading.Lock()
+
+# Jobs of this worker waiting for a thread of the pool
+_queued = 0
+
+
+# Function that, given a number of workers, will return the shared background worker pool
+def get_executor(max_workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='envisonet-job')
+        return _executor
+
+
+# Function that will return the number of jobs of this worker waiting for a thread of the pool
+def queued_jobs():
+    return _queued
+
+
+# Function that, given a job id, will return the path of its record
+def job_path(job_id):
+    return os.path.join(JOBS_FOLDER, f"{job_id}.json")
+
+
+# Function that, given a job record, will write it to disk atomically
+def save_job(job):
+    job['updated'] = time.time()
+    tmp_path = job_path(job['id']) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(job, f)
+    os.replace(tmp_path, job_path(job['id']))
+
+
+# Function that, given a job id, will return its record or None if it does not exist
+def load_job(job_id):
+    # Job ids are generated with uuid4().hex, anything else cannot be a job
+    if not job_id.isalnum():
+        return None
+    try:
+        with open(job_path(job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# Function that, given a job record, will return the function that records the stage the pipeline has reached so clients can show progress
+def job_progress(job):
+    def progress(stage):
+        job['stage'] = stage
+        save_job(job)
+    return progress
+
+
+# Function that, given a job record and the pipeline result, will record that the job is done
+def finish_job(job, result, status_code):
+    job['result'] = result
+    job['status_code'] = status_code
+    job['status'] = 'done'
+    job['stage'] = 'done'
+    save_job(job)
+
+
+# Function that, given a job record and the error it raised, will record that the job failed
+def fail_job(job, e):
+    print(f"Error in job {job['id']}: {e}\n")
+    job['result'] = {'error': 'Error processing the query', 'details': str(e)}
+    job['status_code'] = 500
+    job['status'] = 'error'
+    job['stage'] = 'error'
+    save_job(job)
+
+
+# Function that, given the app, a job record, the work to do and the job's admission slot, will run the job in a background thread
+# and record its progress. The slot is given back once the job is done (see "admission.py")
+def _run_job(app, job, func, args, slot):
+    global _queued
+    with _executor_lock:
+        _queued -= 1
+    progress = job_progress(job)
+
+    with app.app_context():
+        job['status'] = 'running'
+        progress('started')
+        try:
+            result, status_code = func(*args, progress=progress)
+        except Exception as e:
+            fail_job(job, e)
+        else:
+            finish_job(job, result, status_code)
+        finally:
+            if slot is not None:
+                release(slot)
+
+
+# Same as "_run_job", for an async pipeline function: the job runs as a task on the worker's event loop
+async def _run_job_async(app, job, func, args, slot):
+    progress = job_progress(job)
+
+    # The app context lives in the task's own context, so every job has its own database session
+    with app.app_context():
+        job['status'] = 'running'
+        progress('started')
+        try:
+            result, status_code = await func(*args, progress=progress)
+        except Exception as e:
+            fail_job(job, e)
+        else:
+            finish_job(job, result, status_code)
+        finally:
+            if slot is not None:
+                release(slot)
+
+
+# Function that, given the app, the id of the user, and a pipeline function with its arguments, will queue the work and return the new job id
+# The admission slot of the query, if it has one, is kept until the job is done
+def submit_job(app, user_id, func, *args, slot=None):
+    global _queued
+    os.makedirs(JOBS_FOLDER, exist_ok=True)
+
+    job = {
+        'id': uuid.uuid4().hex,
+        'user_id': user_id,
+        'status': 'queued',
+        'stage': 'queued',
+        'result': None,
+        'status_code': None,
+        'created': time.time(),
+    }
+    save_job(job)
+
+    # Async jobs are not limited by JOB_WORKERS, they only hold a thread while they use the CPU (see "aio.py")
+    if inspect.iscoroutinefunction(func):
+        aio.submit(_run_job_async(app, job, func, args, slot))
+        return job['id']
+
+    # The context is copied so the job's log lines carry the id of the request that queued it
+    with _executor_lock:
+        _queued += 1
+    get_executor(app.config['JOB_WORKERS']).submit(contextvars.copy_context().run, _run_job, app, job, func, args, slot)
+    return job['id']
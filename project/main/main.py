@@ -1,11 +1,29 @@
-from flask import Blueprint, render_template, url_for, redirect, request, jsonify, send_from_directory
-from flask_login import login_required, current_user
+from flask import Blueprint, render_template, url_for, redirect, request, jsonify, send_file, current_app, Response, stream_with_context, g
+from flask_login import login_required, current_user, logout_user
 from werkzeug.utils import secure_filename
 import os
-import glob
-from pydub import AudioSegment
-
-from .process import image_interpreter, speech_interpreter, speak, xaiprocess_semantic
+import uuid
+import inspect
+import contextvars
+import functools
+import mimetypes
+
+from .audio import decode_webm
+from .pipeline import run_image_audio_query, run_audio_query, static_audio, RESPONSE_AUDIO, ASYNC_QUERIES
+from .jobs import submit_job, load_job, queued_jobs
+from .process import image_interpreter_stream, xaiprocess_semantic_stream
+from .streaming import load_stream, load_claimed_stream, claim_stream, detect_keyword, speak_stream
+from .tts_cache import tts_cache
+from .intent import intent_stats
+from . import vision_cache
+from . import metrics
+from .conversation import new_id, response_path, find_response, load_state, remember
+from .storage import start_sweeper, storage_stats, SCRATCH_FOLDER
+from .ingest import create_recording, load_recording, add_chunk, StreamedAudio
+from . import aio
+from .providers import circuit_states
+from .admission import admit, release, renew, admission_stats, read_limited, Rejected, MIN_FREE_MEMORY, RECORDING_SLOT_TTL
+from ..auth.user_cache import user_cache
 
 
 
@@ -17,6 +35,23 @@ main = Blueprint('main', __name__)
 ALLOWED_AUDIO_EXTENSIONS = {'webm'}
 ALLOWED_IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png'}
 
+# Addresses "/metrics" is served to when there is no METRICS_TOKEN, and headers that show a request came through a proxy
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+FORWARDED_HEADERS = ('X-Forwarded-For', 'X-Real-IP', 'Forwarded')
+
+# Bytes each chunk of a streamed recording may have (a chunk holds about a second of Opus audio, a few kilobytes)
+MAX_CHUNK_BYTES = 2 ** 20
+
+# What the user is told when a query is turned away by admission control
+REJECTION_MESSAGES = {
+    'user_limit': 'You already have queries in progress',
+    'queue_full': 'The server is busy',
+    'low_memory': 'The server is busy',
+}
+
+# Seconds browsers may keep audio whose URL changes with its content (response audio and versioned prebuilt clips)
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
 # This is a function to check check if a given file has an allowed extension.
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
@@ -24,6 +59,123 @@ def allowed_file(filename, allowed_extensions):
 
 
 
+# Gives every request an id (or keeps the one nginx sent), which is added to the log lines of the queries it runs
+@main.before_app_request
+def assign_request_id():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    metrics.request_id.set(g.request_id)
+
+
+# Descriptions in the vision cache belong to the user who asked, so the logged-in user is kept with the request (and its jobs)
+@main.before_app_request
+def assign_cache_owner():
+    vision_cache.owner.set(current_user.id if current_user.is_authenticated else None)
+
+
+# Starts this worker's storage sweeper with the first request (after gunicorn has forked)
+@main.before_app_request
+def start_storage_sweeper():
+    if current_app.config['STORAGE_SWEEPER']:
+        start_sweeper(current_app._get_current_object())
+
+
+# Sends the request id back so a response can be matched with the logs
+@main.after_app_request
+def add_request_id(response):
+    response.headers['X-Request-ID'] = g.get('request_id', '-')
+    return response
+
+
+# Prebuilt clips are linked with a hash of their content ("static_audio"), so those URLs never change and can be cached for good
+@main.after_app_request
+def cache_static_audio(response):
+    if request.path.startswith('/static/audio/') and request.args.get('v') and response.status_code in (200, 206, 304):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+# Function that, given the uploaded audio file and the route it is for, will decode it and count the bytes going in and out
+def decode_upload(audio_file, route):
+    with metrics.stage("webm_decode", route=route):
+        audio = decode_webm(audio_file.stream)
+    metrics.count_bytes("webm_decode", "in", audio_file.stream.tell())
+    metrics.count_bytes("webm_decode", "out", len(audio.frame_data))
+    return audio
+
+
+# Function that, given the user's folder and a path sent by the client, will return the path if it is a file in that folder, otherwise None
+def user_file(UPLOAD_FOLDER, path):
+    if not path:
+        return None
+    folder = os.path.realpath(UPLOAD_FOLDER)
+    real_path = os.path.realpath(path)
+    if os.path.commonpath([folder, real_path]) != folder or not os.path.isfile(real_path):
+        return None
+    return os.path.join(UPLOAD_FOLDER, os.path.relpath(real_path, folder))
+
+
+# Function that, given a pipeline function, will return the version of it to run: its async version when ASYNC_PIPELINE is on
+def query_function(func):
+    if current_app.config['ASYNC_PIPELINE']:
+        return ASYNC_QUERIES.get(func, func)
+    return func
+
+
+# Function that, given a query turned away by admission control, will build the response with its Retry-After hint
+def rejected_response(e):
+    response = jsonify({'error': REJECTION_MESSAGES[e.reason], 'reason': e.reason, 'retry_after': e.retry_after})
+    response.status_code = e.status
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+# Function that, given a recording id sent by the client, will return the admission slot of the user's recording (kept for as long as
+# a query takes), or None when there is no such recording or its slot has expired
+def recording_slot(recording_id):
+    record = load_recording(recording_id, current_user.id) if recording_id else None
+    if record is None or not record.get('slot') or not renew(record['slot']):
+        return None
+    return record['slot']
+
+
+# Decorator for the routes that run a query: the query has to be admitted (see "admission.py") before its upload is read,
+# and its slot is given back once the request is done, unless the query was queued as a job, which gives it back itself
+def admitted(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # A query about a streamed recording takes over the recording's slot (the frontend puts the recording id in the URL for this)
+        g.admission_slot = recording_slot(request.args.get('recording_id'))
+        if g.admission_slot is None:
+            try:
+                g.admission_slot = admit(current_app, current_user.id)
+            except Rejected as e:
+                print(f"Query turned away ({e.reason})\n")
+                return rejected_response(e)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            if g.admission_slot is not None:
+                release(g.admission_slot)
+    return wrapper
+
+
+# Function that, given a pipeline function and its arguments, will queue it for the current user and return the job id with its status URLs
+def queue_query(func, *args):
+    job_id = submit_job(current_app._get_current_object(), current_user.id, query_function(func), *args, slot=g.admission_slot)
+    # The job holds the slot from now on
+    g.admission_slot = None
+    return jsonify({
+        'message': 'Job queued',
+        'job_id': job_id,
+        'status_url': url_for('main.job_status', job_id=job_id)
+    }), 202
+
+
+
+
 # Default page route, redirects to service route.
 @main.route('/')
 def index():
@@ -51,6 +203,7 @@ def service():
 # Uploading files to server route
 @main.route('/upload_files', methods=['POST'])
 @login_required
+@admitted
 def upload_files():
     # Define the upload folder based on the user who is currently logged in
     username = current_user.id
@@ -59,8 +212,29 @@ def upload_files():
     # *terminal* indicate in the terminal that a post request was recieved and that the program has entered the "upload_files" route.
     print("Received a POST request for /upload_files") 
 
+    # If the audio was streamed while recording, it has already been decoded and mostly transcribed, so only the recording id is posted
+    if 'recording_id' in request.form:
+        if load_recording(request.form['recording_id'], current_user.id) is None:
+            return jsonify({'error': 'Recording not found'}), 404
+        audio = StreamedAudio(request.form['recording_id'])
+
+        if 'image' in request.files:
+            image_file = request.files['image']
+            if not (image_file and allowed_file(image_file.filename, ALLOWED_IMAGE_EXTENSIONS)):
+                return jsonify({'error': 'Invalid image file format'}), 400
+            image_filepath = os.path.join(UPLOAD_FOLDER, f"{new_id()}.{secure_filename(image_file.filename).rsplit('.', 1)[1].lower()}")
+            image_file.save(image_filepath)
+
+            if current_app.config['ASYNC_JOBS']:
+                return queue_query(run_image_audio_query, current_user.id, UPLOAD_FOLDER, audio, image_filepath)
+            return run_query(run_image_audio_query, current_user.id, UPLOAD_FOLDER, audio, image_filepath)
+
+        if current_app.config['ASYNC_JOBS']:
+            return queue_query(run_audio_query, current_user.id, UPLOAD_FOLDER, audio)
+        return run_query(run_audio_query, current_user.id, UPLOAD_FOLDER, audio)
+
     # If an audio file and an image file posted, this handles the modaility.
-    if 'audio' in request.files and 'image' in request.files:
+    elif 'audio' in request.files and 'image' in request.files:
 
         # Pulls audio and image files from the post request
         audio_file = request.files['audio']
@@ -68,40 +242,26 @@ def upload_files():
 
         # Checks to see if the audio file is viable and has an allowed filetype
         if audio_file and allowed_file(audio_file.filename, ALLOWED_AUDIO_EXTENSIONS):
-            # Malicious characters/strings protection for the audio file
-            audio_filename = secure_filename(audio_file.filename)
-            # Temporarily saves WebM audio file in the user's directory using the new file name
-            audio_filepath = os.path.join(UPLOAD_FOLDER, audio_filename)
-            audio_file.save(audio_filepath)
-
-            # Converts the ".webm" audio file to a ".wav" audio file using pydub and requires ffmpeg to be installed to work properly
+            # Decodes the WebM upload straight to 16 kHz mono PCM in memory, this requires ffmpeg to be installed to work properly
             try:
-                webm_audio = AudioSegment.from_file(audio_filepath, format="webm")
-
-                # Gets a filename that ends with ".wav" from the ".webm" filename
-                wav_filename = audio_filename.rsplit('.', 1)[0] + '.wav'
-
-                # Converts the ".webm" audio file to a ".wav" audio
-                wav_filepath = os.path.join(UPLOAD_FOLDER, wav_filename)
-                webm_audio.export(wav_filepath, format="wav")
-
-                # Removes the temporary .webm audio file after conversion to ".wav"
-                os.remove(audio_filepath)
+                audio = decode_upload(audio_file, "process_image_audio_query")
 
                 # Checks to see if the image file is viable and of a proper type
                 if image_file and allowed_file(image_file.filename, ALLOWED_IMAGE_EXTENSIONS):
 
-                    # Malicious characters/strings protection for the image
-                    image_filename = secure_filename(image_file.filename)
+                    # Malicious characters/strings protection for the image, which is saved under a new id so queries from other tabs or devices do not overwrite it
+                    image_filename = f"{new_id()}.{secure_filename(image_file.filename).rsplit('.', 1)[1].lower()}"
 
                     # Saves the image file file in the user's directory using the new file name
                     image_filepath = os.path.join(UPLOAD_FOLDER, image_filename)
                     image_file.save(image_filepath)
 
-                    # Redirect to "/process_audio" with these files now saved
-                    return redirect(url_for('main.process_image_audio_query', 
-                                            audio_filepath=wav_filepath,
-                                            image_filepath=image_filepath))
+                    # Queues the query in the background worker pool and returns the job id straight away
+                    if current_app.config['ASYNC_JOBS']:
+                        return queue_query(run_image_audio_query, current_user.id, UPLOAD_FOLDER, audio, image_filepath)
+
+                    # Otherwise the query is processed within this request, handing the decoded audio straight to the pipeline
+                    return run_query(run_image_audio_query, current_user.id, UPLOAD_FOLDER, audio, image_filepath)
                 # *error* returns a console messege and a 400 error if the image file is not viable.
                 else:
                     return jsonify({'error': 'Invalid image file format'}), 400
@@ -119,19 +279,14 @@ def upload_files():
         audio_file = request.files['audio']
 
         if audio_file and allowed_file(audio_file.filename, ALLOWED_AUDIO_EXTENSIONS):
-            audio_filename = secure_filename(audio_file.filename)
-            audio_filepath = os.path.join(UPLOAD_FOLDER, audio_filename)
-            audio_file.save(audio_filepath)
-
             try:
-                webm_audio = AudioSegment.from_file(audio_filepath, format="webm")
-                wav_filename = audio_filename.rsplit('.', 1)[0] + '.wav'
-                wav_filepath = os.path.join(UPLOAD_FOLDER, wav_filename)
-                webm_audio.export(wav_filepath, format="wav")
+                audio = decode_upload(audio_file, "process_audio_query")
 
-                os.remove(audio_filepath)
+                if current_app.config['ASYNC_JOBS']:
+                    return queue_query(run_audio_query, current_user.id, UPLOAD_FOLDER, audio)
 
-                return redirect(url_for('main.process_audio_query', audio_filepath=wav_filepath,))
+                # Otherwise the query is processed within this request, handing the decoded audio straight to the pipeline
+                return run_query(run_audio_query, current_user.id, UPLOAD_FOLDER, audio)
             
             except Exception as e:
                 return jsonify({'error': 'Error converting WebM to WAV', 'details': str(e)}), 500
@@ -145,132 +300,272 @@ def upload_files():
         return jsonify({'error': 'No audio or image file part'}), 400
     
 
+# Route that starts a recording, whose audio is then sent in chunks while the user is still speaking
+@main.route('/recording', methods=['POST'])
+@login_required
+def start_recording():
+    # Its segments are recognized while the user speaks, so a recording counts as a query in flight from the start
+    try:
+        slot = admit(current_app, current_user.id, ttl=RECORDING_SLOT_TTL)
+    except Rejected as e:
+        print(f"Recording turned away ({e.reason})\n")
+        return rejected_response(e)
+    recording_id = create_recording(current_user.id, slot)
+    return jsonify({
+        'recording_id': recording_id,
+        'chunk_url': url_for('main.recording_chunk', recording_id=recording_id)
+    }), 201
+
+
+# Route that adds the next chunk of a recording (numbered from 0 with "seq"), speech recognition then starts on what has arrived
+@main.route('/recording/<recording_id>/chunk', methods=['POST'])
+@login_required
+def recording_chunk(recording_id):
+    record = load_recording(recording_id, current_user.id)
+    if record is None:
+        return jsonify({'error': 'Recording not found'}), 404
+
+    # Every chunk keeps the recording's slot, a recording that stops getting chunks gives it up after RECORDING_SLOT_TTL seconds
+    if record.get('slot'):
+        renew(record['slot'], RECORDING_SLOT_TTL)
+
+    seq = request.args.get('seq', type=int)
+    if seq is None:
+        return jsonify({'error': 'Chunk number is missing'}), 400
+
+    # Oversized chunks are turned away from their Content-Length, or as soon as they go past the limit while being read
+    if request.content_length is not None and request.content_length > MAX_CHUNK_BYTES:
+        return jsonify({'error': 'Chunk too large', 'max_bytes': MAX_CHUNK_BYTES}), 413
+    data = read_limited(request.stream, MAX_CHUNK_BYTES)
+
+    # Chunks have to arrive in order, the frontend sends them one after the other
+    try:
+        if not add_chunk(recording_id, seq, data):
+            return jsonify({'error': 'Chunk out of order'}), 409
+    # The recording was sent (and removed) in the meantime
+    except FileNotFoundError:
+        return jsonify({'error': 'Recording not found'}), 404
+    return jsonify({'message': 'Chunk received'}), 200
+
+
+# Function that, given a pipeline result, will fill in the URLs the frontend needs
+def resolve_urls(result):
+    # Logging out has to happen through the auth blueprint, so the frontend is sent there with "redirect_url"
+    if result.get('message') == 'logout':
+        return dict(result, redirect_url=url_for("auth.logout"))
+
+    # Streamed responses are played from their own URL
+    if result.get('stream_id'):
+        return dict(result, audio_url=url_for('main.stream_response_audio', stream_id=result['stream_id']))
+
+    # Swaps the placeholder for the URL of the generated response audio
+    if result.get('audio_url') == RESPONSE_AUDIO:
+        return dict(result, audio_url=url_for('main.response_audio', response_id=result['response_id']))
+    return result
+
+
+# Function that, given a pipeline function and its arguments, will run it within this request and build the response
+def run_query(func, *args):
+    func = query_function(func)
+
+    # Errors are reported the same way as for background jobs (and not as errors decoding the upload)
+    try:
+        # An async query runs on the worker's event loop while this request waits for it
+        if inspect.iscoroutinefunction(func):
+            result, status_code = aio.run(func(*args))
+        else:
+            # In a copy of the context, like a job, so the query's timer does not outlive it in this thread when it fails
+            result, status_code = contextvars.copy_context().run(func, *args)
+    except Exception as e:
+        print(f"Error processing the query: {e}\n")
+        return jsonify({'error': 'Error processing the query', 'details': str(e)}), 500
+
+    # The frontend follows "redirect_url" (e.g. to log out) the same way it does for jobs
+    return jsonify(resolve_urls(result)), status_code
+
+
 # Route that processes the user query with an image and audio when called and ulitmately returns a spoken audio response
+# Kept for clients that still follow the old redirect from "/upload_files", which now processes queries itself
 @main.route('/process_image_audio_query')
 @login_required
+@admitted
 def process_image_audio_query():
     # Defines the upload folder based on the user who is currently logged in
     username = current_user.id
     UPLOAD_FOLDER = f'FILES/files_for_{username}'
 
-    # Gets the image and audio filepaths with arguments from the upload_files
-    audio_filepath = request.args.get('audio_filepath')
-    image_filepath = request.args.get('image_filepath')
-    
     # Returns a 500 error if audio file or image file are not recieved
-    if not audio_filepath or not image_filepath:
-        os.remove(image_filepath)
+    if not request.args.get('audio_filepath') or not request.args.get('image_filepath'):
         return jsonify({'error': 'Audio or image file path is missing'}), 500
-    
-    # Generates a transcript of the given audio file
-    transcript = speech_interpreter(audio_filepath)
-    
-    # Returns url for the speechRecognition error audio file if no transcript could be obtained
-    if not transcript:
-        os.remove(image_filepath)
-        return jsonify({
-            'message': 'askAbout',
-            'audio_url': "/static/audio/speechRecognitionError_response.mp3"
-        }), 200
-    
-    # Generates a description of the given image using image_interpreter
-    description = image_interpreter(image_filepath, transcript)
-
-    # Removes the previous last image
-    if(glob.glob(UPLOAD_FOLDER+"/lastimage.*")):
-        os.remove(glob.glob(UPLOAD_FOLDER+"/lastimage.*")[0])
 
-    # The image interpretation has been completed, so the image can now be renamed to last image for future use
-    image_extention = image_filepath.rsplit('.', 1)[1]
-    os.rename(image_filepath, f"{UPLOAD_FOLDER}/lastimage.{image_extention}")
-
-    # Return a 500 error if image interpretation does not return
-    if not description:
-        return jsonify({'error': 'Could not interpret the image'}), 500
+    # The paths come from the query string, so only files in the user's own folder are accepted
+    audio_filepath = user_file(UPLOAD_FOLDER, request.args.get('audio_filepath'))
+    image_filepath = user_file(UPLOAD_FOLDER, request.args.get('image_filepath'))
+    if not audio_filepath or not image_filepath:
+        return jsonify({'error': 'Invalid audio or image file path'}), 400
 
-    # Generates TTS from "description" and saves it to the user's folder.
-    speak(description, UPLOAD_FOLDER)
-
-    # Returns a console message and the URL for the response audio file to be played in the frontend
-    return jsonify({
-        'message': 'Processing completed successfully',
-        'audio_url': url_for('main.download_response_audio')
-    }), 200
+    # Runs the query and returns the URL for the response audio file to be played in the frontend
+    return run_query(run_image_audio_query, current_user.id, UPLOAD_FOLDER, audio_filepath, image_filepath)
 
 
 # Route that processes audio only queries
+# Kept for clients that still follow the old redirect from "/upload_files", which now processes queries itself
 @main.route('/process_audio_query')
 @login_required
+@admitted
 def process_audio_query():
     # Defines the upload folder based on the user who is currently logged in
     username = current_user.id
     UPLOAD_FOLDER = f'FILES/files_for_{username}'
 
-    # Gets the audio filepath with arguments from the upload_files
-    audio_filepath = request.args.get('audio_filepath')
-    
-    # Gets lastImage filepath if it exists, assigns None otherwise
-    if(glob.glob(UPLOAD_FOLDER+"/lastimage.*")):
-        lastImage_filepath = glob.glob(UPLOAD_FOLDER+"/lastimage.*")[0]
-    else:
-        lastImage_filepath = None
-
     # Returns a 500 error if audio file or image file are not recieved
-    if not audio_filepath:
+    if not request.args.get('audio_filepath'):
         return jsonify({'error': 'Audio path is missing'}), 500
-    
-    # Generates a transcript of the given audio file
-    transcript = speech_interpreter(audio_filepath)
-
-    # Returns url for the speechRecognition error audio file if no transcript could be obtained
-    if not transcript:
-        return jsonify({
-            'message': 'Speech Recognition Error',
-            'audio_url': "/static/audio/speechRecognitionError_response.mp3"
-        }), 200
-    
-    
-    # With getting the semantic of the transcript, we are able to use xAI to respond with keywords which can trigger certian responses
-    semantic = xaiprocess_semantic(transcript)
 
-    if(semantic == "logout"):
-        return(redirect(url_for("auth.logout")))
-    
-    elif(semantic == "askAbout"):
-        return jsonify({
-            'message': 'askAbout',
-            'audio_url': "/static/audio/askabout_response.mp3"
-        }), 200
-    
-    elif(semantic == "lastImage"):
-        if(lastImage_filepath != None):
-            description = image_interpreter(lastImage_filepath, transcript)
-            speak(description, UPLOAD_FOLDER)
-            return jsonify({
-                'message': 'Processing completed successfully',
-                'audio_url': url_for('main.download_response_audio')
-            }), 200
-        else:
-            return jsonify({
-                'message': 'Image History Error',
-                'audio_url': "/static/audio/imageHistoryError_response.mp3"
-            }), 200
-        
-    elif(semantic == "repeat"):
-        return jsonify({
-                'message': 'Processing completed successfully',
-                'audio_url': url_for('main.download_response_audio')
-            }), 200
-    
+    # The path comes from the query string, so only files in the user's own folder are accepted
+    audio_filepath = user_file(UPLOAD_FOLDER, request.args.get('audio_filepath'))
+    if not audio_filepath:
+        return jsonify({'error': 'Invalid audio file path'}), 400
+
+    # Runs the query and returns the URL for the response audio file to be played in the frontend
+    return run_query(run_audio_query, current_user.id, UPLOAD_FOLDER, audio_filepath)
+
+
+# Function that, given a job record, will build the status sent to the frontend
+def job_status_payload(job):
+    payload = {'job_id': job['id'], 'status': job['status'], 'stage': job['stage']}
+
+    if job['status'] in ('done', 'error'):
+        payload['result'] = resolve_urls(job['result'])
+        payload['status_code'] = job['status_code']
+    return payload
+
+
+# Route that returns the progress and, once finished, the result of a queued job
+@main.route('/job_status/<job_id>')
+@login_required
+def job_status(job_id):
+    job = load_job(job_id)
+
+    # Users can only see their own jobs
+    if job is None or job['user_id'] != current_user.id:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_status_payload(job)), 200
+
+
+# Function that, given the user's folder and the id of a stream that was already claimed, will redirect to its saved response
+# (a 404 while it is still being generated, or when the stream ended with a control response that is not saved)
+def replay_stream(UPLOAD_FOLDER, stream_id):
+    claimed = load_claimed_stream(stream_id)
+    if claimed is None or claimed['folder'] != UPLOAD_FOLDER or not os.path.exists(response_path(UPLOAD_FOLDER, claimed['response_id'])):
+        return jsonify({'error': 'File not found'}), 404
+    return redirect(url_for('main.response_audio', response_id=claimed['response_id']))
+
+
+# Route that streams a response as MP3 audio, sentence by sentence, while it is being generated
+@main.route('/stream_response_audio/<stream_id>')
+@login_required
+def stream_response_audio(stream_id):
+    # Define the upload folder based on the user who is currently logged in
+    username = current_user.id
+    UPLOAD_FOLDER = f'FILES/files_for_{username}'
+
+    # Users can only play their own responses
+    record = load_stream(stream_id)
+    if record is None:
+        return replay_stream(UPLOAD_FOLDER, stream_id)
+    if record['folder'] != UPLOAD_FOLDER:
+        return jsonify({'error': 'File not found'}), 404
+
+    # The streamed response is saved under its own id (always as MP3, see "speak_stream"), and becomes the user's last response once it is complete
+    # The response is only generated by the request that claims the stream, any other request for it is sent to the saved response
+    response_id = new_id()
+    if not claim_stream(record, response_id):
+        return replay_stream(UPLOAD_FOLDER, stream_id)
+    tts_audio_path = response_path(UPLOAD_FOLDER, response_id)
+    os.makedirs(os.path.dirname(tts_audio_path), exist_ok=True)
+    user_id = current_user.id
+
+    if record['kind'] == "image":
+        pieces = image_interpreter_stream(record['image_path'], record['transcript'], record['prepared_image'])
+
+    else:
+        # Reads just enough of the semantic response to tell a keyword from an answer
+        keyword, pieces = detect_keyword(xaiprocess_semantic_stream(record['transcript']))
+
+        if(keyword == "logout"):
+            logout_user()
+            pieces = ["You have been logged out."]
+
+        elif(keyword == "askAbout"):
+            return redirect(static_audio("askabout_response.mp3"))
+
+        elif(keyword == "lastImage"):
+            if(record['image_path'] != None and os.path.exists(record['image_path'])):
+                pieces = image_interpreter_stream(record['image_path'], record['transcript'])
+            else:
+                return redirect(static_audio("imageHistoryError_response.mp3"))
+
+        elif(keyword == "repeat"):
+            return download_response_audio()
+
+    # Once the whole response is saved it becomes the user's last response
+    saved = lambda: remember(user_id, last_response_id=response_id)
+    return Response(stream_with_context(speak_stream(pieces, tts_audio_path, saved)), mimetype='audio/mpeg',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Function that, given the path of a response audio file and whether its URL always points at the same audio, will send it with caching headers
+def send_audio(path, immutable):
+    # With nginx, the worker only checks access and nginx sends the file (with Range requests) from the internal location
+    prefix = current_app.config['X_ACCEL_RESPONSES']
+    if prefix:
+        response = Response(mimetype=mimetypes.guess_type(path)[0])
+        response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{os.path.relpath(path, SCRATCH_FOLDER)}"
+
+    # Otherwise werkzeug answers If-None-Match with 304 and Range with 206, so playback can start before the whole file is sent
+    # The file name is the response id, a hash of the audio, which makes it a strong ETag
+    else:
+        response = send_file(os.path.abspath(path), as_attachment=True, conditional=True,
+                             etag=os.path.splitext(os.path.basename(path))[0], max_age=IMMUTABLE_MAX_AGE if immutable else 0)
+        response.accept_ranges = "bytes"
+
+    # Responses belong to one user, so only the browser may keep them
+    response.cache_control.public = None
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
     else:
-        speak(semantic, UPLOAD_FOLDER)
-        return jsonify({
-            'message': 'Processing completed successfully',
-            'audio_url': url_for('main.download_response_audio')
-        }), 200
+        response.cache_control.no_cache = True
+    return response
+
+
+# Function that, given the user's folder, a response id and whether the URL always points at this response, will return the response audio
+def send_response_audio(UPLOAD_FOLDER, response_id, immutable=True):
+    # Response ids are generated with uuid4().hex or from the audio's hash, anything else cannot be a response
+    path = find_response(UPLOAD_FOLDER, response_id) if response_id and response_id.isalnum() else None
+    if path:
+        return send_audio(path, immutable)
+
+    # If file does not exist, 404 error is returned
+    return jsonify({'error': 'File not found'}), 404
 
 
-# Route that gets and returns the responseTTS.mp3 file
+# Route that gets and returns the audio of one response
+@main.route('/response_audio/<response_id>')
+@login_required
+def response_audio(response_id):
+    # Define the upload folder based on the user who is currently logged in
+    username = current_user.id
+    UPLOAD_FOLDER = f'FILES/files_for_{username}'
+
+    # Users can only get responses from their own folder
+    return send_response_audio(UPLOAD_FOLDER, response_id)
+
+
+# Route that gets and returns the user's last response (kept for older clients)
 @main.route('/download_response_audio')
 @login_required
 def download_response_audio():
@@ -278,16 +573,75 @@ def download_response_audio():
     username = current_user.id
     UPLOAD_FOLDER = f'FILES/files_for_{username}'
 
-    # Gets the filepath for "responseTTS.mp3"
-    file_path = os.path.join(UPLOAD_FOLDER, "responseTTS.mp3")
+    # The last response changes with every query, so browsers have to check it again (a 304 when it has not changed)
+    state = load_state(username)
+    return send_response_audio(UPLOAD_FOLDER, state.last_response_id if state else None, immutable=False)
+
+
+# Route that returns the metrics of this worker in the Prometheus text format
+@main.route('/metrics')
+def metrics_endpoint():
+    # When a token is configured, scrapers have to send it as a bearer token
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    # Without one, only a scraper on this machine talking to the worker directly may read it (nginx also connects from localhost,
+    # but adds forwarding headers), since it shows how many users have queries in flight and how much memory is left
+    if not token and (request.remote_addr not in LOCAL_ADDRESSES or any(header in request.headers for header in FORWARDED_HEADERS)):
+        return jsonify({'error': 'Forbidden'}), 403
+
+    tts = tts_cache.stats()
+    vision = vision_cache.stats()
+    intent = intent_stats()
+    users = user_cache.stats()
+    admission = admission_stats()
+    lines = metrics.render()
+    lines += metrics.gauge('envisonet_tts_cache_hits', "TTS cache hits in this worker.", tts['hits'])
+    lines += metrics.gauge('envisonet_tts_cache_misses', "TTS cache misses in this worker.", tts['misses'])
+    lines += metrics.gauge('envisonet_tts_cache_bytes', "Size of the TTS cache.", tts['bytes'])
+    lines += metrics.gauge('envisonet_vision_cache_hits', "Vision cache hits (all workers).", vision['hits'])
+    lines += metrics.gauge('envisonet_vision_cache_misses', "Vision cache misses (all workers).", vision['misses'])
+    lines += metrics.gauge('envisonet_vision_cache_entries', "Descriptions in the vision cache.", vision['entries'])
+    lines += metrics.gauge('envisonet_remote_intent_calls_avoided', "Semantic requests settled by the local intent engine.", intent['remote_calls_avoided'])
+    lines += metrics.gauge('envisonet_user_cache_hits', "Logged-in requests whose user came from this worker's user cache.", users['hits'])
+    lines += metrics.gauge('envisonet_user_cache_misses', "Logged-in requests whose user was read from the database.", users['misses'])
+    lines += metrics.gauge('envisonet_queries_in_flight', "Queries running or queued in all workers (admission control).", admission['in_flight'])
+    lines += metrics.gauge('envisonet_users_in_flight', "Users with queries running or queued in all workers.", admission['users'])
+    lines += metrics.gauge('envisonet_jobs_queued', "Jobs of this worker waiting for a job thread.", queued_jobs())
+    if admission['memory_available'] is not None:
+        lines += metrics.gauge('envisonet_memory_available_bytes', "Memory the instance can still give to new work (MemAvailable).", admission['memory_available'])
+        lines += metrics.gauge('envisonet_memory_headroom_bytes', "Memory available above the minimum a query is admitted with.",
+                               admission['memory_available'] - MIN_FREE_MEMORY)
+    lines += metrics.series('envisonet_circuit_open', "State of each provider's circuit in this worker (0 closed, 0.5 half open, 1 open).", 'provider', circuit_states())
+
+    # Disk use and evictions as of the last storage sweep (shared by every worker)
+    storage = storage_stats()
+    if storage is not None:
+        lines += metrics.series('envisonet_storage_bytes', "Bytes used on disk by each area (last sweep).", 'area', storage['bytes'])
+        lines += metrics.gauge('envisonet_storage_free_bytes', "Free bytes on the disk with FILES (last sweep).", storage['free_bytes'])
+        lines += metrics.gauge('envisonet_scratch_free_bytes', "Free bytes in the scratch folder (last sweep).", storage['scratch_free_bytes'])
+        lines += metrics.series('envisonet_storage_evictions_total', "Files removed by the storage sweeper.", 'reason', storage['evictions_total'], kind="counter")
+        lines += metrics.gauge('envisonet_storage_evicted_bytes', "Bytes removed by the storage sweeper.", storage['evicted_bytes_total'])
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+
+# Route that returns the hit rates of the caches, so they can be tuned
+@main.route('/cache_stats')
+@login_required
+def cache_stats():
+    return jsonify({
+        'tts': tts_cache.stats(),
+        'vision': vision_cache.stats(),
+        'intent': intent_stats(),
+        'users': user_cache.stats(),
+    }), 200
 
-    # If file exists, it is returned
-    if os.path.exists(file_path):
-        return send_from_directory(f"../{UPLOAD_FOLDER}", "responseTTS.mp3", as_attachment=True)
-    
-    # If file does not exist, 404 error is returned
-    else:
-        return jsonify({'error': 'File not found'}), 404
+
+# Uploads larger than MAX_CONTENT_LENGTH (or chunks larger than MAX_CHUNK_BYTES) get a JSON error instead of werkzeug's page
+@main.app_errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': 'Upload too large'}), 413
 
 
 # If a page that does not exist is requested, the user is sent back to "/"
@@ -0,0 +1,135 @@
+import os
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Lightweight in-process metrics, exposed in the Prometheus text format on "/metrics"
+# Every gunicorn worker keeps its own numbers, each series is labelled with the worker's pid
+
+# The StageTimer of the query being processed, so nested stages (e.g. inside "speak") are recorded with it
+current_timer = contextvars.ContextVar('current_timer', default=None)
+
+# The id of the request being processed, used to tie log lines together
+request_id = contextvars.ContextVar('request_id', default='-')
+
+# Upper bounds (in seconds) of the duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+# Function that, given label names and values, will return them in the Prometheus format
+def format_labels(names, values):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)] + [f'pid="{os.getpid()}"']
+    return "{" + ",".join(pairs) + "}"
+
+
+# Class for a counter that only goes up, with one value per combination of labels
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+
+# Class for a histogram of durations, with one set of buckets per combination of labels
+class Histogram:
+    def __init__(self, name, help_text, labels, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            # Per bucket counts (the last one is "+Inf"), the sum and the count
+            series = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(list(self.buckets) + ["+Inf"], counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.labels + ("le",), key + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total:.6f}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram('envisonet_stage_duration_seconds', "Time spent in each stage of a query.", ('stage', 'route', 'intent'))
+QUERY_SECONDS = Histogram('envisonet_query_duration_seconds', "Time taken by a whole query.", ('route', 'intent'))
+STAGE_BYTES = Counter('envisonet_stage_bytes_total', "Bytes going into and out of each stage.", ('stage', 'direction'))
+UPSTREAM_ERRORS = Counter('envisonet_upstream_errors_total', "Failed requests to upstream services.", ('provider',))
+
+
+# Function that, given a stage name and a route (used when no query is being timed), will time the "with" block as a stage
+@contextmanager
+def stage(name, route='-'):
+    timer = current_timer.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.record(name, start, time.perf_counter(), (), nested=True)
+        else:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage=name, route=route, intent='-')
+
+
+# Function that, given a stage, a direction ("in" or "out") and a number of bytes, will count the bytes
+def count_bytes(stage_name, direction, amount):
+    STAGE_BYTES.inc(amount, stage=stage_name, direction=direction)
+
+
+# Function that, given a provider, will count a failed request to it
+def upstream_error(provider):
+    UPSTREAM_ERRORS.inc(provider=provider)
+
+
+# Function that, given a metric name, its help text and value, will return it as Prometheus gauge lines
+def gauge(name, help_text, value):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name}{format_labels((), ())} {value}"]
+
+
+# Function that, given a metric name, its help text, a label and the value for each label value, will return them as Prometheus lines
+def series(name, help_text, label, values, kind="gauge"):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for key, value in sorted(values.items()):
+        lines.append(f"{name}{format_labels((label,), (key,))} {value}")
+    return lines
+
+
+# Function that will return every metric in the Prometheus text format
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return lines
@@ -0,0 +1,397 @@
+import os
+import asyncio
+import hashlib
+import functools
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from flask import current_app
+
+from .process import (image_interpreter, speech_interpreter, speak, xaiprocess_semantic, route_query, SEMANTIC_KEYWORDS,
+                      image_interpreter_async, speech_interpreter_async, speak_async, xaiprocess_semantic_async, route_query_async)
+from .aio import offload
+from .imaging import prepare_image, save_prepared_image
+from .timing import StageTimer
+from .streaming import create_stream
+from .intent import local_intent
+from .conversation import load_state, remember, remember_image, last_image
+from .ingest import StreamedAudio
+
+# Placeholder used in results for the generated response audio (its id is in "response_id"), the routes swap it for the real URL
+RESPONSE_AUDIO = "response"
+
+# Folder of the prebuilt response clips (served as static files)
+STATIC_AUDIO_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static', 'audio')
+
+# Toggle to run independent stages of a query at the same time (True) or one after the other (False)
+concurrent_pipeline = True
+
+# Number of stages that can run in the background at the same time, shared by every query in the worker
+STAGE_WORKERS = 4
+
+# The stage pool is created the first time it is needed (after gunicorn has forked)
+_stage_pool = None
+_stage_pool_lock = threading.Lock()
+
+
+# Function that will return the shared pool that runs background stages
+def get_stage_pool():
+    global _stage_pool
+    with _stage_pool_lock:
+        if _stage_pool is None:
+            _stage_pool = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix='envisonet-stage')
+        return _stage_pool
+
+
+# Function that, given the file name of a prebuilt clip, will return its URL with a hash of its content, so browsers can cache it for good
+@functools.lru_cache(maxsize=None)
+def static_audio(filename):
+    with open(os.path.join(STATIC_AUDIO_FOLDER, filename), "rb") as f:
+        version = hashlib.sha256(f.read()).hexdigest()[:12]
+    return f"/static/audio/{filename}?v={version}"
+
+
+# Function that does nothing, used when no progress callback is given
+def no_progress(stage):
+    pass
+
+
+# Function that, given a response id, will return the result that points the frontend to the response audio
+def spoken_result(response_id):
+    if response_id is None:
+        return {'error': 'Could not generate the response audio'}, 500
+    return {
+        'message': 'Processing completed successfully',
+        'audio_url': RESPONSE_AUDIO,
+        'response_id': response_id
+    }, 200
+
+
+# Function that, given a stream id, will return the result that points the frontend to the streamed response
+def streamed_result(stream_id):
+    return {
+        'message': 'Streaming response',
+        'audio_url': RESPONSE_AUDIO,
+        'stream_id': stream_id
+    }, 200
+
+
+# Function that, given a timer, a stage name, the stages it depends on, and a function with its arguments, will start the stage and return its future
+# In concurrent mode the stage runs in the stage pool, otherwise it runs straight away
+def start_stage(timer, stage, after, func, *args):
+    if concurrent_pipeline:
+        # The context is copied so the stage is recorded with this query's timer and request id
+        return get_stage_pool().submit(contextvars.copy_context().run, timer.run, stage, after, func, *args)
+
+    future = Future()
+    try:
+        future.set_result(timer.run(stage, after, func, *args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+# Function that, given the audio of a query, will return its transcript
+# Audio streamed while the user spoke (see "ingest.py") has mostly been recognized already, only the rest of it is left
+def transcribe(audio):
+    if isinstance(audio, StreamedAudio):
+        return audio.transcribe()
+    return speech_interpreter(audio)
+
+
+# Function that, given the user's id and folder, the audio (a ".wav" path, decoded AudioData or StreamedAudio) and an image file, will run the image and audio query and return the result for the frontend
+def run_image_audio_query(user_id, UPLOAD_FOLDER, audio, image_filepath, progress=no_progress):
+    timer = StageTimer("process_image_audio_query")
+    timer.intent = "describe"
+
+    # Loads, downscales and encodes the image while the speech recognition request is in flight
+    image_future = start_stage(timer, "image_prep", (), prepare_image, image_filepath)
+
+    # Generates a transcript of the given audio
+    progress("transcribing")
+    transcript = timer.run("stt", (), transcribe, audio)
+
+    # Returns url for the speechRecognition error audio file if no transcript could be obtained
+    if not transcript:
+        timer.intent = "no_transcript"
+        # The image has to be closed before it can be removed
+        wait([image_future])
+        os.remove(image_filepath)
+        timer.report()
+        return {
+            'message': 'askAbout',
+            'audio_url': static_audio("speechRecognitionError_response.mp3")
+        }, 200
+
+    # In streaming mode the description is generated and spoken while the frontend plays it
+    if current_app.config['STREAM_RESPONSES']:
+        prepared_image = image_future.result()
+        timer.run("housekeeping", ("stt",), save_prepared_image, image_filepath, prepared_image)
+        remember_image(user_id, image_filepath, last_transcript=transcript)
+        timer.report()
+        return streamed_result(create_stream(UPLOAD_FOLDER, "image", transcript, image_filepath, prepared_image))
+
+    # Generates a description of the given image using image_interpreter
+    progress("interpreting")
+    prepared_image = image_future.result()
+    description = timer.run("vision", ("stt", "image_prep"), image_interpreter,
+                            image_filepath, transcript, prepared_image)
+
+    # Keeps the prepared image for questions about the last image while the response is being spoken
+    housekeeping_future = start_stage(timer, "housekeeping", ("vision",), save_prepared_image, image_filepath, prepared_image)
+
+    # Return a 500 error if image interpretation does not return
+    if not description:
+        housekeeping_future.result()
+        remember_image(user_id, image_filepath, last_transcript=transcript)
+        timer.report()
+        return {'error': 'Could not interpret the image'}, 500
+
+    # Generates TTS from "description" and saves it to the user's folder.
+    progress("speaking")
+    response_id = timer.run("tts", ("vision",), speak, description, UPLOAD_FOLDER)
+    housekeeping_future.result()
+
+    # The image becomes the user's last image (the state is only changed from this thread, which has the database session)
+    remember_image(user_id, image_filepath, last_transcript=transcript, last_response_id=response_id)
+    timer.report()
+    return spoken_result(response_id)
+
+
+# Function that, given the user's id and folder and the audio (a ".wav" path, decoded AudioData or StreamedAudio), will run the audio only query and return the result for the frontend
+def run_audio_query(user_id, UPLOAD_FOLDER, audio, progress=no_progress):
+    timer = StageTimer("process_audio_query")
+
+    # Gets the user's last image if there is one, None otherwise
+    lastImage_filepath = last_image(user_id)
+
+    # Generates a transcript of the given audio
+    progress("transcribing")
+    transcript = timer.run("stt", (), transcribe, audio)
+
+    # Returns url for the speechRecognition error audio file if no transcript could be obtained
+    if not transcript:
+        timer.intent = "no_transcript"
+        timer.report()
+        return {
+            'message': 'Speech Recognition Error',
+            'audio_url': static_audio("speechRecognitionError_response.mp3")
+        }, 200
+
+    # Control requests are recognized locally first, which skips the round trip to xAI
+    progress("interpreting")
+    semantic = timer.run("intent", ("stt",), local_intent, transcript)
+
+    # In streaming mode the semantic is worked out while the frontend waits for the audio
+    if current_app.config['STREAM_RESPONSES']:
+        if semantic == "lastImage" and lastImage_filepath != None:
+            remember(user_id, last_transcript=transcript)
+            result = streamed_result(create_stream(UPLOAD_FOLDER, "image", transcript, lastImage_filepath))
+        elif semantic:
+            result = interpret_semantic(user_id, UPLOAD_FOLDER, semantic, transcript, lastImage_filepath, timer, "intent", progress)
+        else:
+            timer.intent = "streamed"
+            remember(user_id, last_transcript=transcript)
+            result = streamed_result(create_stream(UPLOAD_FOLDER, "audio", transcript, lastImage_filepath))
+        timer.report()
+        return result
+
+    # With getting the semantic of the transcript, we are able to use xAI to respond with keywords which can trigger certian responses
+    if semantic:
+        decided_by = "intent"
+    # With one-call routing, a single model call (with the last image attached) picks the keyword or answers straight away
+    elif current_app.config['ONE_CALL_ROUTING']:
+        semantic = timer.run("routing", ("intent",), route_query, transcript, lastImage_filepath)
+        decided_by = "routing"
+    else:
+        semantic = timer.run("semantic", ("intent",), xaiprocess_semantic, transcript)
+        decided_by = "semantic"
+
+    result = interpret_semantic(user_id, UPLOAD_FOLDER, semantic, transcript, lastImage_filepath, timer, decided_by, progress)
+    timer.report()
+    return result
+
+
+# Function that, given the semantic keyword (or answer) for a transcript and the stage that decided it, will act on it and return the result for the frontend
+def interpret_semantic(user_id, UPLOAD_FOLDER, semantic, transcript, lastImage_filepath, timer, decided_by, progress=no_progress):
+    timer.intent = semantic if semantic in SEMANTIC_KEYWORDS else "answer"
+
+    if(semantic == "logout"):
+        return {'message': 'logout'}, 200
+
+    elif(semantic == "askAbout"):
+        return {
+            'message': 'askAbout',
+            'audio_url': static_audio("askabout_response.mp3")
+        }, 200
+
+    elif(semantic == "lastImage"):
+        if(lastImage_filepath != None):
+            description = timer.run("vision", (decided_by,), image_interpreter, lastImage_filepath, transcript)
+            progress("speaking")
+            response_id = timer.run("tts", ("vision",), speak, description, UPLOAD_FOLDER)
+            remember(user_id, last_transcript=transcript, last_response_id=response_id)
+            return spoken_result(response_id)
+        else:
+            return {
+                'message': 'Image History Error',
+                'audio_url': static_audio("imageHistoryError_response.mp3")
+            }, 200
+
+    # Repeating is a lookup of the user's last response
+    elif(semantic == "repeat"):
+        state = load_state(user_id)
+        if state is None or state.last_response_id is None:
+            return {'error': 'There is no response to repeat'}, 404
+        return spoken_result(state.last_response_id)
+
+    else:
+        progress("speaking")
+        response_id = timer.run("tts", (decided_by,), speak, semantic, UPLOAD_FOLDER)
+        remember(user_id, last_transcript=transcript, last_response_id=response_id)
+        return spoken_result(response_id)
+
+
+# Async mode (see "aio.py"): the same queries as coroutines, so a worker waits on the upstream services of many queries at once
+# Background stages are tasks on the event loop instead of threads of the stage pool, CPU and disk work is offloaded
+
+
+# Same as "start_stage", for async mode: given a function, will run it offloaded as a task and return the task
+async def start_stage_async(timer, stage, after, func, *args):
+    task = asyncio.ensure_future(timer.run_async(stage, after, offload, func, *args))
+    if not concurrent_pipeline:
+        await asyncio.wait([task])
+    return task
+
+
+# Same as "transcribe", for async mode
+# The rest of a streamed recording is recognized by its segment pool (see "ingest.py"), which is waited on outside the event loop
+async def transcribe_async(audio):
+    if isinstance(audio, StreamedAudio):
+        return await offload(audio.transcribe)
+    return await speech_interpreter_async(audio)
+
+
+# Same as "run_image_audio_query", for async mode
+async def run_image_audio_query_async(user_id, UPLOAD_FOLDER, audio, image_filepath, progress=no_progress):
+    timer = StageTimer("process_image_audio_query")
+    timer.intent = "describe"
+
+    # Loads, downscales and encodes the image while the speech recognition request is in flight
+    image_task = await start_stage_async(timer, "image_prep", (), prepare_image, image_filepath)
+
+    progress("transcribing")
+    transcript = await timer.run_async("stt", (), transcribe_async, audio)
+
+    if not transcript:
+        timer.intent = "no_transcript"
+        await asyncio.wait([image_task])
+        os.remove(image_filepath)
+        timer.report()
+        return {
+            'message': 'askAbout',
+            'audio_url': static_audio("speechRecognitionError_response.mp3")
+        }, 200
+
+    if current_app.config['STREAM_RESPONSES']:
+        prepared_image = await image_task
+        await timer.run_async("housekeeping", ("stt",), offload, save_prepared_image, image_filepath, prepared_image)
+        await offload(remember_image, user_id, image_filepath, last_transcript=transcript)
+        timer.report()
+        return streamed_result(create_stream(UPLOAD_FOLDER, "image", transcript, image_filepath, prepared_image))
+
+    progress("interpreting")
+    prepared_image = await image_task
+    description = await timer.run_async("vision", ("stt", "image_prep"), image_interpreter_async,
+                                        image_filepath, transcript, prepared_image)
+
+    housekeeping_task = await start_stage_async(timer, "housekeeping", ("vision",), save_prepared_image, image_filepath, prepared_image)
+
+    if not description:
+        await housekeeping_task
+        await offload(remember_image, user_id, image_filepath, last_transcript=transcript)
+        timer.report()
+        return {'error': 'Could not interpret the image'}, 500
+
+    progress("speaking")
+    response_id = await timer.run_async("tts", ("vision",), speak_async, description, UPLOAD_FOLDER)
+    await housekeeping_task
+
+    await offload(remember_image, user_id, image_filepath, last_transcript=transcript, last_response_id=response_id)
+    timer.report()
+    return spoken_result(response_id)
+
+
+# Same as "run_audio_query", for async mode
+async def run_audio_query_async(user_id, UPLOAD_FOLDER, audio, progress=no_progress):
+    timer = StageTimer("process_audio_query")
+
+    lastImage_filepath = await offload(last_image, user_id)
+
+    progress("transcribing")
+    transcript = await timer.run_async("stt", (), transcribe_async, audio)
+
+    if not transcript:
+        timer.intent = "no_transcript"
+        timer.report()
+        return {
+            'message': 'Speech Recognition Error',
+            'audio_url': static_audio("speechRecognitionError_response.mp3")
+        }, 200
+
+    progress("interpreting")
+    semantic = timer.run("intent", ("stt",), local_intent, transcript)
+
+    if current_app.config['STREAM_RESPONSES']:
+        if semantic == "lastImage" and lastImage_filepath != None:
+            await offload(remember, user_id, last_transcript=transcript)
+            result = streamed_result(create_stream(UPLOAD_FOLDER, "image", transcript, lastImage_filepath))
+        elif semantic:
+            result = await interpret_semantic_async(user_id, UPLOAD_FOLDER, semantic, transcript, lastImage_filepath, timer, "intent", progress)
+        else:
+            timer.intent = "streamed"
+            await offload(remember, user_id, last_transcript=transcript)
+            result = streamed_result(create_stream(UPLOAD_FOLDER, "audio", transcript, lastImage_filepath))
+        timer.report()
+        return result
+
+    if semantic:
+        decided_by = "intent"
+    elif current_app.config['ONE_CALL_ROUTING']:
+        semantic = await timer.run_async("routing", ("intent",), route_query_async, transcript, lastImage_filepath)
+        decided_by = "routing"
+    else:
+        semantic = await timer.run_async("semantic", ("intent",), xaiprocess_semantic_async, transcript)
+        decided_by = "semantic"
+
+    result = await interpret_semantic_async(user_id, UPLOAD_FOLDER, semantic, transcript, lastImage_filepath, timer, decided_by, progress)
+    timer.report()
+    return result
+
+
+# Same as "interpret_semantic", for async mode
+async def interpret_semantic_async(user_id, UPLOAD_FOLDER, semantic, transcript, lastImage_filepath, timer, decided_by, progress=no_progress):
+    if semantic == "lastImage" and lastImage_filepath != None:
+        timer.intent = semantic
+        description = await timer.run_async("vision", (decided_by,), image_interpreter_async, lastImage_filepath, transcript)
+        progress("speaking")
+        response_id = await timer.run_async("tts", ("vision",), speak_async, description, UPLOAD_FOLDER)
+        await offload(remember, user_id, last_transcript=transcript, last_response_id=response_id)
+        return spoken_result(response_id)
+
+    # Answers are spoken here, the other keywords only need the prebuilt clips or the conversation state
+    if semantic not in SEMANTIC_KEYWORDS:
+        timer.intent = "answer"
+        progress("speaking")
+        response_id = await timer.run_async("tts", (decided_by,), speak_async, semantic, UPLOAD_FOLDER)
+        await offload(remember, user_id, last_transcript=transcript, last_response_id=response_id)
+        return spoken_result(response_id)
+
+    return await offload(interpret_semantic, user_id, UPLOAD_FOLDER, semantic, transcript, lastImage_filepath, timer, decided_by, progress)
+
+
+# The async version of each query, used instead of it when ASYNC_PIPELINE is on
+ASYNC_QUERIES = {
+    run_image_audio_query: run_image_audio_query_async,
+    run_audio_query: run_audio_query_async,
+}
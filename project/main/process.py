@@ -1,32 +1,61 @@
 import os
-from gtts import gTTS
-from speech_recognition import Recognizer, AudioFile
-from openai import OpenAI
-import base64
-import requests
-from pydub import AudioSegment
-
-# Toggle to change between gTTS(True) and OpenAI(False) (no $ vs $)
-freespeak = True
-
-# Saved as environment variables for safety
-OpenAI.api_key = os.environ.get("OPENAI_API_KEY")
-xAI_API_KEY = os.environ.get("xAI_API_KEY")
+import json
+import threading
+import functools
+from itertools import chain
+from speech_recognition import AudioFile, AudioData, UnknownValueError
+import io
+
+from .imaging import load_prepared_image
+from .tts_cache import tts_cache
+from . import vision_cache
+from .metrics import stage, count_bytes
+from .audio import encode_audio, TTS_FORMATS
+from .vad import trim
+from .conversation import content_id, response_path
+from .aio import offload
+from . import providers
+from .clients import (openai_client, xai_client, recognizer, upstream, call_with_retries,
+                      PooledgTTS, STT_TRANSIENT_ERRORS, TTS_TRANSIENT_ERRORS, GOOGLE_STT_URL,
+                      async_openai_client, async_xai_client, async_upstream, call_with_retries_async,
+                      recognize_google_async, gtts_async, STT_REQUESTS)
+
+# Which providers answer each stage, and whether gTTS or OpenAI speaks the responses (TTS_POLICY, no $ vs $), see "providers.py"
+
+# API keys are saved as environment variables for safety, see "clients.py"
+
+
+
+# Function that, given a path to an audio file (or decoded AudioData), will return the audio to send to speech recognition
+def speech_audio(audio_path):
+    # Audio that was already decoded in memory can be sent as is
+    if isinstance(audio_path, AudioData):
+        audio = audio_path
+    # Given the path to an audiofile, read it with the shared recognizer
+    else:
+        with AudioFile(audio_path) as source:
+            audio = recognizer().record(source)
 
+    # Cuts the silence around and within the speech and resamples to 16 kHz mono before it is uploaded
+    with stage("vad"):
+        audio = trim(audio)
+    count_bytes('stt', 'in', len(audio.frame_data))
+    return audio
 
 
-# Function that, given an path to an audio file, will return a transcript of the speech in that audio file
+# Function that, given an path to an audio file (or decoded AudioData), will return a transcript of the speech in that audio
 def speech_interpreter(audio_path):
     # *terminal* indicate when the "speech_interpreter" function is running
     print("RUNNING SPEECH INTERPRETER")
 
-    # Assign the recognizer function to the the variable, "r"
-    r = Recognizer()
     try:
-        # Given the path to an audiofile, get a transcript using google cloud speech recognition
-        with AudioFile(audio_path) as source:
-            audio = r.record(source)
-        transcript = r.recognize_google(audio)
+        # Get a transcript from Google speech recognition, or from OpenAI when Google is failing or slow
+        audio = speech_audio(audio_path)
+        transcript = providers.call('stt', {
+            'google': functools.partial(stt_google, audio),
+            'openai': functools.partial(stt_openai, audio),
+        })
+        count_bytes('stt', 'out', len(transcript or ""))
         
         # Print the transcript in the terminal
         print(transcript, "\n")
@@ -36,133 +65,414 @@ def speech_interpreter(audio_path):
     
     # If speech interpretation fails, return the error and None
     except Exception as e:
-        print(f"Error in speech interpretation\n")
+        print(f"Error in speech interpretation: {e}\n")
     return None
 
 
-# A function that, given an image path, will return a base64 encoding of that image
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+# Same as "speech_interpreter", for async mode (see "aio.py"): preparing the audio is offloaded as CPU work
+async def speech_interpreter_async(audio_path):
+    print("RUNNING SPEECH INTERPRETER")
 
+    try:
+        audio = await offload(speech_audio, audio_path)
+        transcript = await providers.call_async('stt', {
+            'google': functools.partial(stt_google_async, audio),
+            'openai': functools.partial(stt_openai_async, audio),
+        })
+        count_bytes('stt', 'out', len(transcript or ""))
+        print(transcript, "\n")
+        return transcript
 
-# A function that, given an image path and text, will return a description of an image based on two input modalities
-def image_interpreter(image_path, transcript):
-    # *terminal* indicate when the "image_interpreter" function is running
-    print("RUNNING IMAGE INTERPRETER")
+    except Exception as e:
+        print(f"Error in speech interpretation: {e}\n")
+    return None
 
-    # Assign the OpenAI function to the variable, "client"
-    client = OpenAI()
-        
-    # Get the base64 encoding of the image
-    base64_image = encode_image(image_path)
-
-    # Using gpt-4o-mini, get a response for the two input modalities
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are an assistant for a blind person. Be concise and tell them about the important facts in the image. Your response should be a maximum of two sentences."},
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": transcript,
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
+
+# Functions that, given prepared audio, will return its transcript from Google or OpenAI speech recognition (None when no speech was heard)
+def stt_google(audio):
+    try:
+        return call_with_retries('google', STT_TRANSIENT_ERRORS, recognizer().recognize_google, audio, endpoint=GOOGLE_STT_URL)
+    except UnknownValueError:
+        return None
+
+
+def stt_openai(audio):
+    client = openai_client('stt')
+    with upstream('openai'):
+        transcription = client.audio.transcriptions.create(model="whisper-1", file=("speech.wav", audio.get_wav_data(), "audio/wav"))
+    return transcription.text.strip() or None
+
+
+# Same as "stt_google" and "stt_openai", for async mode: encoding the audio to FLAC or WAV is offloaded as CPU work
+async def stt_google_async(audio):
+    request = await offload(STT_REQUESTS.build, audio)
+    try:
+        return await call_with_retries_async('google', STT_TRANSIENT_ERRORS, recognize_google_async, request)
+    except UnknownValueError:
+        return None
+
+
+async def stt_openai_async(audio):
+    client = async_openai_client('stt')
+    wav_data = await offload(audio.get_wav_data)
+    async with async_upstream('openai'):
+        transcription = await client.audio.transcriptions.create(model="whisper-1", file=("speech.wav", wav_data, "audio/wav"))
+    return transcription.text.strip() or None
+
+
+# Level of detail the vision model looks at the image with: "low" (faster and cheaper), "high" or "auto"
+VISION_DETAIL = "auto"
+
+
+# A function that, given text and a prepared image, will return the chat messages for the vision model
+def image_messages(transcript, prepared_image):
+    return [
+        {"role": "system", "content": "You are an assistant for a blind person. Be concise and tell them about the important facts in the image. Your response should be a maximum of two sentences."},
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": transcript,
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{prepared_image['mime']};base64,{prepared_image['data']}",
+                        "detail": VISION_DETAIL,
                     },
-                ],
-            }
-        ],
-    )
+                },
+            ],
+        }
+    ]
+
 
-    description = response.choices[0].message.content
+# Model each provider answers questions about images with
+VISION_MODELS = {'openai': "gpt-4o-mini", 'xai': "grok-vision-beta"}
 
-    # *terminal* print the response from gpt-4o-mini
+
+# A function that, given an image path and text, will return a description of an image based on two input modalities
+# An image that was already prepared with "prepare_image" can be passed in to skip reading and encoding it again
+def image_interpreter(image_path, transcript, prepared_image=None):
+    # *terminal* indicate when the "image_interpreter" function is running
+    print("RUNNING IMAGE INTERPRETER")
+
+    # Get the downscaled base64 encoding of the image (images asked about again, like the last image, are only encoded once)
+    if prepared_image is None:
+        prepared_image = load_prepared_image(image_path)
+
+    # The same question about the same image is answered from the vision cache (for the same user)
+    description = vision_cache.lookup(prepared_image, transcript)
+    if description:
+        print(description, "\n")
+        return description
+
+    # Using gpt-4o-mini (or Grok when OpenAI is failing or slow), get a response for the two input modalities
+    count_bytes('vision', 'in', len(prepared_image['data']) + len(transcript))
+    messages = image_messages(transcript, prepared_image)
+    description = providers.call('vision', {provider: functools.partial(chat, provider, 'vision', model, messages)
+                                            for provider, model in VISION_MODELS.items()})
+    if description:
+        count_bytes('vision', 'out', len(description))
+        vision_cache.store(prepared_image, transcript, description)
+
+    # *terminal* print the response from the vision model
     print(description, "\n")
 
     # Return the description
     return description
 
-# A function that, given text and a directory path, will do TTS and save the file to the given directory
-def speak(text, UPLOAD_FOLDER):
-    # Indicate the the "speak" function is running
-    print("RUNNING TEXT TO SPEECH")
 
-    # Define the output path for the TTS audio file
-    tts_audio_path = os.path.join(UPLOAD_FOLDER, "responseTTS.mp3")
+# Same as "image_interpreter", for async mode: reading the image and the vision cache is offloaded
+async def image_interpreter_async(image_path, transcript, prepared_image=None):
+    print("RUNNING IMAGE INTERPRETER")
 
-    # Use Google TTS when the "freespeak" variable is true
-    if freespeak == True:
+    if prepared_image is None:
+        prepared_image = await offload(load_prepared_image, image_path)
 
-        # Get text to speech from the given text using google TTS
-        ttsFile = gTTS(text = text, lang='en', slow=False)
+    description = await offload(vision_cache.lookup, prepared_image, transcript)
+    if description:
+        print(description, "\n")
+        return description
 
-        # Saves the TTS file to "UPLOAD_FOLDER" as "responseTTS.mp3"
-        ttsFile.save(tts_audio_path)
+    count_bytes('vision', 'in', len(prepared_image['data']) + len(transcript))
+    messages = image_messages(transcript, prepared_image)
+    description = await providers.call_async('vision', {provider: functools.partial(chat_async, provider, 'vision', model, messages)
+                                                        for provider, model in VISION_MODELS.items()})
+    if description:
+        count_bytes('vision', 'out', len(description))
+        await offload(vision_cache.store, prepared_image, transcript, description)
 
-        boostedTtsFile = AudioSegment.from_mp3(tts_audio_path)
-        boostedTtsFile = boostedTtsFile + 5
-        boostedTtsFile.export(tts_audio_path, format='mp3')
+    print(description, "\n")
+    return description
 
-        print(f"TTS audio saved successfully at {tts_audio_path}\n")
 
-        # Return the audio file path
-        return tts_audio_path
-    
-    # Use OpenAI TTS when the freespeak is false
-    elif freespeak == False:
-        # Initialize the OpenAI client
-        client = OpenAI()
+# The shared clients of the providers that answer chat completions
+CHAT_CLIENTS = {'openai': openai_client, 'xai': xai_client}
+ASYNC_CHAT_CLIENTS = {'openai': async_openai_client, 'xai': async_xai_client}
+
+
+# A function that, given a provider, a stage, a model and chat messages, will return the model's answer
+def chat(provider, stage_name, model, messages):
+    client = CHAT_CLIENTS[provider](stage_name)
+    with upstream(provider):
+        completion = client.chat.completions.create(model=model, messages=messages)
+    return completion.choices[0].message.content
+
+
+# Same as "chat", for async mode
+async def chat_async(provider, stage_name, model, messages):
+    client = ASYNC_CHAT_CLIENTS[provider](stage_name)
+    async with async_upstream(provider):
+        completion = await client.chat.completions.create(model=model, messages=messages)
+    return completion.choices[0].message.content
+
+
+# A function that, given an image path and text, will stream the description of the image as it is generated
+def image_interpreter_stream(image_path, transcript, prepared_image=None):
+    print("RUNNING IMAGE INTERPRETER (STREAMING)")
+
+    if prepared_image is None:
+        prepared_image = load_prepared_image(image_path)
+
+    description = vision_cache.lookup(prepared_image, transcript)
+    if description:
+        return iter([description])
+
+    # The same providers as "image_interpreter", the first one to start answering streams the description
+    count_bytes('vision', 'in', len(prepared_image['data']) + len(transcript))
+    messages = image_messages(transcript, prepared_image)
+    pieces = providers.call('vision', {provider: functools.partial(chat_stream, provider, 'vision', model, messages)
+                                       for provider, model in VISION_MODELS.items()})
+    return cache_stream(pieces, prepared_image, transcript)
+
+
+# A function that, given the pieces of a streamed description, the image and the transcript, will pass the pieces on and store the whole description once it is finished
+def cache_stream(pieces, prepared_image, transcript):
+    description = ""
+    for piece in pieces:
+        description += piece
+        yield piece
+    if description:
+        count_bytes('vision', 'out', len(description))
+        vision_cache.store(prepared_image, transcript, description)
+
+
+# A function that, given a provider and a function that starts a streamed chat completion, will yield the pieces of text as they arrive
+# The provider's request slot is held until the stream is finished
+def stream_text(provider, start_stream):
+    with upstream(provider):
+        for chunk in start_stream():
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+# Same as "chat", but waits for the first piece of the answer and returns all of its pieces, so "providers.call" hedges and fails over
+# on the time to the first piece (and on errors before it). An error after the first piece ends the stream early
+def chat_stream(provider, stage_name, model, messages):
+    client = CHAT_CLIENTS[provider](stage_name)
+    pieces = stream_text(provider, lambda: client.chat.completions.create(model=model, messages=messages, stream=True))
+    first = next(pieces, None)
+    return chain([first] if first is not None else [], pieces)
 
-        # Make the TTS request
+# Volume boost (in dB) applied to every TTS response
+TTS_GAIN = 5
+
+# Format TTS responses are sent in: "mp3" plays everywhere, "opus" (Ogg/Opus) is about a third of the size for the same speech quality
+TTS_FORMAT = "mp3"
+
+# Bitrate of each format, speech needs far less than music
+TTS_BITRATES = {"mp3": "64k", "opus": "24k"}
+
+# Sample rate of the raw PCM OpenAI TTS sends back
+OPENAI_PCM_RATE = 24000
+
+
+# Engine and voice of each TTS provider, part of the key of the TTS cache
+TTS_VOICES = {'gtts': ("gtts", "en"), 'openai': ("tts-1", "nova")}
+
+
+# A function that, given text and a format, will do TTS and return the volume boosted audio in that format and the provider that spoke it
+# (None and None if the TTS failed)
+def synthesize(text, audio_format=TTS_FORMAT):
+    try:
+        # gTTS or OpenAI speaks the text, depending on TTS_POLICY and on how each of them is doing
+        with stage("tts_request"):
+            provider, audio_content, pcm_rate = providers.call('tts', {
+                'gtts': functools.partial(tts_gtts, text),
+                'openai': functools.partial(tts_openai, text),
+            })
+    except Exception as e:
+        print(f"Error in speak function: {e}\n")
+        return None, None
+
+    if not audio_content:
+        print("Error: No audio content in the response.\n")
+        return None, None
+    return boost_and_encode(audio_content, audio_format, pcm_rate), provider
+
+
+# A function that, given text, will return its MP3 audio from Google TTS (with the provider and no PCM sample rate)
+def tts_gtts(text):
+    # Get text to speech from the given text using google TTS
+    ttsFile = PooledgTTS(text = text, lang='en', slow=False)
+
+    def fetch():
+        buffer = io.BytesIO()
+        ttsFile.write_to_fp(buffer)
+        return buffer.getvalue()
+
+    return 'gtts', call_with_retries('google', TTS_TRANSIENT_ERRORS, fetch), None
+
+
+# A function that, given text, will return its raw PCM audio from OpenAI TTS (with the provider and the sample rate)
+def tts_openai(text):
+    # Get the shared OpenAI client
+    client = openai_client('tts')
+
+    # Make the TTS request, asking for raw PCM so the audio is only encoded once
+    with upstream('openai'):
         response = client.audio.speech.create(
             model="tts-1",
             voice="nova",
-            input=text
+            input=text,
+            response_format="pcm",
         )
 
-        # Check if the response is valid
-        if response is None:
-            print("Error: No response received from TTS API.\n")
-            return None
-
         # Read the binary audio content
-        audio_content = response.read()
-        if not audio_content:
-            print("Error: No audio content in the response.\n")
-            return None
+        audio_content = response.read() if response is not None else None
+    return 'openai', audio_content, OPENAI_PCM_RATE
 
-        # Write the audio content to the file
-        with open(tts_audio_path, "wb") as f:
-            f.write(audio_content)
 
-        boostedTtsFile = AudioSegment.from_mp3(tts_audio_path)
-        boostedTtsFile = boostedTtsFile + 5
-        boostedTtsFile.export(tts_audio_path, format='mp3')
+# A function that, given TTS audio (MP3, or raw PCM with its sample rate) and a format, will boost the volume and encode it in that format
+def boost_and_encode(audio_content, audio_format, pcm_rate=None):
+    # Boosts the volume and encodes the audio in the response format in one pass, without a file in between
+    with stage("tts_encode"):
+        encoded = encode_audio(audio_content, TTS_GAIN, audio_format, TTS_BITRATES[audio_format], pcm_rate)
 
-        print(f"TTS audio saved successfully at {tts_audio_path}\n")
-        return tts_audio_path
+    count_bytes('tts', 'out', len(encoded))
+    return encoded
 
+
+# Same as "synthesize", for async mode: the encode is offloaded as CPU work
+async def synthesize_async(text, audio_format=TTS_FORMAT):
+    try:
+        with stage("tts_request"):
+            provider, audio_content, pcm_rate = await providers.call_async('tts', {
+                'gtts': functools.partial(tts_gtts_async, text),
+                'openai': functools.partial(tts_openai_async, text),
+            })
+    except Exception as e:
+        print(f"Error in speak function: {e}\n")
+        return None, None
+
+    if not audio_content:
+        print("Error: No audio content in the response.\n")
+        return None, None
+    return await offload(boost_and_encode, audio_content, audio_format, pcm_rate), provider
+
+
+# Same as "tts_gtts" and "tts_openai", for async mode
+async def tts_gtts_async(text):
+    audio_content = await call_with_retries_async('google', TTS_TRANSIENT_ERRORS, gtts_async, PooledgTTS(text = text, lang='en', slow=False))
+    return 'gtts', audio_content, None
+
+
+async def tts_openai_async(text):
+    client = async_openai_client('tts')
+    async with async_upstream('openai'):
+        response = await client.audio.speech.create(
+            model="tts-1",
+            voice="nova",
+            input=text,
+            response_format="pcm",
+        )
+    return 'openai', response.content if response is not None else None, OPENAI_PCM_RATE
+
+
+# A function that, given text, a format and a TTS provider, will return the key of its audio in the TTS cache
+def tts_key(text, audio_format, provider):
+    engine, voice = TTS_VOICES[provider]
+    return tts_cache.key(text, engine, voice, TTS_GAIN, f"{audio_format}-{TTS_BITRATES[audio_format]}")
+
+
+# A function that, given text and a format, will return the keys of its audio in the TTS cache, in the order of the TTS policy
+def tts_keys(text, audio_format):
+    return [tts_key(text, audio_format, provider) for provider in providers.providers_for('tts', TTS_VOICES)]
+
+
+# A function that, given text and a format (TTS_FORMAT by default), will return the volume boosted audio for it, or None if the TTS failed
+def tts_audio(text, audio_format=None):
+    audio_format = audio_format or TTS_FORMAT
+
+    # Responses that were already spoken (by any provider the policy allows) are taken from the TTS cache, which skips both the TTS request and the encode
+    audio_content = tts_cache.get(*tts_keys(text, audio_format))
+
+    if audio_content is None:
+        audio_content, provider = synthesize(text, audio_format)
+        if audio_content is not None:
+            tts_cache.put(tts_key(text, audio_format, provider), audio_content)
     else:
-        print(f"Error in speak function:")
+        print("TTS cache hit")
+    return audio_content
+
+
+# Same as "tts_audio", for async mode
+async def tts_audio_async(text, audio_format=None):
+    audio_format = audio_format or TTS_FORMAT
+    audio_content = await offload(tts_cache.get, *tts_keys(text, audio_format))
+
+    if audio_content is None:
+        audio_content, provider = await synthesize_async(text, audio_format)
+        if audio_content is not None:
+            await offload(tts_cache.put, tts_key(text, audio_format, provider), audio_content)
+    else:
+        print("TTS cache hit")
+    return audio_content
+
+
+# A function that, given text and a directory path, will do TTS, save the file to the given directory and return the id of the response
+def speak(text, UPLOAD_FOLDER):
+    # Indicate the the "speak" function is running
+    print("RUNNING TEXT TO SPEECH")
+
+    audio_content = tts_audio(text)
+    if audio_content is None:
         return None
-    
-#using xAi for the "Semantic Engine" - returns keywords by interpreting the users speech 
-def xaiprocess_semantic(transcript): 
-    print("RUNNING SEMANTICS INTERPRETER")
+    return save_response(audio_content, UPLOAD_FOLDER)
 
-    client = OpenAI(
-        api_key = xAI_API_KEY,
-        base_url="https://api.x.ai/v1"
-    )
 
-    completion = client.chat.completions.create(
-    model="grok-beta",
-    messages=[
-        {"role": "system", "content": """
+# Same as "speak", for async mode
+async def speak_async(text, UPLOAD_FOLDER):
+    print("RUNNING TEXT TO SPEECH")
+
+    audio_content = await tts_audio_async(text)
+    if audio_content is None:
+        return None
+    return await offload(save_response, audio_content, UPLOAD_FOLDER)
+
+
+# A function that, given response audio and a directory path, will save the audio in the directory and return the id of the response
+def save_response(audio_content, UPLOAD_FOLDER):
+    # Every response is saved under a hash of its audio, so a file never changes once written and its URL can be cached for good
+    response_id = content_id(audio_content)
+    tts_audio_path = response_path(UPLOAD_FOLDER, response_id, TTS_FORMATS[TTS_FORMAT]['extension'])
+    os.makedirs(os.path.dirname(tts_audio_path), exist_ok=True)
+
+    # Write the audio content to the file (written to a temporary file first, the same response may be played while it is saved again)
+    tmp_path = tts_audio_path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(audio_content)
+    os.replace(tmp_path, tts_audio_path)
+
+    print(f"TTS audio saved successfully at {tts_audio_path}\n")
+
+    # Return the id of the response
+    return response_id
+
+
+# Instructions for the xAI "Semantic Engine"
+SEMANTIC_PROMPT = """
          
          With the text you have been given, your job is to decipher and fit it to a specific keyword. You will ONLY respond with the most appropriate keyword. 
          These keywords are given in the format (Interpreted request:keyword response). If the text best fits the decription of:
@@ -175,12 +485,174 @@ def xaiprocess_semantic(transcript):
          EXCEPTION TO KEYWORDS:
          If the user has a a request that does not relate to any other keyword requests, instead returning a keyword, respond to the question with a maximum of two sentences.
          
-         """},
-        {"role": "user", "content": transcript},
-        ],
-    )
+         """
+
+# The keywords the "Semantic Engine" can respond with
+SEMANTIC_KEYWORDS = {"logout", "lastImage", "askAbout", "repeat"}
+
+# Model each provider runs the "Semantic Engine" with
+SEMANTIC_MODELS = {'xai': "grok-beta", 'openai': "gpt-4o-mini"}
+
+
+#using xAi for the "Semantic Engine" - returns keywords by interpreting the users speech 
+def xaiprocess_semantic(transcript): 
+    print("RUNNING SEMANTICS INTERPRETER")
+
+    # Grok answers, or gpt-4o-mini when xAI is failing or slow
+    count_bytes('semantic', 'in', len(transcript))
+    messages = semantic_messages(transcript)
+    response = providers.call('semantic', {provider: functools.partial(chat, provider, 'semantic', model, messages)
+                                           for provider, model in SEMANTIC_MODELS.items()})
 
     # Return the keyword
-    response  = completion.choices[0].message.content
+    count_bytes('semantic', 'out', len(response or ""))
+    print(response, "\n")
+    return response
+
+
+# Same as "xaiprocess_semantic", for async mode
+async def xaiprocess_semantic_async(transcript):
+    print("RUNNING SEMANTICS INTERPRETER")
+
+    count_bytes('semantic', 'in', len(transcript))
+    messages = semantic_messages(transcript)
+    response = await providers.call_async('semantic', {provider: functools.partial(chat_async, provider, 'semantic', model, messages)
+                                                       for provider, model in SEMANTIC_MODELS.items()})
+
+    count_bytes('semantic', 'out', len(response or ""))
+    print(response, "\n")
+    return response
+
+
+# A function that, given a transcript, will return the messages for the semantics interpreter
+def semantic_messages(transcript):
+    return [
+        {"role": "system", "content": SEMANTIC_PROMPT},
+        {"role": "user", "content": transcript},
+    ]
+
+
+# Same as "xaiprocess_semantic", but streams the keyword or answer as it is generated
+def xaiprocess_semantic_stream(transcript):
+    print("RUNNING SEMANTICS INTERPRETER (STREAMING)")
+
+    count_bytes('semantic', 'in', len(transcript))
+    messages = semantic_messages(transcript)
+    return providers.call('semantic', {provider: functools.partial(chat_stream, provider, 'semantic', model, messages)
+                                       for provider, model in SEMANTIC_MODELS.items()})
+
+
+# Instructions for one-call routing, which picks a control action or answers the question in the same model call
+ROUTING_PROMPT = """
+         You are an assistant for a blind person. If the request is one of the actions of the "control" tool, call it with that action.
+         Otherwise answer the request yourself with a maximum of two sentences. If an image is attached, it is the last image the user took,
+         be concise and tell them about the important facts in it that relate to the request.
+         """
+
+# Control actions the router can pick, "lastImage" only exists when there is no last image to answer from
+ROUTING_ACTIONS = {
+    "logout": "The user wishes to log out, or anything relating to logging in/out",
+    "askAbout": "The user is specifically asking about what the website capabilities are, e.g. \"what can you do?\"",
+    "repeat": "The user wants you to repeat yourself or what was said",
+    "lastImage": "The user is asking about the last image, but no image is attached",
+}
+
+
+# A function that, given whether there is a last image, will return the "control" tool the router can call
+def routing_tools(has_image):
+    actions = [action for action in ROUTING_ACTIONS if not (has_image and action == "lastImage")]
+    return [{
+        "type": "function",
+        "function": {
+            "name": "control",
+            "description": "Performs a control action instead of answering. " + " ".join(f"{action}: {ROUTING_ACTIONS[action]}." for action in actions),
+            "parameters": {
+                "type": "object",
+                "properties": {"action": {"type": "string", "enum": actions}},
+                "required": ["action"],
+            },
+        },
+    }]
+
+
+# A function that, given a transcript and the user's last image (or None), will make one model call that either picks a control
+# action or answers, and return the keyword or the answer like "xaiprocess_semantic" does
+def route_query(transcript, lastImage_filepath=None):
+    print("RUNNING ONE-CALL ROUTER")
+
+    client = openai_client('routing')
+    messages, prepared_image, description = routing_request(transcript, lastImage_filepath)
+    if description:
+        return description
+
+    with upstream('openai'):
+        completion = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            tools=routing_tools(prepared_image is not None),
+        )
+    return routing_answer(completion.choices[0].message, prepared_image, transcript)
+
+
+# Same as "route_query", for async mode: reading the last image and the vision cache is offloaded
+async def route_query_async(transcript, lastImage_filepath=None):
+    print("RUNNING ONE-CALL ROUTER")
+
+    client = async_openai_client('routing')
+    messages, prepared_image, description = await offload(routing_request, transcript, lastImage_filepath)
+    if description:
+        return description
+
+    async with async_upstream('openai'):
+        completion = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            tools=routing_tools(prepared_image is not None),
+        )
+    return await offload(routing_answer, completion.choices[0].message, prepared_image, transcript)
+
+
+# A function that, given a transcript and the user's last image (or None), will return the router's messages and the prepared image,
+# or the answer from the vision cache when the user already asked the same question about the same image
+def routing_request(transcript, lastImage_filepath):
+    # The last image is attached straight away, so a question about it is answered in the same call
+    if lastImage_filepath is not None:
+        prepared_image = load_prepared_image(lastImage_filepath)
+
+        # The same question about the same image is answered from the vision cache (for the same user)
+        description = vision_cache.lookup(prepared_image, transcript)
+        if description:
+            print(description, "\n")
+            return None, prepared_image, description
+
+        messages = image_messages(transcript, prepared_image)
+        messages[0] = {"role": "system", "content": ROUTING_PROMPT}
+        count_bytes('routing', 'in', len(prepared_image['data']) + len(transcript))
+    else:
+        prepared_image = None
+        messages = [
+            {"role": "system", "content": ROUTING_PROMPT},
+            {"role": "user", "content": transcript},
+        ]
+        count_bytes('routing', 'in', len(transcript))
+    return messages, prepared_image, None
+
+
+# A function that, given the router's message, the prepared image (or None) and the transcript, will return the keyword or the answer
+def routing_answer(message, prepared_image, transcript):
+    # A control action is returned as its keyword
+    if message.tool_calls:
+        try:
+            action = json.loads(message.tool_calls[0].function.arguments).get("action")
+        except json.JSONDecodeError:
+            action = None
+        if action in ROUTING_ACTIONS:
+            print(action, "\n")
+            return action
+
+    response = message.content
+    count_bytes('routing', 'out', len(response or ""))
+    if response and prepared_image is not None:
+        vision_cache.store(prepared_image, transcript, response)
     print(response, "\n")
-    return response
\ No newline at end of file
+    return response
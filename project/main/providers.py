@@ -0,0 +1,354 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+
+from .metrics import Counter
+
+# Provider routing: speech recognition, vision, the semantic engine and TTS can each be answered by more than one provider
+# Each stage has a latency budget. When the provider asked first is slower than usual, the next one is asked as well (a hedged
+# request) and the first answer wins. A provider that keeps failing or running over budget has its circuit opened and is skipped
+# until it has had time to recover. The numbers are kept by each worker for itself
+
+# Providers of each stage, in order of preference (TTS follows TTS_POLICY)
+STAGE_PROVIDERS = {
+    'stt': ('google', 'openai'),
+    'vision': ('openai', 'xai'),
+    'semantic': ('xai', 'openai'),
+}
+
+# TTS providers for each policy: "free" uses gTTS and only pays for OpenAI while gTTS is failing or slow,
+# "quality" prefers the OpenAI voice and "free_only" never uses OpenAI
+TTS_POLICIES = {
+    'free': ('gtts', 'openai'),
+    'quality': ('openai', 'gtts'),
+    'free_only': ('gtts',),
+}
+TTS_POLICY = os.environ.get("TTS_POLICY", "free")
+
+# Seconds each stage should take, a provider that takes longer counts as failing for its circuit breaker
+LATENCY_BUDGETS = {
+    'stt': 3,
+    'vision': 6,
+    'semantic': 3,
+    'tts': 3,
+}
+
+# The next provider is asked once the first one has taken longer than this percentile of its recent latencies (and never later than the budget)
+HEDGE_PERCENTILE = 95
+
+# Seconds a provider is always given before it is hedged
+MIN_HEDGE_SECONDS = 0.2
+
+# Number of recent latencies kept for each stage and provider, and how many are needed before the percentile is used
+LATENCY_SAMPLES = 50
+MIN_LATENCY_SAMPLES = 10
+
+# A circuit opens when at least this share of the provider's recent requests failed or ran over budget,
+# and stays open for BREAKER_COOLDOWN seconds before a single request is let through to try it again
+BREAKER_WINDOW = 20
+BREAKER_MIN_REQUESTS = 5
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_COOLDOWN = 30
+
+# Number of requests each worker has in flight to all providers together (see "clients.py" for the limit per provider)
+HEDGE_WORKERS = 16
+
+PROVIDER_REQUESTS = Counter('envisonet_provider_requests_total', "Requests sent to each provider by each stage, by why they were sent.",
+                            ('stage', 'provider', 'reason'))
+PROVIDER_ANSWERS = Counter('envisonet_provider_answers_total', "Answers used from each provider by each stage.", ('stage', 'provider'))
+CIRCUITS_OPENED = Counter('envisonet_circuits_opened_total', "Times the circuit of each provider opened.", ('provider',))
+
+# The pool is created the first time it is needed (after gunicorn has forked)
+_pool = None
+_lock = threading.Lock()
+_breakers = {}
+_latencies = {}
+
+# Async requests that lost to a hedged one are left to finish (their latency is still recorded), this keeps them referenced
+_stragglers = set()
+
+
+# Class for the circuit breaker of one provider
+class CircuitBreaker:
+    def __init__(self, provider):
+        self.provider = provider
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    # Function that will return "closed", "open" or "half_open" (the cooldown is over and the next request tries the provider again)
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        if time.monotonic() - self.opened < BREAKER_COOLDOWN:
+            return 'open'
+        return 'half_open'
+
+    # Function that will return whether a request may be sent to the provider
+    def allow(self):
+        with self.lock:
+            state = self.state()
+            if state == 'half_open' and not self.probing:
+                self.probing = True
+                return True
+            return state == 'closed'
+
+    # Function that, given whether a request failed (or ran over budget), will record it and open or close the circuit
+    def record(self, failed):
+        with self.lock:
+            # While the circuit is open only the request that tries the provider again counts
+            if self.opened is not None:
+                if not self.probing:
+                    return
+                self.probing = False
+                if failed:
+                    self.open()
+                else:
+                    print(f"CIRCUIT CLOSED for {self.provider}\n")
+                    self.opened = None
+                    self.outcomes.clear()
+                return
+
+            self.outcomes.append(failed)
+            if len(self.outcomes) >= BREAKER_MIN_REQUESTS and sum(self.outcomes) / len(self.outcomes) >= BREAKER_FAILURE_RATE:
+                self.open()
+
+    def open(self):
+        print(f"CIRCUIT OPENED for {self.provider}\n")
+        self.opened = time.monotonic()
+        CIRCUITS_OPENED.inc(provider=self.provider)
+
+
+# Class for the recent latencies of one provider in one stage
+class LatencyWindow:
+    def __init__(self):
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    # Function that, given a percentile, will return it in seconds, or None while there are too few samples
+    def percentile(self, p):
+        with self.lock:
+            if len(self.samples) < MIN_LATENCY_SAMPLES:
+                return None
+            return float(np.percentile(list(self.samples), p))
+
+
+# Functions that, given a provider (and a stage), will return its circuit breaker and its latencies, created on first use
+def breaker(provider):
+    with _lock:
+        return _breakers.setdefault(provider, CircuitBreaker(provider))
+
+
+def latencies(stage, provider):
+    with _lock:
+        return _latencies.setdefault((stage, provider), LatencyWindow())
+
+
+# Function that will return this worker's pool for requests to providers
+def get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='envisonet-provider')
+        return _pool
+
+
+# Function that will return the state of every provider's circuit (0 closed, 1 open, 0.5 half open), for "/metrics"
+def circuit_states():
+    with _lock:
+        breakers = list(_breakers.values())
+    return {b.provider: {'closed': 0, 'open': 1, 'half_open': 0.5}[b.state()] for b in breakers}
+
+
+# Function that, given a stage and the providers that can answer it, will return them in the order they should be asked
+def providers_for(stage, attempts):
+    preferred = TTS_POLICIES[TTS_POLICY] if stage == 'tts' else STAGE_PROVIDERS[stage]
+    return [provider for provider in preferred if provider in attempts]
+
+
+# Function that, given a stage and a provider, will return how many seconds to wait for the provider before hedging
+def hedge_delay(stage, provider):
+    budget = LATENCY_BUDGETS[stage]
+    usual = latencies(stage, provider).percentile(HEDGE_PERCENTILE)
+    if usual is None:
+        return budget
+    return min(max(usual, MIN_HEDGE_SECONDS), budget)
+
+
+# Function that, given the providers left to ask, will take the next one whose circuit lets a request through (or None)
+def next_provider(remaining):
+    while remaining:
+        provider = remaining.pop(0)
+        if breaker(provider).allow():
+            return provider
+    return None
+
+
+# Function that, given a stage, a provider and how long its request took (None if it failed), will record it
+def record(stage, provider, seconds):
+    if seconds is not None:
+        latencies(stage, provider).add(seconds)
+    breaker(provider).record(seconds is None or seconds > LATENCY_BUDGETS[stage])
+
+
+# Function that, given a stage, a provider and a function, will call it and record how it went
+def timed(stage, provider, func):
+    start = time.perf_counter()
+    try:
+        result = func()
+    except Exception:
+        record(stage, provider, None)
+        raise
+    record(stage, provider, time.perf_counter() - start)
+    return result
+
+
+# Same as "timed", for a coroutine function
+async def timed_async(stage, provider, func):
+    start = time.perf_counter()
+    try:
+        result = await func()
+    except Exception:
+        record(stage, provider, None)
+        raise
+    record(stage, provider, time.perf_counter() - start)
+    return result
+
+
+# Function that, given a stage, will return the providers to ask in order, with the first one already taken
+# When every circuit is open the preferred provider is asked anyway, a request that may fail is better than none
+def plan(stage, attempts):
+    remaining = providers_for(stage, attempts)
+    first = next_provider(remaining) or providers_for(stage, attempts)[0]
+    return first, remaining
+
+
+# Function that, given a stage and a function for each provider that can answer it (by provider name), will return the first answer
+# A provider that fails is replaced by the next one straight away, one that is slower than usual gets the next one asked as well
+# Raises the last error when every provider failed
+def call(stage, attempts):
+    first, remaining = plan(stage, attempts)
+    PROVIDER_REQUESTS.inc(stage=stage, provider=first, reason='first')
+
+    # With nothing to fall back on, the request is simply made here
+    if not remaining:
+        result = timed(stage, first, attempts[first])
+        PROVIDER_ANSWERS.inc(stage=stage, provider=first)
+        return result
+
+    running = {}
+    deadline = None
+
+    def launch(provider, reason):
+        nonlocal deadline
+        if reason != 'first':
+            print(f"Asking {provider} for {stage} ({reason})\n")
+            PROVIDER_REQUESTS.inc(stage=stage, provider=provider, reason=reason)
+        # The context is copied so the request is recorded with this query's timer and request id
+        future = get_pool().submit(contextvars.copy_context().run, timed, stage, provider, attempts[provider])
+        running[future] = provider
+        deadline = time.perf_counter() + hedge_delay(stage, provider)
+
+    launch(first, 'first')
+    error = None
+    while running:
+        timeout = max(0, deadline - time.perf_counter()) if remaining else None
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        # The request in flight is slower than usual
+        if not done:
+            provider = next_provider(remaining)
+            if provider is not None:
+                launch(provider, 'hedge')
+            continue
+
+        for future in done:
+            provider = running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error from {provider} in {stage}: {e}\n")
+                error = e
+                continue
+            # Requests that lost are left to finish in the pool, so their latency is still recorded
+            PROVIDER_ANSWERS.inc(stage=stage, provider=provider)
+            return result
+
+        # Every failed request is replaced by the next provider, unless another one is still in flight
+        if not running:
+            provider = next_provider(remaining)
+            if provider is not None:
+                launch(provider, 'failover')
+    raise error
+
+
+# Same as "call", for async mode: given a coroutine function for each provider
+async def call_async(stage, attempts):
+    first, remaining = plan(stage, attempts)
+    PROVIDER_REQUESTS.inc(stage=stage, provider=first, reason='first')
+
+    if not remaining:
+        result = await timed_async(stage, first, attempts[first])
+        PROVIDER_ANSWERS.inc(stage=stage, provider=first)
+        return result
+
+    running = {}
+    deadline = None
+
+    def launch(provider, reason):
+        nonlocal deadline
+        if reason != 'first':
+            print(f"Asking {provider} for {stage} ({reason})\n")
+            PROVIDER_REQUESTS.inc(stage=stage, provider=provider, reason=reason)
+        task = asyncio.ensure_future(timed_async(stage, provider, attempts[provider]))
+        running[task] = provider
+        deadline = time.perf_counter() + hedge_delay(stage, provider)
+
+    launch(first, 'first')
+    error = None
+    while running:
+        timeout = max(0, deadline - time.perf_counter()) if remaining else None
+        done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+        if not done:
+            provider = next_provider(remaining)
+            if provider is not None:
+                launch(provider, 'hedge')
+            continue
+
+        for task in done:
+            provider = running.pop(task)
+            try:
+                result = task.result()
+            except Exception as e:
+                print(f"Error from {provider} in {stage}: {e}\n")
+                error = e
+                continue
+            PROVIDER_ANSWERS.inc(stage=stage, provider=provider)
+            for straggler in running:
+                _stragglers.add(straggler)
+                straggler.add_done_callback(finish_straggler)
+            return result
+
+        if not running:
+            provider = next_provider(remaining)
+            if provider is not None:
+                launch(provider, 'failover')
+    raise error
+
+
+# Function that, given an async request that lost to a hedged one, will forget it once it has finished
+def finish_straggler(task):
+    _stragglers.discard(task)
+    if not task.cancelled():
+        task.exception()
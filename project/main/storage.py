@@ -0,0 +1,288 @@
+import os
+import glob
+import json
+import time
+import fcntl
+import shutil
+import threading
+
+from .. import db
+from ..auth.models import Conversation
+from .imaging import prepared_path
+from .audio import TTS_FORMATS
+from .tts_cache import tts_cache
+from .vision_cache import VISION_CACHE_PATH
+
+# Lifecycle of everything the app writes: expiry, quotas and disk use, handled by a background sweeper instead of the request path
+
+# Durable state (user folders with the last images, the caches) stays on disk
+FILES_FOLDER = 'FILES'
+
+# Scratch media (response audio, job and stream records, recordings being streamed) can be put on tmpfs, e.g. SCRATCH_FOLDER=/dev/shm/envisonet
+SCRATCH_FOLDER = os.environ.get("SCRATCH_FOLDER", FILES_FOLDER)
+
+# Sub-folders of the scratch folder
+JOBS_FOLDER = os.path.join(SCRATCH_FOLDER, 'jobs')
+STREAMS_FOLDER = os.path.join(SCRATCH_FOLDER, 'streams')
+RECORDINGS_FOLDER = os.path.join(SCRATCH_FOLDER, 'recordings')
+RESPONSES_FOLDER = 'responses'
+
+# Seconds before each kind of file expires
+RECORD_TTL = 10 * 60                   # job and stream records, and recordings that were never sent
+UPLOAD_TTL = 60 * 60                   # uploaded images that did not become the last image, and left over ".wav" files
+RESPONSE_TTL = 24 * 60 * 60            # response audio
+STATE_TTL = 7 * 24 * 60 * 60           # the last image and last response of a user
+
+# Number of response audio files kept for each user
+RESPONSES_KEPT = 10
+
+# Bytes each user's files may use, and all users' files together (the caches have their own limits)
+USER_QUOTA = 50 * 2 ** 20
+TOTAL_QUOTA = 2 * 2 ** 30
+
+# Seconds between two sweeps
+SWEEP_INTERVAL = 60
+
+# Disk use and eviction counts of the last sweep, shared by every gunicorn worker
+STATS_PATH = os.path.join(FILES_FOLDER, 'storage_stats.json')
+
+# Only one gunicorn worker sweeps at a time
+LOCK_PATH = os.path.join(FILES_FOLDER, '.sweeper.lock')
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+# Function that, given the user's folder, will return the user's folder for scratch media
+def scratch_folder(UPLOAD_FOLDER):
+    return os.path.join(SCRATCH_FOLDER, os.path.basename(UPLOAD_FOLDER))
+
+
+# Function that, given a folder, will return the path, size and modification time of every file in it and its sub-folders
+def list_files(folder):
+    files = []
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((path, stat.st_size, stat.st_mtime))
+    return files
+
+
+# Function that, given a folder, will return the number of bytes used by its files
+def folder_bytes(folder):
+    return sum(size for _, size, _ in list_files(folder))
+
+
+# Function that, given a path, will remove the file and return its size (0 if it was already gone)
+def remove(path):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+# Class for one sweep: finds expired files and files over the quotas, removes them and counts what it did
+class Sweep:
+    def __init__(self):
+        self.now = time.time()
+        self.evictions = {'ttl': 0, 'user_quota': 0, 'total_quota': 0}
+        self.evicted_bytes = 0
+        self.cleared = {}
+
+    # Function that, given a path and the reason, will remove the file and count it
+    def evict(self, path, reason):
+        self.evicted_bytes += remove(path)
+        self.evictions[reason] += 1
+
+    # Function that, given a folder and a TTL, will remove the files in it older than the TTL
+    def expire_folder(self, folder, ttl):
+        for path, _, mtime in list_files(folder):
+            if self.now - mtime > ttl:
+                self.evict(path, 'ttl')
+
+        # Sub-folders left empty (those of recordings) are removed as well
+        for root, names, _ in os.walk(folder, topdown=False):
+            for name in names:
+                try:
+                    os.rmdir(os.path.join(root, name))
+                except OSError:
+                    pass
+
+    # Function that, given the conversation states, will return the files each user still needs (last image and last response)
+    def protected_files(self, states):
+        protected = {}
+        for state in states:
+            folder = f'{FILES_FOLDER}/files_for_{state.user_id}'
+            if state.last_image:
+                protected[os.path.normpath(state.last_image)] = (state.user_id, 'last_image')
+                protected[os.path.normpath(prepared_path(state.last_image))] = (state.user_id, 'last_image')
+            if state.last_response_id:
+                for audio_format in TTS_FORMATS.values():
+                    path = os.path.join(scratch_folder(folder), RESPONSES_FOLDER, f"{state.last_response_id}.{audio_format['extension']}")
+                    protected[os.path.normpath(path)] = (state.user_id, 'last_response_id')
+        return protected
+
+    # Function that, given a user's files and the files users still need, will remove expired files and return the ones left
+    def expire_user_files(self, files, protected):
+        kept = []
+        responses = []
+        for path, size, mtime in files:
+            path = os.path.normpath(path)
+            if path in protected:
+                ttl = STATE_TTL
+            elif os.path.basename(os.path.dirname(path)) == RESPONSES_FOLDER:
+                ttl = RESPONSE_TTL
+                responses.append((mtime, path))
+            else:
+                ttl = UPLOAD_TTL
+
+            if self.now - mtime > ttl:
+                self.evict(path, 'ttl')
+                if path in protected:
+                    self.clear(protected[path])
+            else:
+                kept.append((path, size, mtime))
+
+        # Only the newest responses are kept
+        evicted = set()
+        for _, path in sorted(responses, reverse=True)[RESPONSES_KEPT:]:
+            if os.path.exists(path):
+                self.evict(path, 'ttl')
+                evicted.add(path)
+        return [file for file in kept if file[0] not in evicted]
+
+    # Function that, given the files (path, size, time), the files users still need, a quota and the reason, will remove the oldest files until they fit
+    # Files users still need are only removed when removing everything else is not enough
+    def enforce_quota(self, files, protected, quota, reason):
+        used = sum(size for _, size, _ in files)
+        evicted = set()
+        for path, size, _ in sorted(files, key=lambda file: (file[0] in protected, file[2])):
+            if used <= quota:
+                break
+            self.evict(path, reason)
+            if path in protected:
+                self.clear(protected[path])
+            evicted.add(path)
+            used -= size
+        return [file for file in files if file[0] not in evicted]
+
+    # Function that, given a user id and a field of the conversation state, will remember to clear it once the sweep is done
+    def clear(self, owner):
+        user_id, field = owner
+        self.cleared.setdefault(user_id, set()).add(field)
+
+    # Function that, given the app, will run the sweep and return the statistics
+    def run(self, app):
+        # Short-lived records only expire
+        self.expire_folder(JOBS_FOLDER, RECORD_TTL)
+        self.expire_folder(STREAMS_FOLDER, RECORD_TTL)
+        self.expire_folder(RECORDINGS_FOLDER, RECORD_TTL)
+
+        with app.app_context():
+            protected = self.protected_files(Conversation.query.all())
+
+        # Each user's files (on disk and in the scratch folder) expire, then have to fit in the user's quota
+        all_files = []
+        for name in os.listdir(FILES_FOLDER):
+            if not name.startswith('files_for_'):
+                continue
+            folder = os.path.join(FILES_FOLDER, name)
+            files = list_files(folder)
+            if scratch_folder(folder) != folder:
+                files += list_files(scratch_folder(folder))
+            files = self.expire_user_files(files, protected)
+            all_files += self.enforce_quota(files, protected, USER_QUOTA, 'user_quota')
+
+        # Then all users' files together have to fit in the total quota
+        all_files = self.enforce_quota(all_files, protected, TOTAL_QUOTA, 'total_quota')
+
+        # Conversation state that points at removed files is cleared
+        if self.cleared:
+            with app.app_context():
+                for user_id, fields in self.cleared.items():
+                    state = db.session.get(Conversation, user_id)
+                    if state is not None:
+                        for field in fields:
+                            setattr(state, field, None)
+                db.session.commit()
+
+        return {
+            'bytes': {
+                'users': sum(size for _, size, _ in all_files),
+                'tts_cache': folder_bytes(tts_cache.folder),
+                'vision_cache': sum(os.path.getsize(path) for path in glob.glob(VISION_CACHE_PATH + "*")),
+                'records': folder_bytes(JOBS_FOLDER) + folder_bytes(STREAMS_FOLDER) + folder_bytes(RECORDINGS_FOLDER),
+            },
+            'free_bytes': shutil.disk_usage(FILES_FOLDER).free,
+            'scratch_free_bytes': shutil.disk_usage(SCRATCH_FOLDER).free,
+            'evictions': self.evictions,
+            'evicted_bytes': self.evicted_bytes,
+        }
+
+
+# Function that will return the statistics of the last sweep (eviction counts add up over every sweep), or None before the first one
+def storage_stats():
+    try:
+        with open(STATS_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# Function that, given the statistics of a sweep, will add them to the stored statistics
+def save_stats(stats):
+    previous = storage_stats() or {}
+    totals = previous.get('evictions_total', {})
+    for reason, count in stats['evictions'].items():
+        totals[reason] = totals.get(reason, 0) + count
+    stats = dict(stats, evictions_total=totals, swept=time.time(),
+                 evicted_bytes_total=previous.get('evicted_bytes_total', 0) + stats['evicted_bytes'])
+
+    tmp_path = STATS_PATH + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(stats, f)
+    os.replace(tmp_path, STATS_PATH)
+
+
+# Function that, given the app, will sweep once if no other worker is sweeping and return the statistics (None when skipped)
+def sweep(app):
+    os.makedirs(SCRATCH_FOLDER, exist_ok=True)
+    with open(LOCK_PATH, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        try:
+            stats = Sweep().run(app)
+            save_stats(stats)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    if sum(stats['evictions'].values()):
+        print(f"STORAGE SWEEP removed {sum(stats['evictions'].values())} files ({stats['evicted_bytes']} bytes)\n")
+    return stats
+
+
+# Function that, given the app, will sweep every SWEEP_INTERVAL seconds forever
+def sweep_forever(app):
+    while True:
+        try:
+            sweep(app)
+        except Exception as e:
+            print(f"Error in storage sweep: {e}\n")
+        time.sleep(SWEEP_INTERVAL)
+
+
+# Function that, given the app, will start the background sweeper of this worker the first time it is called (after gunicorn has forked)
+def start_sweeper(app):
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=sweep_forever, args=(app,), name='envisonet-sweeper', daemon=True)
+            _sweeper.start()
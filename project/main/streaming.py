@@ -0,0 +1,189 @@
+import os
+import re
+import json
+import time
+import uuid
+import queue
+import threading
+from itertools import chain
+
+from .process import tts_audio, SEMANTIC_KEYWORDS
+from .storage import STREAMS_FOLDER
+
+# Streamed responses are described by small JSON files in STREAMS_FOLDER so that whichever gunicorn worker gets the audio request can serve it (the storage sweeper removes old ones)
+
+# Matches the end of a sentence: ".", "!" or "?" (optionally followed by quotes or brackets) and then whitespace
+SENTENCE_END = re.compile(r'[.!?]+["\')\]]*\s+')
+
+# Words whose full stop does not end a sentence ("Dr. Smith", "e.g. red"), single letters (initials) are treated the same way
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "prof", "st", "jr", "sr", "vs", "e.g", "i.e", "approx", "fig"}
+
+# Keywords are a single word, so once the semantic response is longer than this or has a space in it, it is an answer
+KEYWORD_MAX_LENGTH = 12
+
+
+# Function that, given a stream id, will return the path of its record
+def stream_path(stream_id):
+    return os.path.join(STREAMS_FOLDER, f"{stream_id}.json")
+
+
+# Function that, given a stream record, will write it to disk atomically
+def save_stream(record):
+    tmp_path = stream_path(record['id']) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(record, f)
+    os.replace(tmp_path, stream_path(record['id']))
+
+
+# Function that, given a stream id, will return its record or None if it does not exist
+def load_stream(stream_id):
+    # Stream ids are generated with uuid4().hex, anything else cannot be a stream
+    if not stream_id.isalnum():
+        return None
+    try:
+        with open(stream_path(stream_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# Function that, given a stream id, will return the path of the record left once the stream has been claimed
+def claimed_path(stream_id):
+    return os.path.join(STREAMS_FOLDER, f"{stream_id}.claimed.json")
+
+
+# Function that, given a stream id, will return the record of the claimed stream (with the id of its response) or None
+def load_claimed_stream(stream_id):
+    if not stream_id.isalnum():
+        return None
+    try:
+        with open(claimed_path(stream_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# Function that, given a stream record and the id its response will be saved under, will claim the stream and return True,
+# or False when another request (in any worker) claimed it first. A stream is only generated once: its record is replaced
+# by one that sends later requests to the saved response
+def claim_stream(record, response_id):
+    claimed = {'id': record['id'], 'folder': record['folder'], 'response_id': response_id, 'created': time.time()}
+    tmp_path = claimed_path(record['id']) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(claimed, f)
+    try:
+        # Linking fails when the claimed record already exists, so only one request can win
+        os.link(tmp_path, claimed_path(record['id']))
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+    try:
+        os.remove(stream_path(record['id']))
+    except FileNotFoundError:
+        pass
+    return True
+
+
+# Function that, given the user's folder, the kind of query ("image" or "audio"), the transcript and the image, will record a response to be streamed and return its id
+def create_stream(UPLOAD_FOLDER, kind, transcript, image_path=None, prepared_image=None):
+    os.makedirs(STREAMS_FOLDER, exist_ok=True)
+
+    record = {
+        'id': uuid.uuid4().hex,
+        'folder': UPLOAD_FOLDER,
+        'kind': kind,
+        'transcript': transcript,
+        'image_path': image_path,
+        'prepared_image': prepared_image,
+        'created': time.time(),
+    }
+    save_stream(record)
+    return record['id']
+
+
+# Function that, given text, will return the match of the first sentence end in it that is not an abbreviation's full stop, or None
+# Decimals ("3.5") are never split, since a sentence end has to be followed by whitespace
+def sentence_end(text):
+    for match in SENTENCE_END.finditer(text):
+        words = text[:match.start()].split()
+        if match.group().rstrip() == "." and words:
+            word = words[-1].lower()
+            if word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()):
+                continue
+        return match
+    return None
+
+
+# Function that, given pieces of text as they are generated, will yield whole sentences as soon as each one is complete
+def split_sentences(pieces):
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        while True:
+            match = sentence_end(buffer)
+            if not match:
+                break
+            sentence = buffer[:match.end()].strip()
+            buffer = buffer[match.end():]
+            if sentence:
+                yield sentence
+
+    # Whatever is left when the generation ends is the last sentence
+    if buffer.strip():
+        yield buffer.strip()
+
+
+# Function that, given the pieces of a semantic response, will return the keyword (or None for an answer) and the pieces with nothing lost
+# Only the first few pieces are read, so the answer can still be streamed afterwards
+def detect_keyword(pieces):
+    pieces = iter(pieces)
+    text = ""
+    for piece in pieces:
+        text += piece
+        stripped = text.strip()
+        if len(stripped) > KEYWORD_MAX_LENGTH or re.search(r'\s', stripped):
+            return None, chain([text], pieces)
+
+    if text.strip() in SEMANTIC_KEYWORDS:
+        return text.strip(), iter(())
+    return None, iter([text])
+
+
+# Function that, given pieces of generated text, the path for the full response and a function to call once it is saved, will yield MP3 audio sentence by sentence
+# Generation and TTS run in a background thread so later sentences are generated while earlier ones are being sent
+def speak_stream(pieces, tts_audio_path, saved=None):
+    chunks = queue.Queue()
+    started = time.perf_counter()
+
+    def produce():
+        try:
+            for sentence in split_sentences(pieces):
+                # MP3 frames can simply be joined, so streamed responses are always MP3 whatever "TTS_FORMAT" is
+                audio_content = tts_audio(sentence, "mp3")
+                if audio_content:
+                    chunks.put(audio_content)
+        except Exception as e:
+            print(f"Error in streamed response: {e}\n")
+        finally:
+            chunks.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    spoken = []
+    while True:
+        audio_content = chunks.get()
+        if audio_content is None:
+            break
+        if not spoken:
+            print(f"TIME TO FIRST AUDIO {time.perf_counter() - started:.2f}s\n")
+        spoken.append(audio_content)
+        yield audio_content
+
+    # Saves the whole response so it can be repeated later
+    if spoken:
+        with open(tts_audio_path, "wb") as f:
+            f.write(b"".join(spoken))
+        if saved is not None:
+            saved()
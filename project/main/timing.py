@@ -0,0 +1,90 @@
+import json
+import time
+import logging
+import threading
+
+from .metrics import current_timer, request_id, STAGE_SECONDS, QUERY_SECONDS
+
+# Structured (JSON) log lines, one per query
+log = logging.getLogger('envisonet')
+
+
+# Class that records how long each stage of a query takes and which stages it had to wait for
+# Creating a timer makes it the current one, so stages timed deeper down (with "metrics.stage") are recorded with it, until it reports
+# or is closed, after which the stages go back to the timer before it (or to no timer)
+class StageTimer:
+    def __init__(self, name):
+        self.name = name
+        self.intent = '-'
+        self.request_id = request_id.get()
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.token = current_timer.set(self)
+
+    # Function that stops the timer from being the current one (later requests in this thread must not record into it)
+    def close(self):
+        if self.token is not None:
+            current_timer.reset(self.token)
+            self.token = None
+
+    # Function that, given a stage, its start and end times, the stages it depends on, and whether it is part of another stage, will record it
+    def record(self, stage, start, end, after, nested=False):
+        with self.lock:
+            self.stages[stage] = {'start': start - self.started, 'end': end - self.started, 'after': after, 'nested': nested}
+
+    # Function that, given a stage name, the stages it depends on, and a function with its arguments, will run and time the function
+    def run(self, stage, after, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(stage, start, time.perf_counter(), after)
+
+    # Same as "run", for a coroutine function (async mode)
+    async def run_async(self, stage, after, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            self.record(stage, start, time.perf_counter(), after)
+
+    # Function that will return the chain of stages that decided how long the query took
+    def critical_path(self):
+        stages = {stage: t for stage, t in self.stages.items() if not t['nested']}
+        if not stages:
+            return []
+
+        # Starts from the stage that finished last and walks back through the dependency that finished last each time
+        path = [max(stages, key=lambda stage: stages[stage]['end'])]
+        while True:
+            after = [stage for stage in stages[path[-1]]['after'] if stage in stages]
+            if not after:
+                break
+            path.append(max(after, key=lambda stage: stages[stage]['end']))
+        return path[::-1]
+
+    # Function that will return the timings of every stage, the total time and the critical path
+    def summary(self):
+        durations = {stage: round(t['end'] - t['start'], 3) for stage, t in self.stages.items()}
+        return {
+            'stages': durations,
+            'total': round(time.perf_counter() - self.started, 3),
+            'serial_total': round(sum(durations[stage] for stage, t in self.stages.items() if not t['nested']), 3),
+            'critical_path': self.critical_path(),
+        }
+
+    # Function that prints the timings to the terminal, adds them to the metrics and writes the query's log line
+    def report(self):
+        self.close()
+        summary = self.summary()
+        stages = ", ".join(f"{stage} {duration:.2f}s" for stage, duration in summary['stages'].items())
+        path = " -> ".join(summary['critical_path'])
+        print(f"TIMINGS {self.name}: {stages} | total {summary['total']:.2f}s "
+              f"(stages add up to {summary['serial_total']:.2f}s) | critical path: {path}\n")
+
+        for stage, duration in summary['stages'].items():
+            STAGE_SECONDS.observe(duration, stage=stage, route=self.name, intent=self.intent)
+        QUERY_SECONDS.observe(summary['total'], route=self.name, intent=self.intent)
+
+        log.info(json.dumps(dict(summary, request_id=self.request_id, route=self.name, intent=self.intent)))
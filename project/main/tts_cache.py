@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+import threading
+
+# Finished (volume boosted) TTS audio is kept here so repeated responses skip the TTS request and the re-encode
+TTS_CACHE_FOLDER = 'FILES/tts_cache'
+
+# Once the cache holds more than this many bytes, the least recently used responses are removed
+TTS_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+
+# Class for an on-disk cache of TTS audio that every gunicorn worker can share
+class TTSCache:
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Counters for this worker
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Function that, given the text and every setting that changes the audio, will return the cache key
+    @staticmethod
+    def key(text, engine, voice, gain, audio_format):
+        settings = json.dumps([text, engine, voice, gain, audio_format])
+        return hashlib.sha256(settings.encode('utf-8')).hexdigest()
+
+    # Function that, given a cache key, will return the path of the cached audio
+    def path(self, key):
+        return os.path.join(self.folder, f"{key}.audio")
+
+    # Function that, given one or more cache keys (e.g. the same text spoken by different voices), will return the audio of the first one
+    # that is cached, or None if none of them is
+    def get(self, *keys):
+        for key in keys:
+            path = self.path(key)
+            try:
+                with open(path, "rb") as f:
+                    audio_content = f.read()
+                # Updates the modification time, which is what the least recently used eviction goes by
+                os.utime(path)
+            except FileNotFoundError:
+                continue
+
+            with self.lock:
+                self.hits += 1
+            return audio_content
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    # Function that, given a cache key and audio, will store the audio in the cache
+    def put(self, key, audio_content):
+        os.makedirs(self.folder, exist_ok=True)
+
+        # Writes to a temporary file first so other workers never read a half written file
+        tmp_path = self.path(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(audio_content)
+        os.replace(tmp_path, self.path(key))
+
+        self.evict()
+
+    # Function that removes the least recently used audio until the cache fits in max_bytes
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.folder):
+            if not entry.name.endswith(".audio"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        # Oldest first
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                with self.lock:
+                    self.evictions += 1
+            except FileNotFoundError:
+                # Another worker already removed it
+                pass
+            total -= size
+
+    # Function that will return the hit/miss counters of this worker and the current size of the cache
+    def stats(self):
+        entries = 0
+        total = 0
+        if os.path.isdir(self.folder):
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith(".audio"):
+                    entries += 1
+                    total += entry.stat().st_size
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+        }
+
+
+# The cache used by "speak"
+tts_cache = TTSCache(TTS_CACHE_FOLDER, TTS_CACHE_MAX_BYTES)
@@ -0,0 +1,114 @@
+import json
+import logging
+import numpy as np
+from speech_recognition import AudioData
+
+from .audio import SAMPLE_RATE, SAMPLE_WIDTH
+from .metrics import request_id, count_bytes
+
+# Voice activity trimming before speech recognition: silence before and after the user speaks is cut, long pauses are shortened
+# and the audio is resampled to 16 kHz mono, so less audio is uploaded and recognized
+
+log = logging.getLogger('envisonet')
+
+# Toggle to trim the audio before speech recognition (True) or send it as it is (False)
+trim_silence = True
+
+# Length of the frames speech is detected in, in seconds
+FRAME_SECONDS = 0.03
+
+# A frame is speech when it is this many dB louder than the quietest frames (the noise floor) and louder than MIN_SPEECH_DB
+SPEECH_MARGIN_DB = 12
+MIN_SPEECH_DB = -50
+
+# Quieter frames that cross zero this often (share of samples) are speech too, e.g. "s" and "f" sounds
+UNVOICED_MARGIN_DB = 6
+UNVOICED_ZCR = 0.25
+
+# Share of the quietest frames taken as the noise floor
+NOISE_PERCENTILE = 10
+
+# Seconds kept before and after speech, so soft starts and ends of words are not cut
+PADDING_SECONDS = 0.2
+
+# Pauses longer than MAX_PAUSE_SECONDS are shortened to KEPT_PAUSE_SECONDS
+MAX_PAUSE_SECONDS = 0.8
+KEPT_PAUSE_SECONDS = 0.4
+
+
+# Function that, given AudioData, will return its samples as 16-bit integers at SAMPLE_RATE
+def resample(audio):
+    samples = np.frombuffer(audio.get_raw_data(convert_width=SAMPLE_WIDTH), dtype=np.int16).astype(np.float32)
+    if audio.sample_rate == SAMPLE_RATE or len(samples) == 0:
+        return samples.astype(np.int16)
+
+    # When downsampling, a moving average removes most of what is above the new Nyquist frequency before interpolating
+    if audio.sample_rate > SAMPLE_RATE:
+        width = int(np.ceil(audio.sample_rate / SAMPLE_RATE))
+        samples = np.convolve(samples, np.ones(width, dtype=np.float32) / width, mode="same")
+    length = int(len(samples) * SAMPLE_RATE / audio.sample_rate)
+    positions = np.arange(length) * (audio.sample_rate / SAMPLE_RATE)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.int16)
+
+
+# Function that, given 16-bit samples, will return which frames hold speech
+def speech_frames(samples, frame):
+    frames = samples[:len(samples) // frame * frame].reshape(-1, frame).astype(np.float32)
+
+    # Energy in dB below full scale, and the share of samples where the sign changes
+    rms = np.sqrt(np.mean(frames ** 2, axis=1))
+    energy = 20 * np.log10(np.maximum(rms, 1) / 32768)
+    zcr = np.mean(np.abs(np.diff(np.signbit(frames), axis=1)), axis=1)
+
+    floor = np.percentile(energy, NOISE_PERCENTILE)
+    voiced = energy > max(floor + SPEECH_MARGIN_DB, MIN_SPEECH_DB)
+    unvoiced = (energy > max(floor + UNVOICED_MARGIN_DB, MIN_SPEECH_DB)) & (zcr > UNVOICED_ZCR)
+    speech = voiced | unvoiced
+
+    # Frames close to speech are kept as well
+    padding = int(PADDING_SECONDS / FRAME_SECONDS)
+    return np.convolve(speech, np.ones(2 * padding + 1), mode="same") > 0
+
+
+# Function that, given which frames hold speech, will return which frames to keep: no silence at the ends and shortened pauses
+def kept_frames(speech):
+    keep = speech.copy()
+    max_pause = int(MAX_PAUSE_SECONDS / FRAME_SECONDS)
+    half_kept = int(KEPT_PAUSE_SECONDS / FRAME_SECONDS) // 2
+
+    # Pauses are the runs of silent frames between the first and the last speech frame
+    spoken = np.flatnonzero(speech)
+    edges = np.diff(speech[spoken[0]:spoken[-1] + 1].astype(np.int8))
+    starts = np.flatnonzero(edges == -1) + spoken[0] + 1
+    ends = np.flatnonzero(edges == 1) + spoken[0] + 1
+    for start, end in zip(starts, ends):
+        if end - start > max_pause:
+            keep[start:end] = False
+            keep[start:start + half_kept] = True
+            keep[end - half_kept:end] = True
+        else:
+            keep[start:end] = True
+    return keep
+
+
+# Function that, given AudioData, will return it at 16 kHz mono with the silence trimmed, and log how much was removed
+def trim(audio):
+    samples = resample(audio)
+    frame = int(FRAME_SECONDS * SAMPLE_RATE)
+    speech = speech_frames(samples, frame) if len(samples) >= frame else np.zeros(0, dtype=bool)
+
+    # Audio without anything that stands out from the noise is sent as it is, recognition decides whether it is speech
+    if trim_silence and speech.any():
+        keep = np.repeat(kept_frames(speech), frame)
+        trimmed = samples[:len(keep)][keep]
+    else:
+        trimmed = samples
+
+    count_bytes("vad", "in", len(audio.frame_data))
+    count_bytes("vad", "out", trimmed.nbytes)
+    removed = 1 - len(trimmed) / len(samples) if len(samples) else 0.0
+    log.info(json.dumps({"vad": {"seconds_in": round(len(samples) / SAMPLE_RATE, 2),
+                                 "seconds_out": round(len(trimmed) / SAMPLE_RATE, 2),
+                                 "removed": round(removed, 3)},
+                         "request_id": request_id.get()}))
+    return AudioData(trimmed.tobytes(), SAMPLE_RATE, SAMPLE_WIDTH)
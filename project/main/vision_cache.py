@@ -0,0 +1,124 @@
+import time
+import sqlite3
+import hashlib
+import threading
+import contextvars
+
+from .intent import normalize
+
+# Descriptions from the vision model are kept here, shared by every gunicorn worker
+VISION_CACHE_PATH = 'FILES/vision_cache.sqlite'
+
+# Seconds a description stays valid
+VISION_CACHE_TTL = 24 * 60 * 60
+
+# Once there are more descriptions than this, the least recently used are removed
+VISION_CACHE_MAX_ENTRIES = 5000
+
+# Toggle to answer from the cache and store new descriptions (False sends every image to the vision model, e.g. "batch.py --no-cache")
+cache_enabled = True
+
+# User whose queries are being answered, set for every logged-in request (and carried into its jobs and stages)
+# A description is only ever given back to the user it was made for, since it can hold the text of a private document
+owner = contextvars.ContextVar('vision_cache_owner', default=None)
+
+_local = threading.local()
+
+
+# Function that will return this thread's connection to the cache database, creating the tables the first time
+def connection():
+    if getattr(_local, 'db', None) is None:
+        db = sqlite3.connect(VISION_CACHE_PATH, timeout=5)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        # Descriptions used to be matched on a perceptual hash, which mixed up different labels and documents, so they are dropped
+        db.execute("DROP TABLE IF EXISTS descriptions")
+        db.execute("""CREATE TABLE IF NOT EXISTS image_descriptions (
+                          owner TEXT NOT NULL,
+                          image_hash TEXT NOT NULL,
+                          transcript TEXT NOT NULL,
+                          description TEXT NOT NULL,
+                          created REAL NOT NULL,
+                          last_used REAL NOT NULL,
+                          PRIMARY KEY (owner, image_hash, transcript))""")
+        db.execute("CREATE INDEX IF NOT EXISTS image_descriptions_last_used ON image_descriptions (last_used)")
+        db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        db.commit()
+        _local.db = db
+    return _local.db
+
+
+# Function that, given a prepared image, will return the SHA-256 of its bytes (only the very same image gets the same hash)
+def image_hash(prepared_image):
+    return hashlib.sha256(prepared_image['data'].encode()).hexdigest()
+
+
+# Function that will return the key of the current user's descriptions ("" outside a request, e.g. in the batch command)
+def current_owner():
+    user_id = owner.get()
+    return "" if user_id is None else str(user_id)
+
+
+# Function that, given a counter name and an amount, will add the amount to the counter
+def count(db, name, amount=1):
+    db.execute("INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+               (name, amount, amount))
+
+
+# Function that, given a prepared image and a transcript, will return the description the current user got for the same image
+# and question, or None
+def lookup(prepared_image, transcript):
+    if not cache_enabled:
+        return None
+    db = connection()
+    now = time.time()
+
+    row = db.execute("""SELECT description FROM image_descriptions
+                        WHERE owner = ? AND image_hash = ? AND transcript = ? AND created > ?""",
+                     (current_owner(), image_hash(prepared_image), normalize(transcript), now - VISION_CACHE_TTL)).fetchone()
+    with db:
+        if row is None:
+            count(db, 'misses')
+            return None
+        db.execute("UPDATE image_descriptions SET last_used = ? WHERE owner = ? AND image_hash = ? AND transcript = ?",
+                   (now, current_owner(), image_hash(prepared_image), normalize(transcript)))
+        count(db, 'hits')
+    print("VISION CACHE HIT")
+    return row[0]
+
+
+# Function that, given a prepared image, a transcript and the description of the image, will store the description for the current user
+def store(prepared_image, transcript, description):
+    if not cache_enabled:
+        return
+    db = connection()
+    now = time.time()
+    with db:
+        db.execute("""INSERT OR REPLACE INTO image_descriptions (owner, image_hash, transcript, description, created, last_used)
+                      VALUES (?, ?, ?, ?, ?, ?)""",
+                   (current_owner(), image_hash(prepared_image), normalize(transcript), description, now, now))
+
+        # Removes expired descriptions, then the least recently used ones if there are too many
+        expired = db.execute("DELETE FROM image_descriptions WHERE created <= ?", (now - VISION_CACHE_TTL,)).rowcount
+        evicted = db.execute("""DELETE FROM image_descriptions WHERE rowid IN (
+                                    SELECT rowid FROM image_descriptions ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+                             (VISION_CACHE_MAX_ENTRIES,)).rowcount
+        if expired + evicted:
+            count(db, 'evictions', expired + evicted)
+
+
+# Function that will return the hit rate and size of the cache (shared by every worker)
+def stats():
+    db = connection()
+    counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+    hits = counters.get('hits', 0)
+    misses = counters.get('misses', 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+        'evictions': counters.get('evictions', 0),
+        'entries': db.execute("SELECT COUNT(*) FROM image_descriptions").fetchone()[0],
+        'ttl': VISION_CACHE_TTL,
+        'max_entries': VISION_CACHE_MAX_ENTRIES,
+    }
@@ -18,6 +18,46 @@ document.addEventListener('DOMContentLoaded', () => {
     let audioChunks = [];
     let uploadedImage = null;
 
+    // Defines the streamed recording: its chunks are sent while the user speaks, one after the other
+    const CHUNK_MS = 1000;
+    let recording = null;
+    let chunkUploads = Promise.resolve();
+    let chunkCount = 0;
+    let streamingFailed = false;
+
+    // Function that starts a recording on the server, if that fails the whole audio is sent at the end instead
+    async function startStreamedRecording() {
+        try {
+            const response = await fetch('/recording', { method: 'POST' });
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            recording = await response.json();
+        } catch (error) {
+            console.error("Error starting the streamed recording:", error);
+            streamingFailed = true;
+        }
+    }
+
+    // Function that queues a chunk of audio to be sent after the ones before it
+    function sendChunk(chunk) {
+        const seq = chunkCount++;
+        chunkUploads = chunkUploads.then(async () => {
+            if (!recording || streamingFailed) {
+                return;
+            }
+            try {
+                const response = await fetch(recording.chunk_url + '?seq=' + seq, { method: 'POST', body: chunk });
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+            } catch (error) {
+                console.error("Error sending an audio chunk:", error);
+                streamingFailed = true;
+            }
+        });
+    }
+
     // Function to start recording audio
     async function startRecording() {
         // Checks for invalid mic permissions
@@ -31,15 +71,20 @@ document.addEventListener('DOMContentLoaded', () => {
             let options = { mimeType: 'audio/webm' };
             audioRecorder = new MediaRecorder(stream, options, workerOptions);
             
-            // Stores audio chunks
+            // Starts the recording on the server while the recorder is set up
+            const recordingStarted = startStreamedRecording();
+
+            // Stores audio chunks, and sends them to the server as they arrive
             audioRecorder.ondataavailable = (event) => {
                 if (event.data.size > 0) {
                     audioChunks.push(event.data);
+                    sendChunk(event.data);
                 }
             };
 
-            // Starts recording
-            audioRecorder.start();
+            // Starts recording, handing over a chunk every second
+            chunkUploads = recordingStarted;
+            audioRecorder.start(CHUNK_MS);
             console.log("Recording started.");
 
             // Waits for half a second before re-enabling the audio button
@@ -53,34 +98,87 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     } 
 
+    // Function that polls a queued job until the server has finished processing it
+    async function waitForJob(statusUrl) {
+        while (true) {
+            const response = await fetch(statusUrl);
+            if (!response.ok) {
+                throw new Error("Job status error: " + response.statusText);
+            }
+
+            const job = await response.json();
+            if (job.status === 'done' || job.status === 'error') {
+                return job.result;
+            }
+
+            // Checks again in half a second
+            await new Promise(resolve => setTimeout(resolve, 500));
+        }
+    }
+
+    // Number of times a query turned away because the server is busy is sent again
+    const MAX_BUSY_RETRIES = 3;
+
     // Function to send image and audio to the server
     async function sendFilesToServer(imageFile, audioBlob) {
         // Defines formData
         const formData = new FormData();
         
-        // Appends both the image and audio files to FormData
-        formData.append('image', imageFile);
-        formData.append('audio', audioBlob, 'recorded_audio.webm');
+        // Waits for the last chunks, then sends the recording id if every chunk arrived, otherwise the whole audio
+        await chunkUploads;
+        if (imageFile) {
+            formData.append('image', imageFile);
+        }
+        if (recording && !streamingFailed) {
+            formData.append('recording_id', recording.recording_id);
+        } else {
+            formData.append('audio', audioBlob, 'recorded_audio.webm');
+        }
+
+        // A query about a streamed recording also names it in the URL, so the server can admit it before reading the form
+        const uploadUrl = (recording && !streamingFailed) ? '/upload_files?recording_id=' + recording.recording_id : '/upload_files';
 
         // Posts formData to the upload_files route in main.py
         try {
-            const response = await fetch('/upload_files', {
+            let response = await fetch(uploadUrl, {
                 method: 'POST',
                 body: formData,
             });
 
+            // When the server is busy (503) or the user's last queries are still running (429), tries again after the time it asks for
+            for (let retries = 0; (response.status === 429 || response.status === 503) && retries < MAX_BUSY_RETRIES; retries++) {
+                const retryAfter = parseInt(response.headers.get('Retry-After'), 10) || 5;
+                console.log("Server busy, trying again in " + retryAfter + "s");
+                await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+                response = await fetch(uploadUrl, {
+                    method: 'POST',
+                    body: formData,
+                });
+            }
+
             if (response.ok) {
+                let result = await response.json();
+
+                // Waits for the result if the server queued the query as a job
+                if (result.job_id) {
+                    result = await waitForJob(result.status_url);
+                }
+
                 // Dissapears the spinner and reload disclaimer
                 document.getElementById('spinnerdiv').style.display = 'none';
                 document.getElementById('spinner').style.display = 'none';
                 document.getElementById('reloadDisclaimer').style.display = 'none';
-                
-                const result = await response.json();
+
                 console.log("Server response:", result);
-                
-                if (result.audio_url) {
-                    // Sets the source of the audio player with a unique URL each time to ensure the source is refreshed
-                    ttsAudioPlayer.src = result.audio_url + '?t=' + new Date().getTime();
+
+                // Follows redirects (e.g. logout) sent back with the result
+                if (result.redirect_url) {
+                    window.location.href = result.redirect_url;
+                }
+
+                else if (result.audio_url) {
+                    // Sets the source of the audio player, response URLs change with their audio so they can be cached
+                    ttsAudioPlayer.src = result.audio_url;
                     // Sets the audioplayer volume to max
                     ttsAudioPlayer.volume = 1.0;
                     // Makes the audioplayer appear
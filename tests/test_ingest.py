@@ -0,0 +1,113 @@
+import io
+import subprocess
+from concurrent.futures import Future
+
+import pytest
+
+from project.main import ingest
+from project.main.audio import decode_webm, FFMPEG
+
+SEGMENT_SAMPLES = ingest.SEGMENT_SECONDS * ingest.SAMPLE_RATE
+STEP_SAMPLES = (ingest.SEGMENT_SECONDS - ingest.OVERLAP_SECONDS) * ingest.SAMPLE_RATE
+
+
+# Pool that runs the work as soon as it is submitted, so every chunk has been decoded and recognized before the next one is added
+class InlinePool:
+    def submit(self, func, *args):
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+
+@pytest.fixture(autouse=True)
+def local_recordings(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, 'RECORDINGS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(ingest, 'STREAMING_RECOGNIZER', "local")
+    monkeypatch.setattr(ingest, 'get_segment_pool', InlinePool)
+
+
+# Noise gives every half second of audio its own word from the local recognizer (a tone would repeat one word)
+@pytest.fixture(scope="module")
+def webm(tmp_path_factory):
+    path = tmp_path_factory.mktemp("audio") / "query.webm"
+    subprocess.run([FFMPEG, "-loglevel", "error", "-y", "-f", "lavfi", "-i", "anoisesrc=duration=14:color=pink:seed=7:amplitude=0.3",
+                    "-ac", "1", "-ar", "48000", "-c:a", "libopus", "-b:a", "32k", str(path)], check=True)
+    return path.read_bytes()
+
+
+def one_shot(data):
+    return ingest.local_recognize(decode_webm(io.BytesIO(data)))
+
+
+def send_in_chunks(data, count=14):
+    recording_id = ingest.create_recording(1)
+    size = len(data) // count + 1
+    for seq in range(count):
+        assert ingest.add_chunk(recording_id, seq, data[seq * size:(seq + 1) * size])
+    return recording_id
+
+
+def test_streamed_transcript_matches_one_shot(webm):
+    recording_id = send_in_chunks(webm)
+
+    # The segments were recognized while the chunks arrived, from audio decoded a little at a time
+    segments = ingest.load_record(recording_id)['segments']
+    assert segments and all(segment['status'] == 'done' for segment in segments.values())
+
+    assert ingest.StreamedAudio(recording_id).transcribe() == one_shot(webm)
+
+
+def test_incremental_decode_matches_whole_decode(webm):
+    recording_id = send_in_chunks(webm)
+    decoded = ingest.decode_recording(recording_id).frame_data
+    with open(ingest.audio_path(recording_id), "rb") as f:
+        whole = decode_webm(f).frame_data
+    assert len(decoded) > 10 * ingest.SAMPLE_RATE * ingest.SAMPLE_WIDTH
+    assert decoded == whole[:len(decoded)]
+
+
+def test_segment_left_running_is_recognized_again(webm, monkeypatch):
+    monkeypatch.setattr(ingest, 'advance', lambda recording_id: None)
+    monkeypatch.setattr(ingest, 'SEGMENT_WAIT', 0.1)
+    recording_id = send_in_chunks(webm)
+
+    # Another request claimed the first segment and never finished it
+    with ingest.locked_record(recording_id) as record:
+        ingest.claim_segments(record, 1)
+
+    assert ingest.StreamedAudio(recording_id).transcribe() == one_shot(webm)
+
+
+def test_chunks_are_added_in_order():
+    recording_id = ingest.create_recording(1)
+    assert ingest.add_chunk(recording_id, 0, b"first")
+    # A chunk sent again is ignored, a chunk after a gap is refused
+    assert ingest.add_chunk(recording_id, 0, b"first")
+    assert not ingest.add_chunk(recording_id, 2, b"third")
+    assert ingest.add_chunk(recording_id, 1, b"second")
+
+    with open(ingest.audio_path(recording_id), "rb") as f:
+        assert f.read() == b"firstsecond"
+    assert ingest.load_record(recording_id)['next_seq'] == 2
+
+
+@pytest.mark.parametrize("samples, count", [
+    (0, 0),
+    (SEGMENT_SAMPLES - 1, 0),
+    (SEGMENT_SAMPLES, 1),
+    (SEGMENT_SAMPLES + STEP_SAMPLES - 1, 1),
+    (SEGMENT_SAMPLES + STEP_SAMPLES, 2),
+])
+def test_complete_segments(samples, count):
+    assert ingest.complete_segments(samples) == count
+
+
+@pytest.mark.parametrize("transcripts, merged", [
+    (["what is on", "on the table"], "what is on the table"),
+    (["read the sign", "The sign says stop"], "read the sign says stop"),
+    (["no overlap here", "at all"], "no overlap here at all"),
+    (["hello", None, "world"], "hello world"),
+    ([None, None], None),
+])
+def test_merge_transcripts(transcripts, merged):
+    assert ingest.merge_transcripts(transcripts) == merged
@@ -0,0 +1,40 @@
+import pytest
+
+from project.main.intent import classify_intent, local_intent
+
+
+# Questions that only contain a command's words have to reach xAI, never act as the command
+@pytest.mark.parametrize("transcript", [
+    "read the sign out loud",
+    "what does the sign out front say",
+    "can you read the log off the screen",
+    "can you repeat the number on the sign",
+    "what can you do with this coupon",
+    "how do i use this microwave",
+    "how do i use this inhaler",
+    "tell me what you can see",
+    "say that again slower",
+])
+def test_questions_are_not_commands(transcript):
+    intent, confidence = classify_intent(transcript)
+    assert confidence < 1.0
+    assert local_intent(transcript) is None
+
+
+@pytest.mark.parametrize("transcript, intent", [
+    ("log out", "logout"),
+    ("Please log me out.", "logout"),
+    ("sign off", "logout"),
+    ("repeat that", "repeat"),
+    ("Can you repeat?", "repeat"),
+    ("what did you just say", "repeat"),
+    ("I didn't hear you.", "repeat"),
+    ("one more time", "repeat"),
+    ("I want to log out", "logout"),
+    ("what can I ask you?", "askAbout"),
+    ("what can you do", "askAbout"),
+    ("what color is the car in the last image", "lastImage"),
+    ("looking at the same photo, is it raining", "lastImage"),
+])
+def test_commands(transcript, intent):
+    assert local_intent(transcript) == intent
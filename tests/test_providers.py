@@ -0,0 +1,172 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from speech_recognition import UnknownValueError
+
+from project.main import providers, process, metrics
+
+
+# Every test starts with closed circuits, no latencies and short budgets and cooldowns
+@pytest.fixture(autouse=True)
+def fresh_providers(monkeypatch):
+    monkeypatch.setattr(providers, '_breakers', {})
+    monkeypatch.setattr(providers, '_latencies', {})
+    monkeypatch.setattr(providers, '_pool', None)
+    monkeypatch.setattr(providers, 'LATENCY_BUDGETS', {'stt': 0.2, 'vision': 0.2, 'semantic': 0.2, 'tts': 0.2})
+    monkeypatch.setattr(providers, 'BREAKER_COOLDOWN', 0.1)
+    monkeypatch.setattr(providers.PROVIDER_REQUESTS, 'values', {})
+    monkeypatch.setattr(providers.PROVIDER_ANSWERS, 'values', {})
+
+
+# Function that, given a stage, a provider and the reason, will return how many requests were sent for it
+def requests_sent(stage, provider, reason):
+    return providers.PROVIDER_REQUESTS.values.get((stage, provider, reason), 0)
+
+
+# Fake providers: one that answers after a delay, and one that fails
+def answer(value, delay=0.0):
+    def call():
+        time.sleep(delay)
+        return value
+    return call
+
+
+def fail(message):
+    def call():
+        raise RuntimeError(message)
+    return call
+
+
+def answer_async(value, delay=0.0):
+    async def call():
+        await asyncio.sleep(delay)
+        return value
+    return call
+
+
+def fail_async(message):
+    async def call():
+        raise RuntimeError(message)
+    return call
+
+
+def open_circuit(provider):
+    for _ in range(providers.BREAKER_MIN_REQUESTS):
+        providers.breaker(provider).record(True)
+    assert providers.breaker(provider).state() == 'open'
+
+
+def test_first_provider_answers():
+    assert providers.call('vision', {'openai': answer("openai"), 'xai': answer("xai")}) == "openai"
+    assert requests_sent('vision', 'xai', 'hedge') == 0
+
+
+def test_slow_provider_is_hedged():
+    start = time.perf_counter()
+    result = providers.call('vision', {'openai': answer("openai", delay=1.0), 'xai': answer("xai")})
+    assert result == "xai"
+    # The second provider is asked once the first has used up its budget, not once it has answered
+    assert time.perf_counter() - start < 0.8
+    assert requests_sent('vision', 'xai', 'hedge') == 1
+
+
+def test_failing_provider_fails_over():
+    assert providers.call('vision', {'openai': fail("down"), 'xai': answer("xai")}) == "xai"
+    assert requests_sent('vision', 'xai', 'failover') == 1
+
+
+def test_last_error_is_raised_when_every_provider_fails():
+    with pytest.raises(RuntimeError, match="xai down"):
+        providers.call('vision', {'openai': fail("openai down"), 'xai': fail("xai down")})
+
+
+def test_open_circuit_is_skipped():
+    open_circuit('openai')
+    assert providers.call('vision', {'openai': answer("openai"), 'xai': answer("xai")}) == "xai"
+    assert requests_sent('vision', 'openai', 'first') == 0
+
+
+def test_preferred_provider_is_asked_when_every_circuit_is_open():
+    open_circuit('openai')
+    open_circuit('xai')
+    assert providers.call('vision', {'openai': answer("openai"), 'xai': answer("xai")}) == "openai"
+
+
+def test_circuit_opens_after_failures_and_closes_after_a_good_probe():
+    breaker = providers.breaker('openai')
+    for _ in range(providers.BREAKER_MIN_REQUESTS):
+        assert breaker.allow()
+        breaker.record(True)
+    assert breaker.state() == 'open'
+    assert not breaker.allow()
+
+    # After the cooldown a single request is let through to try the provider again
+    time.sleep(providers.BREAKER_COOLDOWN)
+    assert breaker.state() == 'half_open'
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state() == 'closed'
+    assert breaker.allow()
+
+
+def test_failed_probe_opens_the_circuit_again():
+    breaker = providers.breaker('openai')
+    open_circuit('openai')
+    time.sleep(providers.BREAKER_COOLDOWN)
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state() == 'open'
+    assert not breaker.allow()
+
+
+def test_answer_over_budget_counts_as_failure():
+    providers.call('stt', {'google': answer("slow", delay=0.3)})
+    assert list(providers.breaker('google').outcomes) == [True]
+
+
+def test_no_speech_is_not_a_provider_failure(monkeypatch):
+    class Recognizer:
+        def recognize_google(self, audio, endpoint):
+            raise UnknownValueError()
+
+    monkeypatch.setattr(process, 'recognizer', Recognizer)
+    errors = dict(metrics.UPSTREAM_ERRORS.values)
+    assert providers.call('stt', {'google': lambda: process.stt_google(None)}) is None
+    assert list(providers.breaker('google').outcomes) == [False]
+    assert metrics.UPSTREAM_ERRORS.values == errors
+
+
+def test_async_slow_provider_is_hedged():
+    result = asyncio.run(providers.call_async('vision', {'openai': answer_async("openai", delay=1.0), 'xai': answer_async("xai")}))
+    assert result == "xai"
+    assert requests_sent('vision', 'xai', 'hedge') == 1
+
+
+def test_async_failing_provider_fails_over():
+    result = asyncio.run(providers.call_async('vision', {'openai': fail_async("down"), 'xai': answer_async("xai")}))
+    assert result == "xai"
+    assert requests_sent('vision', 'xai', 'failover') == 1
+
+
+def test_async_preferred_provider_is_asked_when_every_circuit_is_open():
+    open_circuit('openai')
+    open_circuit('xai')
+    assert asyncio.run(providers.call_async('vision', {'openai': answer_async("openai"), 'xai': answer_async("xai")})) == "openai"
+
+
+# Fake chat client that streams the given pieces, or fails before the first one
+def streaming_client(pieces=None):
+    def create(**kwargs):
+        if pieces is None:
+            raise RuntimeError("down")
+        return iter(SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))]) for piece in pieces)
+    return lambda stage_name: SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def test_streamed_answer_fails_over(monkeypatch):
+    monkeypatch.setattr(process, 'CHAT_CLIENTS', {'xai': streaming_client(), 'openai': streaming_client(["The sky", " is blue."])})
+    assert "".join(process.xaiprocess_semantic_stream("what colour is the sky")) == "The sky is blue."
+    assert requests_sent('semantic', 'openai', 'failover') == 1
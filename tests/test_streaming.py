@@ -0,0 +1,71 @@
+import pytest
+
+from project.main import streaming
+
+
+@pytest.fixture(autouse=True)
+def streams_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(streaming, 'STREAMS_FOLDER', str(tmp_path))
+
+
+def test_stream_is_claimed_once():
+    stream_id = streaming.create_stream("FILES/files_for_1", "audio", "what is this")
+    record = streaming.load_stream(stream_id)
+
+    assert streaming.claim_stream(record, "first")
+    assert not streaming.claim_stream(record, "second")
+
+    # The record is gone, and the claimed one points at the response of the request that won
+    assert streaming.load_stream(stream_id) is None
+    claimed = streaming.load_claimed_stream(stream_id)
+    assert claimed['response_id'] == "first"
+    assert claimed['folder'] == "FILES/files_for_1"
+
+
+def test_unclaimed_stream_has_no_claimed_record():
+    stream_id = streaming.create_stream("FILES/files_for_1", "audio", "what is this")
+    assert streaming.load_claimed_stream(stream_id) is None
+    assert streaming.load_claimed_stream("../jobs") is None
+
+
+@pytest.mark.parametrize("pieces, sentences", [
+    (["Hello there. How are", " you? Fine"], ["Hello there.", "How are you?", "Fine"]),
+    # A full stop that arrives before the rest of a decimal does not end the sentence
+    (["It costs 3.", "5 dollars. That is all."], ["It costs 3.5 dollars.", "That is all."]),
+    (["Dr. Smith and Mr. J. Jones met at St. Mary's, e.g. on Sunday. Then they left."],
+     ["Dr. Smith and Mr. J. Jones met at St. Mary's, e.g. on Sunday.", "Then they left."]),
+    (['He said "stop." Then', " he ran!"], ['He said "stop."', "Then he ran!"]),
+    (["   ", ""], []),
+])
+def test_split_sentences(pieces, sentences):
+    assert list(streaming.split_sentences(pieces)) == sentences
+
+
+@pytest.mark.parametrize("pieces, keyword", [
+    (["log", "out"], "logout"),
+    ([" repeat\n"], "repeat"),
+    (["lastImage"], "lastImage"),
+])
+def test_keyword_is_detected(pieces, keyword):
+    detected, rest = streaming.detect_keyword(iter(pieces))
+    assert detected == keyword
+    assert list(rest) == []
+
+
+def test_answer_keeps_every_piece_and_stays_lazy():
+    def pieces():
+        yield "The sky"
+        yield " is blue."
+        # Only read once the answer is spoken, not to tell it from a keyword
+        raise AssertionError("read too far")
+
+    keyword, rest = streaming.detect_keyword(pieces())
+    assert keyword is None
+    assert next(rest) == "The sky"
+
+
+@pytest.mark.parametrize("pieces", [["Unbelievable"], ["Supercalifragilistic"], ["logout now"]])
+def test_words_that_are_not_keywords_are_answers(pieces):
+    keyword, rest = streaming.detect_keyword(iter(pieces))
+    assert keyword is None
+    assert "".join(rest) == "".join(pieces)
@@ -0,0 +1,24 @@
+from project.main import metrics
+from project.main.timing import StageTimer
+
+
+def test_report_stops_the_timer_from_being_current():
+    timer = StageTimer("query")
+    assert metrics.current_timer.get() is timer
+    timer.report()
+    assert metrics.current_timer.get() is None
+
+    # A stage timed after the query (e.g. in the next request on this thread) is not recorded with it
+    with metrics.stage("password_check", route="login"):
+        pass
+    assert "password_check" not in timer.stages
+
+
+def test_nested_timer_gives_back_the_outer_one():
+    outer = StageTimer("outer")
+    inner = StageTimer("inner")
+    inner.close()
+    inner.close()
+    assert metrics.current_timer.get() is outer
+    outer.close()
+    assert metrics.current_timer.get() is None
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+from project.main import vision_cache
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(vision_cache, 'VISION_CACHE_PATH', str(tmp_path / "vision_cache.sqlite"))
+    monkeypatch.setattr(vision_cache, '_local', threading.local())
+
+
+# Queries are answered for user 1, the owner is set back afterwards so it does not carry into other tests
+@pytest.fixture(autouse=True)
+def owner():
+    token = vision_cache.owner.set(1)
+    yield
+    vision_cache.owner.reset(token)
+
+
+# Prepared images that only differ in a few bytes, like two labels with different expiry dates
+LABEL_2025 = {'data': "bGFiZWwgRVhQIDAzLzIwMjU=", 'mime': "image/jpeg"}
+LABEL_2027 = {'data': "bGFiZWwgRVhQIDExLzIwMjc=", 'mime': "image/jpeg"}
+
+
+def test_same_user_same_image_is_answered_from_the_cache():
+    vision_cache.store(LABEL_2025, "What does this say?", "EXP 03/2025")
+    assert vision_cache.lookup(LABEL_2025, "what does this say") == "EXP 03/2025"
+
+
+def test_a_different_image_is_not_answered_from_the_cache():
+    vision_cache.store(LABEL_2025, "what does this say", "EXP 03/2025")
+    assert vision_cache.lookup(LABEL_2027, "what does this say") is None
+
+
+def test_another_user_is_not_answered_from_the_cache():
+    vision_cache.store(LABEL_2025, "what does this say", "EXP 03/2025")
+    for user in (2, None):
+        token = vision_cache.owner.set(user)
+        try:
+            assert vision_cache.lookup(LABEL_2025, "what does this say") is None
+        finally:
+            vision_cache.owner.reset(token)